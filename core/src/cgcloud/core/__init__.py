@@ -20,8 +20,8 @@ def roles( ):
 
 
 def command_classes( ):
-    from cgcloud.core.commands import (ListRolesCommand,
-                                       CreateCommand,
+    from cgcloud.core.local_commands import ListRolesCommand
+    from cgcloud.core.commands import (CreateCommand,
                                        RecreateCommand,
                                        StartCommand,
                                        StopCommand,
@@ -1,5 +1,6 @@
 import datetime
 import hashlib
+import shlex
 import socket
 # cluster ssh and rsync commands need thread-safe subprocess
 import subprocess32
@@ -19,7 +20,6 @@ from bd2k.util.collections import OrderedSet
 from bd2k.util.exceptions import panic
 from bd2k.util.expando import Expando
 from bd2k.util.iterables import concat
-from bd2k.util.retry import retry
 from boto import logging
 from boto.ec2.blockdevicemapping import BlockDeviceType, BlockDeviceMapping
 from boto.ec2.instance import Instance
@@ -33,19 +33,26 @@ from paramiko.client import MissingHostKeyPolicy
 
 from cgcloud.core.project import project_artifacts
 from cgcloud.lib import aws_d32
-from cgcloud.lib.context import Context, throttlePredicate
+from cgcloud.lib.context import Context
 from cgcloud.lib.ec2 import (ec2_instance_types,
                              wait_instances_running,
                              inconsistencies_detected,
                              create_spot_instances,
                              create_ondemand_instances,
                              tag_object_persistently)
-from cgcloud.lib.ec2 import retry_ec2, a_short_time, a_long_time, wait_transition
+from cgcloud.lib.ec2 import (retry_ec2,
+                             a_short_time,
+                             a_long_time,
+                             wait_transition,
+                             wait_image_available)
+from cgcloud.lib.inventory import inventory
 from cgcloud.lib.util import (UserError,
                               camel_to_snake,
                               ec2_keypair_fingerprint,
                               private_to_public_key,
                               mean, std_dev)
+from cgcloud.lib.retry import retry, throttled, ssh_retryable
+from cgcloud.lib.trace import tracer
 
 log = logging.getLogger( __name__ )
 
@@ -69,12 +76,15 @@ class fabric_task( object ):
     def __call__( self, function ):
         @wraps( function )
         def wrapper( box, *args, **kwargs ):
+            start = time.time( )
             with self.lock:
                 user = box.admin_account( ) if self.user is None else self.user
                 user_stack = self.user_stack
                 if user_stack and user_stack[ -1 ] == user:
                     return function( box, *args, **kwargs )
                 else:
+                    # Contention on this lock is a common cause of slow cluster boots
+                    tracer.record( 'wait fabric lock', start, task=function.__name__ )
                     user_stack.append( user )
                     try:
                         task = partial( function, box, *args, **kwargs )
@@ -312,12 +322,14 @@ class Box( object ):
                 filters = { 'group-name': name }
                 if vpc_id is not None:
                     filters[ 'vpc-id' ] = vpc_id
-                for attempt in retry_ec2( retry_while=inconsistencies_detected,
-                                          retry_for=10 * 60 ):
-                    with attempt:
-                        sgs = self.ctx.ec2.get_all_security_groups( filters=filters )
-                        assert len( sgs ) == 1
-                        sg = sgs[ 0 ]
+                # The group may not be visible yet, don't let the inventory cache pin that
+                with inventory.bypass( ):
+                    for attempt in retry_ec2( retry_while=inconsistencies_detected,
+                                              retry_for=10 * 60 ):
+                        with attempt:
+                            sgs = self.ctx.ec2.get_all_security_groups( filters=filters )
+                            assert len( sgs ) == 1
+                            sg = sgs[ 0 ]
             else:
                 raise
         # It's OK to have two security groups of the same name as long as their VPC is distinct.
@@ -697,11 +709,15 @@ class Box( object ):
         pending_ids = set( )
         pending_ids_lock = threading.RLock( )
 
-        def adopt( adoptees ):
+        launch_time = time.time( )
+
+        def adopt( adoptees, phase ):
             """
             :type adoptees: Iterator[Instance]
             """
             pending_ids.update( i.id for i in adoptees )
+            for instance in adoptees:
+                tracer.record( phase, launch_time, instance=instance.id )
             for box, instance in izip( adopters, adoptees ):
                 box.adopt( instance, next( cluster_ordinal ) )
                 if not wait_ready:
@@ -723,10 +739,10 @@ class Box( object ):
                                                     timeout=spot_timeout,
                                                     tentative=spot_tentative,
                                                     tags=tags):
-                    adopt( batch )
+                    adopt( batch, 'spot fulfillment' )
             else:
                 adopt( create_ondemand_instances( self.ctx.ec2, self.image_id, spec,
-                                                  num_instances=num_instances ) )
+                                                  num_instances=num_instances ), 'launch' )
             if spot_tentative:
                 if not boxes: return boxes
             else:
@@ -774,7 +790,9 @@ class Box( object ):
             num_running, num_other = 0, 0
             # TODO: timeout
             instances = (box.instance for box in boxes)
+            start = time.time( )
             for instance in wait_instances_running( self.ctx.ec2, instances ):
+                tracer.record( 'wait running', start, instance=instance.id )
                 box = boxes_by_id[ instance.id ]
                 # equivalent to the instance.update() done in _wait_ready()
                 box.instance = instance
@@ -811,7 +829,8 @@ class Box( object ):
         self.cluster_ordinal = cluster_ordinal
         if self.cluster_name is None:
             self.cluster_name = self.instance_id
-        self._on_instance_created( )
+        with tracer.span( 'on instance created', instance=instance.id ):
+            self._on_instance_created( )
 
     def _set_instance_options( self, options ):
         """
@@ -987,6 +1006,21 @@ class Box( object ):
                  for box, instance in izip( concat( self, self.clones( ) ),
                                             self.__list_instances( **tags ) ) ]
 
+    def handles( self, keep_instances=False, **tags ):
+        """
+        Like list() but returns a lightweight handle for each instance instead of a box bound to
+        it. Use this instead of list() when there could be many instances and only some of them
+        need to be operated on, or only one at a time.
+
+        :param bool keep_instances: if True, each handle holds on to the instance from the
+               listing until a box is bound to it, so that BoxHandle.box() doesn't have to look
+               up the instance again. Use this when boxes will be bound to most of the handles.
+
+        :rtype: list[BoxHandle]
+        """
+        return [ BoxHandle( self, instance, ordinal, keep_instance=keep_instances )
+            for ordinal, instance in enumerate( self.__list_instances( **tags ) ) ]
+
     def __list_instances( self, **tags ):
         """
         Lookup and return a list of instance performing this box' role.
@@ -1060,27 +1094,13 @@ class Box( object ):
             instance_id=self.instance_id,
             name=image_name,
             block_device_mapping=self._image_block_device_mapping( ) )
-        while True:
-            try:
-                image = self.ctx.ec2.get_image( image_id )
-                tag_object_persistently( image, self._get_image_options( ) )
-                wait_transition( image, { 'pending' }, 'available' )
-                log.info( "... created %s (%s).", image.id, image.name )
-                break
-            except self.ctx.ec2.ResponseError as e:
-                # FIXME: I don't think get_image can throw this, it should be outside the try
-                if e.error_code != 'InvalidAMIID.NotFound':
-                    raise
-        # There seems to be another race condition in EC2 that causes a freshly created image to
-        # not be included in queries other than by AMI ID.
-        log.info( 'Checking if image %s is discoverable ...' % image_id )
-        while True:
-            if image_id in (_.id for _ in self.list_images( )):
-                log.info( '... image now discoverable.' )
-                break
-            log.info( '... image %s not yet discoverable, trying again in %is ...', image_id,
-                      a_short_time )
-            time.sleep( a_short_time )
+        # There seems to be a race condition in EC2 that causes a freshly created image to not be
+        # included in queries other than by AMI ID. Passing the filter used by list_images()
+        # ensures that the image is discoverable by the time the wait is over.
+        image = wait_image_available( self.ctx.ec2, image_id,
+                                      filters=self._image_name_filters( ) )
+        tag_object_persistently( image, self._get_image_options( ) )
+        log.info( "... created %s (%s).", image.id, image.name )
         return image_id
 
     def stop( self ):
@@ -1174,20 +1194,30 @@ class Box( object ):
          None if the instance isn't booting, False if the instance is booting but not for the
          first time.
         """
-        log.info( "... waiting for instance %s ... ", self.instance.id )
-        wait_transition( self.instance, from_states, 'running' )
-        self._on_instance_running( first_boot )
-        log.info( "... running, waiting for assignment of public IP ... " )
-        self.__wait_public_ip_assigned( self.instance )
-        log.info( "... assigned, waiting for SSH port ... " )
-        self.__wait_ssh_port_open( )
-        log.info( "... open ... " )
-        if first_boot is not None:
-            log.info( "... testing SSH ... " )
-            self.__wait_ssh_working( )
-            log.info( "... SSH working ..., " )
-        log.info( "... instance ready." )
-        self._on_instance_ready( first_boot )
+        instance_id = self.instance.id
+        log.info( "... waiting for instance %s ... ", instance_id )
+        with tracer.span( 'wait ready', instance=instance_id, role=self.role( ) ):
+            # If _batch_wait_ready() already waited for the instance, it also recorded the wait
+            if self.instance.state != 'running':
+                with tracer.span( 'wait running', instance=instance_id ):
+                    wait_transition( self.instance, from_states, 'running' )
+            with tracer.span( 'on instance running', instance=instance_id ):
+                self._on_instance_running( first_boot )
+            log.info( "... running, waiting for assignment of public IP ... " )
+            with tracer.span( 'wait public ip', instance=instance_id ):
+                self.__wait_public_ip_assigned( self.instance )
+            log.info( "... assigned, waiting for SSH port ... " )
+            with tracer.span( 'wait ssh port', instance=instance_id ):
+                self.__wait_ssh_port_open( )
+            log.info( "... open ... " )
+            if first_boot is not None:
+                log.info( "... testing SSH ... " )
+                with tracer.span( 'wait ssh working', instance=instance_id ):
+                    self.__wait_ssh_working( )
+                log.info( "... SSH working ..., " )
+            log.info( "... instance ready." )
+            with tracer.span( 'on instance ready', instance=instance_id ):
+                self._on_instance_ready( first_boot )
 
     def __wait_public_ip_assigned( self, instance ):
         """
@@ -1222,31 +1252,21 @@ class Box( object ):
             pass
 
     def __wait_ssh_working( self ):
-        while True:
-            client = None
-            try:
+        for attempt in retry( cap=a_short_time, timeout=None, predicate=ssh_retryable ):
+            with attempt:
                 client = self._ssh_client( )
-                stdin, stdout, stderr = client.exec_command( 'echo hi' )
                 try:
-                    line = stdout.readline( )
-                    if line == 'hi\n':
-                        return
-                    else:
-                        raise AssertionError( "Read unexpected line '%s'" % line )
+                    stdin, stdout, stderr = client.exec_command( 'echo hi' )
+                    try:
+                        line = stdout.readline( )
+                        if line != 'hi\n':
+                            raise AssertionError( "Read unexpected line '%s'" % line )
+                    finally:
+                        stdin.close( )
+                        stdout.close( )
+                        stderr.close( )
                 finally:
-                    stdin.close( )
-                    stdout.close( )
-                    stderr.close( )
-            except AssertionError:
-                raise
-            except KeyboardInterrupt:
-                raise
-            except Exception as e:
-                logging.info( e )
-            finally:
-                if client is not None:
                     client.close( )
-            time.sleep( a_short_time )
 
     def _ssh_client( self ):
         client = SSHClient( )
@@ -1274,6 +1294,23 @@ class Box( object ):
             ssh_args.append( ssh_opts )
         subprocess32.check_call( [ 'rsync', '-e', ' '.join( ssh_args ) ] + args )
 
+    def relay_rsync( self, args, host, user=None, ssh_opts=None ):
+        """
+        Run rsync on this box against another host, typically another node of the same cluster
+        reached via its private IP address. The arguments are the same as for rsync() except
+        that remote paths refer to the given host. This box authenticates with the other host
+        using the SSH agent forwarded from the local machine, so the other host must accept the
+        same keys as this box.
+        """
+        if user is None: user = self.default_account( )
+        remote_ssh = 'ssh -A -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null'
+        args = [ '%s@%s%s' % (user, host, arg) if arg.startswith( ':' ) else arg for arg in args ]
+        command = ' '.join( quote( arg ) for arg in [ 'rsync', '-e', remote_ssh ] + args )
+        ssh_args = self._ssh_args( user, [ ] )
+        if ssh_opts:
+            ssh_args.extend( shlex.split( ssh_opts ) )
+        subprocess32.check_call( ssh_args + [ command ] )
+
     def _ssh_args( self, user, command ):
         if user is None: user = self.default_account( )
         # Using host name instead of IP allows for more descriptive known_hosts entries and
@@ -1339,12 +1376,18 @@ class Box( object ):
         """
         return [ 'hvm', 'paravirtual' ]
 
+    def _image_name_filters( self ):
+        """
+        Returns the DescribeImages filters matching the images created from boxes of this role
+        """
+        image_name_pattern = self.ctx.to_aws_name( self._image_name_prefix( ) + '_' ) + '*'
+        return { 'name': image_name_pattern }
+
     def list_images( self ):
         """
         :rtype: list of boto.ec2.image.Image
         """
-        image_name_pattern = self.ctx.to_aws_name( self._image_name_prefix( ) + '_' ) + '*'
-        images = self.ctx.ec2.get_all_images( filters={ 'name': image_name_pattern } )
+        images = self.ctx.ec2.get_all_images( filters=self._image_name_filters( ) )
         images.sort( key=attrgetter( 'name' ) )  # that sorts by date, effectively
         return images
 
@@ -1370,7 +1413,7 @@ class Box( object ):
             profile = self.ctx.iam.get_instance_profile( aws_instance_profile_name )
         except BotoServerError as e:
             if e.status == 404:
-                for attempt in retry(predicate=throttlePredicate):
+                for attempt in retry( predicate=throttled ):
                     with attempt:
                         profile = self.ctx.iam.create_instance_profile( aws_instance_profile_name )
                 profile = profile.create_instance_profile_response.create_instance_profile_result
@@ -1396,7 +1439,7 @@ class Box( object ):
             else:
                 self.ctx.iam.remove_role_from_instance_profile( aws_instance_profile_name,
                                                                 profile.roles.member.role_name )
-        for attempt in retry(predicate=throttlePredicate):
+        for attempt in retry( predicate=throttled ):
             with attempt:
                 self.ctx.iam.add_role_to_instance_profile( aws_instance_profile_name, aws_role_name )
         return profile_arn
@@ -1637,3 +1680,78 @@ class Box( object ):
         for artifact in artifacts:
             if artifact.startswith( '/' ):
                 run( 'rm %s' % quote( artifact ) )
+
+
+class BoxHandle( object ):
+    """
+    A reference to an EC2 instance performing a role, holding only what a listing of instances
+    reveals about it: the instance ID, its ordinal among the instances performing the role,
+    its IP addresses and its tags. A handle is much smaller than a Box bound to the instance.
+    Use box() to obtain the latter when an operation needs the role's behaviour.
+    """
+
+    __slots__ = ('prototype', 'instance_id', 'ordinal', 'ip_address', 'private_ip_address',
+                 'tags', 'instance')
+
+    def __init__( self, prototype, instance, ordinal, keep_instance=False ):
+        """
+        :param Box prototype: an unbound box performing the instance's role, typically shared
+               by all handles from the same listing
+
+        :param Instance instance: the instance
+
+        :param int ordinal: the instance's index in the listing
+
+        :param bool keep_instance: if True, hold on to the instance until box() is invoked
+        """
+        super( BoxHandle, self ).__init__( )
+        self.prototype = prototype
+        self.instance_id = instance.id
+        self.ordinal = ordinal
+        self.ip_address = instance.ip_address
+        self.private_ip_address = instance.private_ip_address
+        self.tags = instance.tags
+        self.instance = instance if keep_instance else None
+
+    @property
+    def role_name( self ):
+        return self.prototype.role( )
+
+    @property
+    def cluster_name( self ):
+        return self.tags.get( 'cluster_name' )
+
+    @property
+    def cluster_ordinal( self ):
+        return int( self.tags.get( 'cluster_ordinal' ) or 0 )
+
+    def box( self, wait_ready=False ):
+        """
+        Returns a new box bound to the instance referenced by this handle. Unless this handle
+        kept the instance from the listing, this involves looking up the instance again. A kept
+        instance is used only once and released afterwards.
+
+        >>> from bd2k.util.expando import Expando
+        >>> class FakeBox( object ):
+        ...     def clones( self ):
+        ...         while True: yield FakeBox( )
+        ...     def bind( self, **kwargs ):
+        ...         return sorted( kwargs.items( ) )
+        >>> instance = Expando( id='i-1', ip_address=None, private_ip_address=None, tags={ } )
+        >>> handle = BoxHandle( FakeBox( ), instance, 0, keep_instance=True )
+        >>> handle.box( ) == [ ( 'instance', instance ), ( 'verbose', False ),
+        ...                    ( 'wait_ready', False ) ]
+        True
+        >>> handle.box( )
+        [('instance_id', 'i-1'), ('verbose', False), ('wait_ready', False)]
+
+        :rtype: Box
+        """
+        box = next( self.prototype.clones( ) )
+        if self.instance is not None:
+            instance, self.instance = self.instance, None
+            return box.bind( instance=instance, wait_ready=wait_ready, verbose=False )
+        return box.bind( instance_id=self.instance_id, wait_ready=wait_ready, verbose=False )
+
+    def __repr__( self ):
+        return 'BoxHandle(%r, %r, %r)' % (self.role_name, self.instance_id, self.ordinal)
@@ -1,15 +1,21 @@
 # PYTHON_ARGCOMPLETE_OK
 
 from __future__ import absolute_import
-from collections import OrderedDict
+from collections import OrderedDict, MutableMapping
 from importlib import import_module
+import hashlib
+import json
 import logging
 import os
+import shlex
 import sys
 import imp
 from bd2k.util.iterables import concat
+from tabulate import tabulate
 
-from cgcloud.lib.util import Application, app_name, UserError
+from cgcloud.lib.api_calls import api_call_stats
+from cgcloud.lib.trace import tracer
+from cgcloud.lib.util import Application, app_name, UserError, user_cache_dir, heredoc
 import cgcloud.core
 
 log = logging.getLogger( __name__ )
@@ -39,19 +45,184 @@ def main( args=None ):
     root_logger = CGCloud.setup_logging( )
     try:
         plugins = os.environ.get( 'CGCLOUD_PLUGINS', '' ).strip( )
-        plugins = concat( cgcloud.core,
-                          [ plugin_module( plugin ) for plugin in plugins.split( ":" ) if plugin ] )
+        plugins = list( concat( cgcloud.core,
+                                [ plugin_module( plugin )
+                                    for plugin in plugins.split( ":" ) if plugin ] ) )
         app = CGCloud( plugins, root_logger )
-        for plugin in plugins:
-            if hasattr( plugin, 'command_classes' ):
-                for command_class in plugin.command_classes( ):
-                    app.add( command_class )
         app.run( args )
     except UserError as e:
         log.error( e.message )
         sys.exit( 255 )
 
 
+def plugin_manifest( plugin ):
+    """
+    Returns a dictionary describing the roles, cluster types and commands provided by the given
+    plugin module, each by name, defining module, class name and summary. For commands,
+    the summary is the help text shown in the list of commands. Building
+    the manifest is expensive since it imports everything the plugin provides.
+
+    >>> manifest = plugin_manifest( cgcloud.core )
+    >>> sorted( manifest.keys( ) )
+    ['cluster_types', 'commands', 'roles']
+    >>> command = dict( (c[ 'name' ], c) for c in manifest[ 'commands' ] )[ 'list-roles' ]
+    >>> command[ 'module' ], command[ 'cls' ], command[ 'summary' ].split( '.' )[ 0 ].strip( )
+    ('cgcloud.core.local_commands', 'ListRolesCommand', 'List available roles')
+    >>> manifest[ 'roles' ][ 0 ][ 'name' ], manifest[ 'roles' ][ 0 ][ 'summary' ]
+    ('generic-centos-6-box', 'Generic box with Centos 6.4')
+    """
+
+    def entry( cls, name, summary ):
+        return dict( name=name, module=cls.__module__, cls=cls.__name__, summary=summary )
+
+    # Instantiate the commands in a scratch application in order to get their name and help
+    app = Application( )
+    commands = [ ]
+    for command_class in getattr( plugin, 'command_classes', list )( ):
+        command = command_class( app )
+        # noinspection PyProtectedMember
+        summary = app.subparsers._choices_actions[ -1 ].help
+        commands.append( entry( command_class, command.name( ), summary ) )
+    return dict(
+        roles=[ entry( role, role.role( ), doc_summary( role ) )
+            for role in getattr( plugin, 'roles', list )( ) ],
+        cluster_types=[ entry( cluster_type, cluster_type.name( ), doc_summary( cluster_type ) )
+            for cluster_type in getattr( plugin, 'cluster_types', list )( ) ],
+        commands=commands )
+
+
+def doc_summary( cls ):
+    return (cls.__doc__ or '').strip( ).split( '\n' )[ 0 ].strip( )
+
+
+def plugin_fingerprint( plugin ):
+    """
+    Returns a string that changes whenever a source file in the given plugin's package changes.
+    """
+    h = hashlib.md5( plugin.__name__ )
+    for dir_path, dir_names, file_names in os.walk( os.path.dirname( plugin.__file__ ) ):
+        dir_names.sort( )
+        for file_name in sorted( file_names ):
+            if file_name.endswith( '.py' ):
+                path = os.path.join( dir_path, file_name )
+                h.update( '%s:%r\n' % (path, os.lstat( path ).st_mtime) )
+    return h.hexdigest( )
+
+
+manifest_cache_version = 1
+
+
+def plugin_manifests( plugins ):
+    """
+    Returns the manifests of the given plugin modules, as built by plugin_manifest(). Manifests
+    are cached per user and a plugin's cached manifest is only rebuilt when the plugin's source
+    changes. This is what lets the CLI start, and complete command lines, without importing
+    every role and command.
+    """
+    try:
+        cache_path = os.path.join( user_cache_dir( ), 'plugin-manifests.json' )
+    except (OSError, IOError):
+        log.debug( 'Unable to create cache directory', exc_info=True )
+        cache_path = None
+    cache = { }
+    if cache_path is not None:
+        try:
+            with open( cache_path ) as f:
+                cache = json.load( f )
+            if cache.get( 'version' ) != manifest_cache_version:
+                cache = { }
+        except (OSError, IOError, ValueError):
+            pass
+    cached_plugins = cache.get( 'plugins', { } )
+    manifests = [ ]
+    dirty = False
+    for plugin in plugins:
+        fingerprint = plugin_fingerprint( plugin )
+        cached = cached_plugins.get( plugin.__name__ )
+        if cached is None or cached[ 'fingerprint' ] != fingerprint:
+            cached = dict( fingerprint=fingerprint, manifest=plugin_manifest( plugin ) )
+            cached_plugins[ plugin.__name__ ] = cached
+            dirty = True
+        manifests.append( cached[ 'manifest' ] )
+    if dirty and cache_path is not None:
+        tmp_path = '%s.%i' % (cache_path, os.getpid( ))
+        try:
+            with open( tmp_path, 'w' ) as f:
+                json.dump( dict( version=manifest_cache_version, plugins=cached_plugins ), f )
+            os.rename( tmp_path, cache_path )
+        except (OSError, IOError):
+            log.debug( 'Unable to write %s', cache_path, exc_info=True )
+    return manifests
+
+
+class ClassRef( object ):
+    """
+    A reference to a class by module and class name
+    """
+
+    def __init__( self, module, cls, summary ):
+        super( ClassRef, self ).__init__( )
+        self.module = module
+        self.cls = cls
+        self.summary = summary
+
+    def load( self ):
+        return getattr( import_module( self.module ), self.cls )
+
+
+class ClassMap( MutableMapping ):
+    """
+    An ordered mapping from names to classes. Instead of a class, a ClassRef can be added,
+    in which case the module defining the class is only imported when the name is looked up.
+
+    >>> m = ClassMap( )
+    >>> m.add_ref( 'foo', 'collections', 'OrderedDict', 'Dictionary that remembers order' )
+    >>> m[ 'bar' ] = ClassMap
+    >>> list( m ), 'foo' in m, 'baz' in m
+    (['foo', 'bar'], True, False)
+    >>> m.summary( 'foo' ), m.summary( 'bar' )
+    ('Dictionary that remembers order', 'An ordered mapping from names to classes. Instead of a class, a ClassRef can be added,')
+    >>> m[ 'foo' ]
+    <class 'collections.OrderedDict'>
+    """
+
+    def __init__( self ):
+        super( ClassMap, self ).__init__( )
+        self.entries = OrderedDict( )
+
+    def add_ref( self, name, module, cls, summary ):
+        self.entries[ name ] = ClassRef( module, cls, summary )
+
+    def summary( self, name ):
+        """
+        Returns the one-line summary of the class of the given name, without importing it.
+        """
+        entry = self.entries[ name ]
+        return entry.summary if isinstance( entry, ClassRef ) else doc_summary( entry )
+
+    def __getitem__( self, name ):
+        entry = self.entries[ name ]
+        if isinstance( entry, ClassRef ):
+            entry = entry.load( )
+            self.entries[ name ] = entry
+        return entry
+
+    def __setitem__( self, name, cls ):
+        self.entries[ name ] = cls
+
+    def __delitem__( self, name ):
+        del self.entries[ name ]
+
+    def __contains__( self, name ):
+        return name in self.entries
+
+    def __iter__( self ):
+        return iter( self.entries )
+
+    def __len__( self ):
+        return len( self.entries )
+
+
 class LoggingFormatter( logging.Formatter ):
     """
     A formatter that logs the thread name of secondary threads, but not the main thread.
@@ -82,10 +253,113 @@ class CGCloud( Application ):
                      help='Write debug log to %s in current directory.' % self.debug_log_file_name )
         self.option( '--script', '-s', metavar='PATH',
                      help='The path to a Python script with additional role definitions.' )
-        self.roles = OrderedDict( )
-        self.cluster_types = OrderedDict( )
-        for plugin in plugins:
-            self._import_plugin_roles( plugin )
+        self.option( '--trace', metavar='PATH',
+                     help=heredoc( """Trace the phases of the command's execution, e.g. the
+                     phases of booting each node of a cluster, write the trace to a file at the
+                     given path in Chrome trace event format (chrome://tracing) and log a summary
+                     of the time spent in each phase.""" ) )
+        self.option( '--api-stats', metavar='FORMAT', choices=[ 'table', 'json' ],
+                     help=heredoc( """Count and time the requests made to AWS APIs, per service
+                     and action, and print the statistics to stderr when the command finishes,
+                     either as a table or in JSON.""" ) )
+        self.trace_path = None
+        self.api_stats_format = None
+        self.roles = ClassMap( )
+        self.cluster_types = ClassMap( )
+        self.command_refs = OrderedDict( )
+        for manifest in plugin_manifests( plugins ):
+            for role in manifest[ 'roles' ]:
+                self.roles.add_ref( role[ 'name' ], role[ 'module' ], role[ 'cls' ],
+                                    role[ 'summary' ] )
+            for cluster_type in manifest[ 'cluster_types' ]:
+                self.cluster_types.add_ref( cluster_type[ 'name' ], cluster_type[ 'module' ],
+                                            cluster_type[ 'cls' ], cluster_type[ 'summary' ] )
+            for command in manifest[ 'commands' ]:
+                self.command_refs[ command[ 'name' ] ] = ClassRef( command[ 'module' ],
+                                                                   command[ 'cls' ],
+                                                                   command[ 'summary' ] )
+
+    def run( self, args=None ):
+        # Only the selected command needs to be fully set up, all other commands just need to be
+        # listed in the help, which is what a stub parser is good for. This saves importing
+        # the modules of all other commands, and the roles they depend on. If no command is
+        # selected, e.g. for --help or while completing the command name, the stub parsers,
+        # whose names and help come from the cached plugin manifests, are all that is needed.
+        selected = self._selected_command( args )
+        for name, command_ref in self.command_refs.iteritems( ):
+            if name == selected:
+                self.add( command_ref.load( ) )
+            else:
+                self.subparsers.add_parser( name, help=command_ref.summary )
+        try:
+            super( CGCloud, self ).run( args )
+        finally:
+            if self.trace_path is not None:
+                self._write_trace( )
+            if self.api_stats_format is not None:
+                self._write_api_stats( )
+
+    def _write_trace( self ):
+        tracer.write_chrome_trace( self.trace_path )
+        log.info( 'Wrote trace to %s. Time spent per phase in seconds:\n%s', self.trace_path,
+                  tabulate( tracer.summary( ),
+                            headers=[ 'phase', 'count', 'p50', 'p90', 'p99', 'max' ],
+                            floatfmt='.1f' ) )
+
+    def _write_api_stats( self ):
+        if self.api_stats_format == 'json':
+            sys.stderr.write( api_call_stats.to_json( ) + '\n' )
+        else:
+            sys.stderr.write( tabulate( api_call_stats.table( ),
+                                        headers=api_call_stats.table_headers,
+                                        floatfmt='.3f' ) + '\n' )
+
+    def _selected_command( self, args ):
+        """
+        Returns the name of the command selected by the given command line arguments or None
+        if the command can't be determined without parsing them in full.
+
+        >>> app = CGCloud( [ ] )
+        >>> app.command_refs.update( { 'ssh': None, 'list': None } )
+        >>> app._selected_command( [ '--debug', 'ssh', '-h' ] )
+        'ssh'
+        >>> app._selected_command( [ '-s', 'list', 'ssh' ] )
+        'ssh'
+        >>> app._selected_command( [ '--scr=foo.py', 'list', 'ssh' ] )
+        'list'
+        >>> app._selected_command( [ '--trace', 'list', 'ssh' ] )
+        'ssh'
+        >>> app._selected_command( [ '--help' ] ) is None
+        True
+        >>> app._selected_command( [ 'foo' ] ) is None
+        True
+        """
+        if args is None:
+            if '_ARGCOMPLETE' in os.environ:
+                # Under argcomplete, the command line comes from the environment. Ignore the
+                # word being completed, it may be an incomplete command name.
+                line = os.environ.get( 'COMP_LINE', '' )
+                line = line[ :int( os.environ.get( 'COMP_POINT', len( line ) ) ) ]
+                try:
+                    args = shlex.split( line )[ 1: ]
+                except ValueError:
+                    return None
+                if args and not line[ -1: ].isspace( ):
+                    args.pop( )
+            else:
+                args = sys.argv[ 1: ]
+        args = iter( args )
+        for arg in args:
+            if arg.startswith( '-' ):
+                if arg == '-s' or len( arg ) > 2 and any( option.startswith( arg )
+                                                          for option in ('--script', '--trace',
+                                                                         '--api-stats') ):
+                    next( args, None )  # skip the option's value
+                elif arg in ('-h', '--help'):
+                    return None
+            else:
+                return arg if arg in self.command_refs else None
+        return None
 
     def _import_plugin_roles( self, plugin ):
         if hasattr( plugin, 'roles' ):
@@ -107,6 +381,12 @@ class CGCloud( Application ):
                 self.root_logger.addHandler( file_handler )
             else:
                 self.silence_boto_and_paramiko( )
+        if options.trace:
+            self.trace_path = options.trace
+            tracer.enabled = True
+        if options.api_stats:
+            self.api_stats_format = options.api_stats
+            api_call_stats.enabled = True
         if options.script:
             plugin = imp.load_source( os.path.splitext( os.path.basename( options.script ) )[ 0 ],
                                       options.script )
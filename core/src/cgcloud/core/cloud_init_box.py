@@ -1,10 +1,9 @@
 import logging
-import time
+import select
 from StringIO import StringIO
 from abc import abstractmethod
 from functools import partial
 
-import paramiko
 import yaml
 from fabric.operations import put
 from paramiko import Channel
@@ -12,6 +11,7 @@ from paramiko import Channel
 from cgcloud.core.box import Box, fabric_task
 from cgcloud.core.package_manager_box import PackageManagerBox
 from cgcloud.lib.ec2 import ec2_instance_types
+from cgcloud.lib.trace import tracer
 from cgcloud.lib.util import heredoc
 
 log = logging.getLogger( __name__ )
@@ -160,7 +160,8 @@ class CloudInitBox( PackageManagerBox ):
     def _on_instance_ready( self, first_boot ):
         super( CloudInitBox, self )._on_instance_ready( first_boot )
         if first_boot:
-            self.__wait_for_cloud_init_completion( )
+            with tracer.span( 'wait cloud-init', instance=self.instance_id ):
+                self.__wait_for_cloud_init_completion( )
             if self.generation == 0:
                 self.__add_per_boot_script( )
 
@@ -199,14 +200,28 @@ class CloudInitBox( PackageManagerBox ):
         # lock serialising all calls to this method we have to wait for the delay for every node
         # in sequence, in O(N) time. Paramiko, OTOH, is thread-safe allowing us to do the wait
         # in concurrently, in O(1) time.
+        #
+        # The command runs for as long as cloud-init does, streaming the output of cloud-init
+        # as it progresses. If inotify-tools is installed, the command sleeps until the kernel
+        # reports the creation of the .done file, otherwise it polls for it. The timeout of
+        # inotifywait guards against the file being created between the test and inotifywait
+        # setting up its watch.
 
-        command = ';'.join( [
-            'echo -n "Waiting for cloud-init to finish ..."',
-            'while [ ! -e /tmp/cloud-init.done ]',
-            'do echo -n "."',
-            'sleep 1 ',
-            'done ',
-            'echo "... cloud-init done."' ] )
+        command = heredoc( """
+            if [ ! -e /tmp/cloud-init.done ]; then
+                echo "Waiting for cloud-init to finish ..."
+                tail -n 0 -F /var/log/cloud-init-output.log 2>/dev/null &
+                tail_pid=$!
+                while [ ! -e /tmp/cloud-init.done ]; do
+                    if command -v inotifywait >/dev/null; then
+                        inotifywait -qq -t 10 -e create -e moved_to /tmp
+                    else
+                        sleep 1
+                    fi
+                done
+                kill $tail_pid
+            fi
+            echo "... cloud-init done." """ )
 
         self._run( command )
 
@@ -241,7 +256,9 @@ class CloudInitBox( PackageManagerBox ):
                     partial( stream, 'stderr', chan.recv_stderr_ready, chan.recv_stderr, log.warn ),
                     partial( stream, 'stdout', chan.recv_ready, chan.recv, log.info ))
                 while sum( stream( ) for stream in streams ) or not chan.exit_status_ready( ):
-                    time.sleep( paramiko.common.io_sleep )
+                    # Block until there is output or the command exits. The timeout is a
+                    # safeguard, the channel signals both events via its file descriptor.
+                    select.select( [ chan ], [ ], [ ], 1 )
                 assert 0 == chan.recv_exit_status( )
         finally:
             client.close( )
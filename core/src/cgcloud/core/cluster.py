@@ -2,7 +2,9 @@ import logging
 from abc import ABCMeta, abstractproperty
 
 from cgcloud.core.box import Box
-from cgcloud.lib.util import (abreviated_snake_case_class_name, papply, thread_pool)
+from cgcloud.core.common_iam_policies import s3_read_only_policy
+from cgcloud.lib.shared_dir import parse_distribution
+from cgcloud.lib.util import (abreviated_snake_case_class_name, papply, cores, TaskGroup)
 
 log = logging.getLogger( __name__ )
 
@@ -45,7 +47,10 @@ class Cluster( object ):
                wait_ready=True, operation='operation', pool_size=None, callback=None ):
         """
         Apply a callable to the leader and each worker. The callable may be applied to multiple
-        workers concurrently.
+        workers concurrently, at most pool_size at a time. A pool size of 0 applies the callable
+        to one worker after another. Otherwise, the failure on one worker doesn't prevent the
+        callable from being applied to the remaining workers. Each failure is logged as it
+        occurs and all of them are raised together once every worker is done.
         """
         # Look up the leader first, even if leader_first is False or skip_leader is True. That
         # way we fail early if the cluster doesn't exist.
@@ -60,12 +65,33 @@ class Cluster( object ):
                 if callback is not None:
                     callback( result )
 
+        def apply_worker( handle ):
+            # Only bind a box to the worker when it's its turn, so that the number of bound
+            # boxes is limited by the pool size rather than the cluster size.
+            return f( handle.box( wait_ready=wait_ready ) )
+
         def apply_workers( ):
             log.info( '=== Performing %s on workers ===', operation )
-            workers = first_worker.list( leader_instance_id=leader.instance_id,
-                                         wait_ready=wait_ready )
-            # zip() creates the singleton tuples that papply() expects
-            papply( f, seq=zip( workers ), pool_size=pool_size, callback=callback )
+            # Keep the instances from the listing so that binding a box to a worker doesn't
+            # require another request
+            workers = first_worker.handles( keep_instances=True,
+                                            leader_instance_id=leader.instance_id )
+            if pool_size == 0:
+                # zip() creates the singleton tuples that papply() expects
+                papply( apply_worker, seq=zip( workers ), pool_size=0, callback=callback )
+            elif workers:
+                with TaskGroup( cores if pool_size is None else pool_size,
+                                name='cluster-apply', cancel_on_error=False ) as group:
+                    for worker in workers:
+                        group.apply_async( apply_worker, (worker,),
+                                           label='%s %s' % (worker.role_name, worker.instance_id) )
+                    # Report results as workers finish so a slow worker doesn't delay the others
+                    for task in group.as_completed( ):
+                        if task.failed( ):
+                            log.error( 'Failed to perform %s on %s', operation, task,
+                                       exc_info=task.exc_info )
+                        elif callback is not None:
+                            callback( task.value )
 
         if leader_first:
             apply_leader( )
@@ -83,11 +109,23 @@ class ClusterBox( Box ):
     def _set_instance_options( self, options ):
         super( ClusterBox, self )._set_instance_options( options )
         self.ebs_volume_size = int( options.get( 'ebs_volume_size' ) or 0 )
+        self.shared_dir_distribution = options.get( 'shared_dir_distribution' )
 
     def _get_instance_options( self ):
-        return dict( super( ClusterBox, self )._get_instance_options( ),
-                     ebs_volume_size=str( self.ebs_volume_size ),
-                     leader_instance_id=self.instance_id)
+        options = dict( super( ClusterBox, self )._get_instance_options( ),
+                        ebs_volume_size=str( self.ebs_volume_size ),
+                        leader_instance_id=self.instance_id )
+        if self.shared_dir_distribution is not None:
+            options[ 'shared_dir_distribution' ] = self.shared_dir_distribution
+        return options
+
+    def _get_iam_ec2_role( self ):
+        iam_role_name, policies = super( ClusterBox, self )._get_iam_ec2_role( )
+        if parse_distribution( self.shared_dir_distribution )[ 0 ] == 's3':
+            # The workers download the shared directory from S3
+            iam_role_name += '--' + abreviated_snake_case_class_name( ClusterBox ) + '_s3'
+            policies.update( dict( s3_read_only=s3_read_only_policy ) )
+        return iam_role_name, policies
 
     @classmethod
     def _get_node_role( cls ):
@@ -1,6 +1,7 @@
 import logging
 import os
 import sys
+import time
 from abc import abstractmethod
 from functools import partial
 
@@ -11,10 +12,12 @@ from cgcloud.core.commands import (RecreateCommand,
                                    ContextCommand,
                                    SshCommandMixin,
                                    RsyncCommandMixin)
+from cgcloud.lib.shared_dir import parse_distribution, publish, s3_key_prefix
+from cgcloud.lib.trace import tracer
 from cgcloud.lib.util import (abreviated_snake_case_class_name,
                               UserError,
                               heredoc,
-                              thread_pool,
+                              TaskGroup,
                               allocate_cluster_ordinals)
 
 log = logging.getLogger( __name__ )
@@ -89,6 +92,16 @@ class CreateClusterCommand( ClusterTypeCommand, RecreateCommand ):
                      directory, if the path ends in a slash) will be placed in the default user's
                      ~/shared directory on each node.""" ) )
 
+        self.option( '--share-via', metavar='SPEC', default=None,
+                     dest='shared_dir_distribution',
+                     help=heredoc( """How workers should obtain the shared directory when they
+                     boot. With 'rsync', the default, each worker copies it directly from the
+                     leader. With 'relay' or 'relay:K', the workers form a K-ary tree rooted at
+                     the leader and each worker copies from its parent in the tree, K defaulting
+                     to 2. With 's3://BUCKET/PREFIX', the shared directory is uploaded to the
+                     given S3 location and the workers download it from there in parallel.
+                     Use 'relay' or 's3://...' for large clusters.""" ) )
+
         self.option( '--ssh-opts', metavar='OPTS', default=None,
                      help=heredoc( """Additional options to pass to ssh when uploading the files
                      shared via rsync. For more detail refer to cgcloud rsync --help""" ) )
@@ -96,7 +109,8 @@ class CreateClusterCommand( ClusterTypeCommand, RecreateCommand ):
     def preparation_kwargs( self, options, box ):
         return dict( super( CreateClusterCommand, self ).preparation_kwargs( options, box ),
                      cluster_name=options.cluster_name,
-                     ebs_volume_size=options.ebs_volume_size )
+                     ebs_volume_size=options.ebs_volume_size,
+                     shared_dir_distribution=options.shared_dir_distribution )
 
     def creation_kwargs( self, options, box ):
         return dict( super( CreateClusterCommand, self ).creation_kwargs( options, box ),
@@ -127,6 +141,10 @@ class CreateClusterCommand( ClusterTypeCommand, RecreateCommand ):
         if options.share_path is not None:
             if not os.path.exists( options.share_path ):
                 raise UserError( "No such file or directory: '%s'" % options.share_path )
+        try:
+            parse_distribution( options.shared_dir_distribution )
+        except ValueError as e:
+            raise UserError( e.message )
         # --leader-instance-type should default to the value of --instance-type
         if options.instance_type is None:
             options.instance_type = options.worker_instance_type
@@ -147,14 +165,19 @@ class CreateClusterCommand( ClusterTypeCommand, RecreateCommand ):
         if options.leader_on_demand:
             preparation_kwargs = { k: v for k, v in preparation_kwargs.iteritems( )
                 if not k.startswith( 'spot_' ) }
-        spec = leader.prepare( **preparation_kwargs )
-        creation_kwargs = dict( self.creation_kwargs( options, leader ),
-                                num_instances=1,
-                                # We must always wait for the leader since workers depend on it.
-                                wait_ready=True )
-        leader.create( spec, **creation_kwargs )
+        with tracer.span( 'create leader' ):
+            with tracer.span( 'prepare', role=leader.role( ) ):
+                spec = leader.prepare( **preparation_kwargs )
+            creation_kwargs = dict( self.creation_kwargs( options, leader ),
+                                    num_instances=1,
+                                    # We must always wait for the leader since workers depend
+                                    # on it.
+                                    wait_ready=True )
+            with tracer.span( 'create', role=leader.role( ) ):
+                leader.create( spec, **creation_kwargs )
         try:
-            self.run_on_creation( leader, options )
+            with tracer.span( 'on creation', instance=leader.instance_id ):
+                self.run_on_creation( leader, options )
         except:
             if options.terminate is not False:
                 with panic( log ):
@@ -168,12 +191,18 @@ class CreateClusterCommand( ClusterTypeCommand, RecreateCommand ):
             preparation_kwargs = dict( self.preparation_kwargs( options, first_worker ),
                                        leader_instance_id=leader.instance_id,
                                        instance_type=options.worker_instance_type )
-            spec = first_worker.prepare( **preparation_kwargs )
-            with thread_pool( min( options.num_threads, options.num_workers ) ) as pool:
-                workers = first_worker.create( spec,
-                                               cluster_ordinal=leader.cluster_ordinal + 1,
-                                               executor=pool.apply_async,
-                                               **self.creation_kwargs( options, first_worker ) )
+            with tracer.span( 'create workers', num_workers=options.num_workers ):
+                with tracer.span( 'prepare', role=first_worker.role( ) ):
+                    spec = first_worker.prepare( **preparation_kwargs )
+                # A worker failing to boot mustn't keep the others from booting
+                with tracer.span( 'create', role=first_worker.role( ) ):
+                    with TaskGroup( min( options.num_threads, options.num_workers ),
+                                    cancel_on_error=False ) as group:
+                        workers = first_worker.create( spec,
+                                                       cluster_ordinal=leader.cluster_ordinal + 1,
+                                                       executor=group.apply_async,
+                                                       **self.creation_kwargs( options,
+                                                                               first_worker ) )
         else:
             workers = [ ]
         if options.list:
@@ -189,7 +218,24 @@ class CreateClusterCommand( ClusterTypeCommand, RecreateCommand ):
         if local_path is not None:
             log.info( '=== Copying %s%s to ~/shared on leader ===',
                       'the contents of ' if local_path.endswith( '/' ) else '', local_path )
-            leader.rsync( args=[ '-r', local_path, ":shared/" ], ssh_opts=options.ssh_opts )
+            with tracer.span( 'share', path=local_path ):
+                leader.rsync( args=[ '-r', local_path, ":shared/" ], ssh_opts=options.ssh_opts )
+            name, arg = parse_distribution( options.shared_dir_distribution )
+            if name == 's3':
+                self.stage_share( leader, local_path, *arg )
+
+    def stage_share( self, leader, local_path, bucket_name, prefix ):
+        """
+        Upload the shared files to the S3 location from which the workers will download them.
+        """
+        key_prefix = s3_key_prefix( prefix, leader.instance_id )
+        log.info( '=== Staging %s in s3://%s/%s ===', local_path, bucket_name, key_prefix )
+        ctx = leader.ctx
+        with tracer.span( 'stage share', bucket=bucket_name ):
+            num_files = publish( local_path,
+                                 lambda: ctx.s3.get_bucket( bucket_name, validate=False ),
+                                 key_prefix )
+        log.info( 'Staged %i file(s).', num_files )
 
     def ssh_hint( self, options ):
         hint = super( CreateClusterCommand, self ).ssh_hint( options )
@@ -284,11 +330,13 @@ class GrowClusterCommand( ClusterCommand, RecreateCommand ):
         first_worker.unbind( )  # list() bound it
         spec = first_worker.prepare( leader_instance_id=leader.instance_id,
                                      cluster_name=leader.cluster_name,
+                                     shared_dir_distribution=leader.shared_dir_distribution,
                                      **self.preparation_kwargs( options, first_worker ) )
-        with thread_pool( min( options.num_threads, options.num_workers ) ) as pool:
+        with TaskGroup( max( 1, min( options.num_threads, options.num_workers ) ),
+                        cancel_on_error=False ) as group:
             workers = first_worker.create( spec,
                                            cluster_ordinal=cluster_ordinal,
-                                           executor=pool.apply_async,
+                                           executor=group.apply_async,
                                            **self.creation_kwargs( options, first_worker ) )
         if options.list:
             self.list( workers )
@@ -400,11 +448,135 @@ class RsyncClusterCommand( RsyncCommandMixin, ApplyClusterCommand ):
     key, use --ssh-opts="-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no".
     """
 
+    def __init__( self, application ):
+        super( RsyncClusterCommand, self ).__init__( application )
+        self.option( '--fanout', '-F', metavar='K', type=int, default=0,
+                     help=heredoc( """Upload to the leader only and let the nodes relay the
+                     upload to each other over the cluster's private network, each node relaying
+                     to at most K other nodes. This way, the data is sent from the local machine
+                     once and reaches all nodes in a number of rounds that grows with the
+                     logarithm of the cluster size. The nodes authenticate with each other using
+                     the forwarded SSH agent. Only uploads to a remote directory are supported,
+                     i.e. the last argument must be a remote path ending in a slash. Options to
+                     rsync that take a value must be passed as --option=value. If 0, upload to
+                     every node directly.""" ) )
+
     def run_on_cluster( self, options, ctx, cluster ):
-        cluster.apply( partial( self.rsync, options ),
-                       cluster_name=options.cluster_name,
-                       ordinal=options.ordinal,
-                       leader_first=True,
-                       skip_leader=options.skip_leader,
-                       pool_size=options.num_threads,
-                       wait_ready=False )
+        if options.fanout > 0:
+            self.relay( options, ctx, cluster )
+        else:
+            cluster.apply( partial( self.rsync, options ),
+                           cluster_name=options.cluster_name,
+                           ordinal=options.ordinal,
+                           leader_first=True,
+                           skip_leader=options.skip_leader,
+                           pool_size=options.num_threads,
+                           wait_ready=False )
+
+    def relay( self, options, ctx, cluster ):
+        """
+        Upload to the leader and then, in a k-ary tree rooted at the leader, from each node to
+        its children. If a node fails, its children are served by that node's parent instead.
+        """
+        if options.skip_leader:
+            raise UserError( "Can't skip the leader with --fanout, the leader relays the upload "
+                             "to the workers." )
+        relay_args = self.relay_args( options.args )
+        leader = cluster.leader_role( ctx )
+        leader.bind( cluster_name=options.cluster_name, ordinal=options.ordinal, wait_ready=False )
+        # Only the workers that relay the upload to others need a box, so list handles and bind
+        # boxes from the instances they kept when a worker becomes a source.
+        workers = cluster.worker_role( ctx ).handles( keep_instances=True,
+                                                      leader_instance_id=leader.instance_id )
+        nodes = [ leader ] + workers
+        names = [ '%s %s' % (leader.role( ), leader.instance_id) ] + [
+            '%s %s' % (worker.role_name, worker.instance_id) for worker in workers ]
+        fanout = options.fanout
+        start = time.time( )
+        sources = { }
+        num_done = 0
+
+        def transfer( i, source ):
+            """
+            Copy to the i-th node and return the box to relay the upload from that node to its
+            children, if it has any.
+            """
+            node = nodes[ i ]
+            if source is None:
+                self.rsync( options, node )
+            else:
+                source.relay_rsync( relay_args, node.private_ip_address,
+                                    user=self._user( source, options ),
+                                    ssh_opts=options.ssh_opts )
+            if i == 0:
+                return node
+            elif fanout * i + 1 < len( nodes ):
+                return node.box( )
+            else:
+                return None
+
+        with TaskGroup( options.num_threads, cancel_on_error=False ) as group:
+            def submit( i, source ):
+                task = group.apply_async( transfer, (i, source), label=names[ i ] )
+                sources[ task ] = i, source
+
+            submit( 0, None )
+            for task in group.as_completed( ):
+                i, source = sources.pop( task )
+                num_done += 1
+                if task.failed( ):
+                    log.error( 'Failed to rsync to %s', task, exc_info=task.exc_info )
+                else:
+                    log.info( 'Finished rsync to %s %s after %.1fs (%i of %i nodes).',
+                              names[ i ],
+                              'from the local machine' if source is None
+                              else 'via ' + source.instance_id,
+                              time.time( ) - start, num_done, len( nodes ) )
+                    source = task.value
+                for child in range( fanout * i + 1, min( fanout * (i + 1) + 1, len( nodes ) ) ):
+                    submit( child, source )
+
+    @staticmethod
+    def relay_args( args ):
+        """
+        Returns the arguments for rsync'ing the files uploaded with the given rsync arguments
+        from one node to another.
+
+        >>> RsyncClusterCommand.relay_args( [ '-av', '--delete', 'foo', 'bar/baz', ':dst/' ] )
+        ['-av', '--delete', 'dst/foo', 'dst/baz', ':dst/']
+
+        When copying the contents of a directory, the entire destination directory is relayed:
+
+        >>> RsyncClusterCommand.relay_args( [ '-r', 'foo/', ':dst/' ] )
+        ['-r', 'dst/', ':dst/']
+
+        An empty destination refers to the home directory:
+
+        >>> RsyncClusterCommand.relay_args( [ '-r', 'foo', ':' ] )
+        ['-r', 'foo', ':']
+        >>> RsyncClusterCommand.relay_args( [ '-r', 'foo', ':dst' ] )
+        Traceback (most recent call last):
+        ...
+        UserError: With --fanout, the remote destination must be a directory ending in a slash.
+        """
+        if not args or not args[ -1 ].startswith( ':' ):
+            raise UserError( 'With --fanout, the last argument must be the remote destination.' )
+        destination = args[ -1 ][ 1: ]
+        if destination and not destination.endswith( '/' ):
+            raise UserError( 'With --fanout, the remote destination must be a directory ending '
+                             'in a slash.' )
+        i = len( args ) - 1
+        while i > 0 and not args[ i - 1 ].startswith( '-' ):
+            i -= 1
+        rsync_options, sources = args[ :i ], args[ i:-1 ]
+        if not sources or any( source.startswith( ':' ) for source in sources ):
+            raise UserError( 'With --fanout, there must be at least one source and all sources '
+                             'must be local.' )
+        if any( source.endswith( '/' ) for source in sources ):
+            if not destination:
+                raise UserError( "With --fanout, the contents of a directory can't be copied to "
+                                 "the home directory. Please specify a remote directory." )
+            relayed = [ destination ]
+        else:
+            relayed = [ destination + os.path.basename( source ) for source in sources ]
+        return rsync_options + relayed + [ ':' + destination ]
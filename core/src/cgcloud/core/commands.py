@@ -1,12 +1,15 @@
 from __future__ import print_function
 
 import argparse
+import datetime
 import functools
+import json
 import logging
 import os
 import re
 import sys
 from abc import abstractmethod
+from collections import OrderedDict
 from operator import itemgetter
 
 from bd2k.util.exceptions import panic
@@ -19,9 +22,12 @@ from fabric.operations import prompt
 from tabulate import tabulate
 
 from cgcloud.core.box import Box
+# For backwards compatibility
+from cgcloud.core.local_commands import ListRolesCommand
 from cgcloud.lib.context import Context
-from cgcloud.lib.ec2 import ec2_instance_types
-from cgcloud.lib.util import Application, heredoc
+from cgcloud.lib.ec2 import ec2_instance_types, describe_instances
+from cgcloud.lib.trace import tracer
+from cgcloud.lib.util import Application, heredoc, TaskGroup
 from cgcloud.lib.util import UserError, Command
 
 log = logging.getLogger( __name__ )
@@ -219,10 +225,209 @@ class ListCommand( BoxCommand ):
         super( ListCommand, self ).__init__( application )
         self.option( '--cluster-name', '-c', metavar='NAME',
                      help='Only list boxes belonging to a cluster of the given name.' )
+        self.option( '--all-roles', '-A', default=False, action='store_true',
+                     help=heredoc( """List the boxes of all roles instead of just those of the
+                     given role, in which case the role argument must be omitted.""" ) )
+        self.option( '--all-regions', '-R', default=False, action='store_true',
+                     help=heredoc( """List boxes in all EC2 regions instead of just the region
+                     of the availability zone selected with --zone. The regions are queried
+                     concurrently and listed in the order in which their results come in.""" ) )
+        self.option( '--output', '-O', default='tsv', choices=self.formats,
+                     help=heredoc( """The output format. With tsv, a header line is followed
+                     by one tab-separated line per box. With json, the output is an array of
+                     objects, one per box, and with jsonl, each line is such an object. The
+                     JSON objects always include all fields, including the region, the spot
+                     flag and the uptime in seconds. Boxes are written as soon as the
+                     instances of their region have been paged in.""" ) )
+
+    def option( self, option_name, *args, **kwargs ):
+        if option_name == 'role':
+            # The role is optional with --all-roles
+            kwargs = dict( kwargs, nargs='?' )
+        return super( ListCommand, self ).option( option_name, *args, **kwargs )
+
+    def run_in_ctx( self, options, ctx ):
+        if options.all_roles:
+            if options.role is not None:
+                raise UserError( "Can't specify a role together with --all-roles" )
+        elif options.role is None:
+            raise UserError( 'Must specify a role unless --all-roles is used' )
+        elif not options.all_regions:
+            return super( ListCommand, self ).run_in_ctx( options, ctx )
+        elif options.role not in self.application.roles:
+            raise UserError( "No such role: '%s'" % options.role )
+        roles = self.application.roles.keys( ) if options.all_roles else [ options.role ]
+        regions = self.regions( ctx ) if options.all_regions else [ ctx.region ]
+        records = self.records( ctx, roles, regions, options.cluster_name )
+        self.write( records, self.fleet_columns, options.output )
 
     def run_on_box( self, options, box ):
-        boxes = box.list( cluster_name=options.cluster_name )
-        self.list( boxes )
+        records = self.records( box.ctx, [ box.role( ) ], [ box.ctx.region ],
+                                options.cluster_name )
+        self.write( records, self.columns, options.output )
+
+    @staticmethod
+    def regions( ctx ):
+        return sorted( region.name for region in ctx.ec2.get_all_regions( ) )
+
+    fleet_states = [ 'pending', 'running', 'shutting-down', 'stopping', 'stopped' ]
+
+    def records( self, ctx, roles, regions, cluster_name=None ):
+        """
+        Find the boxes of the given roles in the given regions using one paged DescribeInstances
+        request per region and a thread per region. Yield one record per box, the records of
+        each region as soon as all of its instances are in. The ordinal of a box is its index
+        among the boxes of the same role in the same region, ordered like Box.list() orders
+        them, so it can be passed to commands like ssh to select the box.
+
+        :rtype: Iterator[OrderedDict]
+        """
+        roles = dict( (ctx.to_aws_name( role ), role) for role in roles )
+        filters = { 'tag:Name': roles.keys( ), 'instance-state-name': self.fleet_states }
+        if cluster_name is not None:
+            filters[ 'tag:cluster_name' ] = cluster_name
+
+        def describe( region ):
+            pages = describe_instances( ctx.regional_ec2( region ), filters=filters )
+            instances = [ instance for page in pages for instance in page ]
+            instances.sort( key=lambda i: (i.launch_time, i.private_ip_address, i.id) )
+            return region, instances
+
+        with TaskGroup( len( regions ) ) as group:
+            for region in regions:
+                group.submit( describe, region )
+            for task in group.as_completed( ):
+                region, instances = task.result( )
+                now = datetime.datetime.utcnow( )
+                ordinals = { }
+                for instance in instances:
+                    role = roles[ instance.tags[ 'Name' ] ]
+                    ordinal = ordinals[ role ] = ordinals.get( role, -1 ) + 1
+                    yield instance_record( region, role, ordinal, instance, now )
+
+    formats = ('tsv', 'json', 'jsonl')
+
+    columns = """
+        cluster_name
+        role_name
+        ordinal
+        cluster_ordinal
+        private_ip_address
+        ip_address
+        instance_id
+        instance_type
+        launch_time
+        state
+        zone""".split( )
+
+    fleet_columns = list( concat( 'region', columns[ :4 ], 'spot', 'uptime', columns[ 4: ] ) )
+
+    @staticmethod
+    def write( records, columns, output, out=None ):
+        """
+        Write the given records to the given stream, flushing after every record so that
+        consumers can process the records as they come in. The given columns are used for the
+        tsv format only.
+
+        >>> records = [ OrderedDict( [ ('a', 1), ('b', datetime.timedelta( minutes=1 ) ) ] ) ]
+        >>> ListCommand.write( records, [ 'b' ], 'tsv', sys.stdout )
+        b
+        0:01:00
+        >>> ListCommand.write( records * 2, None, 'jsonl', sys.stdout )
+        {"a": 1, "b": 60}
+        {"a": 1, "b": 60}
+        >>> ListCommand.write( records * 2, None, 'json', sys.stdout )
+        [
+            {"a": 1, "b": 60},
+            {"a": 1, "b": 60}
+        ]
+        >>> ListCommand.write( [ ], None, 'json', sys.stdout )
+        [
+        ]
+        """
+        if out is None:
+            out = sys.stdout
+        if output == 'tsv':
+            columns = list( columns )
+            out.write( '\t'.join( columns ) + '\n' )
+            for record in records:
+                out.write( '\t'.join( str( record[ column ] ) for column in columns ) + '\n' )
+                out.flush( )
+        else:
+            def dumps( record ):
+                return json.dumps( record, default=json_default )
+
+            if output == 'jsonl':
+                for record in records:
+                    out.write( dumps( record ) + '\n' )
+                    out.flush( )
+            elif output == 'json':
+                out.write( '[\n' )
+                separator = ''
+                for record in records:
+                    out.write( separator + '    ' + dumps( record ) )
+                    out.flush( )
+                    separator = ',\n'
+                out.write( '\n]\n' if separator else ']\n' )
+            else:
+                assert False, output
+
+
+def instance_record( region, role, ordinal, instance, now ):
+    """
+    Returns a dictionary describing the given instance of the given role, as listed by the list
+    command.
+
+    :type instance: Instance
+    :rtype: OrderedDict
+    """
+    tags = instance.tags
+    return OrderedDict( [
+        ('region', region),
+        ('cluster_name', tags.get( 'cluster_name' )),
+        ('role_name', role),
+        ('ordinal', ordinal),
+        ('cluster_ordinal', int( tags.get( 'cluster_ordinal' ) or 0 )),
+        ('spot', bool( instance.spot_instance_request_id )),
+        ('uptime', uptime( instance, now )),
+        ('private_ip_address', instance.private_ip_address),
+        ('ip_address', instance.ip_address),
+        ('instance_id', instance.id),
+        ('instance_type', instance.instance_type),
+        ('launch_time', instance.launch_time),
+        ('state', instance.state),
+        ('zone', instance.placement) ] )
+
+
+def json_default( o ):
+    """
+    Serializes the values in list records that the json module can't handle natively.
+    Durations are represented as a number of seconds.
+    """
+    if isinstance( o, datetime.timedelta ):
+        return int( o.total_seconds( ) )
+    raise TypeError( repr( o ) + ' is not JSON serializable' )
+
+
+def uptime( instance, now ):
+    """
+    Returns the time a running instance has been running for, as a timedelta rounded to whole
+    seconds, or None if the instance isn't running. Note that EC2 resets the launch time when a
+    stopped instance is started again.
+
+    >>> from boto.ec2.instance import Instance
+    >>> i = Instance( )
+    >>> i.launch_time, i._state.name = '2016-05-04T12:00:00.000Z', 'running'
+    >>> str( uptime( i, datetime.datetime( 2016, 5, 5, 13, 30, 15, 500 ) ) )
+    '1 day, 1:30:15'
+    >>> i._state.name = 'stopped'
+    >>> uptime( i, datetime.datetime( 2016, 5, 5 ) ) is None
+    True
+    """
+    if instance.state != 'running':
+        return None
+    launch_time = datetime.datetime.strptime( instance.launch_time, '%Y-%m-%dT%H:%M:%S.%fZ' )
+    return datetime.timedelta( seconds=int( (now - launch_time).total_seconds( ) ) )
 
 
 class UserCommandMixin( Command ):
@@ -568,10 +773,13 @@ class CreationCommand( BoxCommand ):
         """
         :type box: Box
         """
-        spec = box.prepare( **self.preparation_kwargs( options, box ) )
-        box.create( spec, **self.creation_kwargs( options, box ) )
+        with tracer.span( 'prepare', role=box.role( ) ):
+            spec = box.prepare( **self.preparation_kwargs( options, box ) )
+        with tracer.span( 'create', role=box.role( ) ):
+            box.create( spec, **self.creation_kwargs( options, box ) )
         try:
-            self.run_on_creation( box, options )
+            with tracer.span( 'on creation', instance=box.instance_id ):
+                self.run_on_creation( box, options )
         except:
             if options.terminate is not False:
                 with panic( log ):
@@ -643,19 +851,6 @@ class RegisterKeyCommand( ContextCommand ):
             raise UserError( cause=e )
 
 
-class ListRolesCommand( Command ):
-    """
-    List available roles. A role is a template for a box. A box is a virtual machines in EC2,
-    also known as an instance.
-    """
-
-    def run( self, options ):
-        print( tabulate( (name , (role.__doc__ or '').strip().split('\n')[0].strip())
-                         for name, role in self.application.roles.iteritems( ) ) )
-        log.info( "If you are expecting to see more roles listed above, you may need to set/change "
-                  "the CGCLOUD_PLUGINS environment variable." )
-
-
 # noinspection PyAbstractClass
 class ImageReferenceCommand( Command ):
     """
@@ -828,31 +1023,64 @@ class CleanupCommand( ContextCommand ):
     Lists and optionally deletes unused AWS resources after prompting for confirmation.
     """
 
+    def __init__( self, application, **kwargs ):
+        super( CleanupCommand, self ).__init__( application, **kwargs )
+        self.option( '--dry-run', '-D', default=False, action='store_true',
+                     help=heredoc( """Don't prompt and don't delete anything. Instead report the
+                     resources that would be deleted. For snapshots, the permission to delete each
+                     of them is verified, too.""" ) )
+        self.option( '--num-threads', metavar='NUM', type=int, default=8,
+                     help='The maximum number of snapshots to delete concurrently.' )
+
+        def rate( s ):
+            r = float( s )
+            if not r > 0:
+                raise ValueError( 'The rate must be greater than zero.' )
+            return r
+
+        self.option( '--rate', metavar='NUM', type=rate, default=None,
+                     help=heredoc( """The maximum number of snapshot deletion requests to make per
+                     second. The limit for all mutating EC2 requests applies regardless, so only a
+                     lower rate has an effect. By default, only that limit applies. It is 5
+                     requests per second unless overridden by the CGCLOUD_RATE_LIMITS environment
+                     variable.""" ) )
+
     def run_in_ctx( self, options, ctx ):
-        self.cleanup_image_snapshots( ctx )
-        self.cleanup_ssh_pubkeys( ctx )
+        self.cleanup_image_snapshots( ctx, options )
+        self.cleanup_ssh_pubkeys( ctx, options )
 
     @staticmethod
-    def cleanup_ssh_pubkeys( ctx ):
+    def cleanup_ssh_pubkeys( ctx, options ):
         unused_fingerprints = ctx.unused_fingerprints( )
         if unused_fingerprints:
             print( 'The following public keys in S3 are not referenced by any EC2 keypairs:' )
             for fingerprint in unused_fingerprints:
                 print( fingerprint )
-            if 'yes' == prompt( 'Delete these public keys from S3? (yes/no)', default='no' ):
-                ctx.delete_fingerprints( unused_fingerprints )
+            if options.dry_run:
+                num_deleted = ctx.delete_fingerprints( unused_fingerprints, dry_run=True )
+                print( 'Would delete %i public key(s) from S3.' % num_deleted )
+            elif 'yes' == prompt( 'Delete these public keys from S3? (yes/no)', default='no' ):
+                num_deleted = ctx.delete_fingerprints( unused_fingerprints )
+                print( 'Deleted %i of %i public key(s) from S3.' % (num_deleted,
+                                                                    len( unused_fingerprints )) )
         else:
             print( 'No orphaned public keys in S3.' )
 
     @staticmethod
-    def cleanup_image_snapshots( ctx ):
+    def cleanup_image_snapshots( ctx, options ):
         unused_snapshots = ctx.unused_snapshots( )
         if unused_snapshots:
             print( 'The following snapshots are not referenced by any images:' )
             for snapshot_id in unused_snapshots:
                 print( snapshot_id )
-            if 'yes' == prompt( 'Delete these snapshots? (yes/no)', default='no' ):
-                ctx.delete_snapshots( unused_snapshots )
+            kwargs = dict( num_threads=options.num_threads, rate=options.rate )
+            if options.dry_run:
+                num_deleted = ctx.delete_snapshots( unused_snapshots, dry_run=True, **kwargs )
+                print( 'Would delete %i of %i snapshot(s).' % (num_deleted,
+                                                               len( unused_snapshots )) )
+            elif 'yes' == prompt( 'Delete these snapshots? (yes/no)', default='no' ):
+                num_deleted = ctx.delete_snapshots( unused_snapshots, **kwargs )
+                print( 'Deleted %i of %i snapshot(s).' % (num_deleted, len( unused_snapshots )) )
         else:
             print( 'No unused EBS volume snapshots in EC2.' )
 
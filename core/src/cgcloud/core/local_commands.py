@@ -0,0 +1,27 @@
+"""
+Commands that don't make requests to AWS. They are kept apart from cgcloud.core.commands,
+which imports boto, Fabric and the roles, so that running them stays cheap.
+"""
+
+from __future__ import print_function
+
+import logging
+
+from tabulate import tabulate
+
+from cgcloud.lib.util import Command
+
+log = logging.getLogger( __name__ )
+
+
+class ListRolesCommand( Command ):
+    """
+    List available roles. A role is a template for a box. A box is a virtual machines in EC2,
+    also known as an instance.
+    """
+
+    def run( self, options ):
+        roles = self.application.roles
+        print( tabulate( (name, roles.summary( name )) for name in roles ) )
+        log.info( "If you are expecting to see more roles listed above, you may need to set/change "
+                  "the CGCLOUD_PLUGINS environment variable." )
@@ -17,6 +17,8 @@ from cgcloud.core.cloud_init_box import CloudInitBox
 from cgcloud.core.package_manager_box import PackageManagerBox
 from cgcloud.core.rc_local_box import RcLocalBox
 from cgcloud.fabric.operations import remote_sudo_popen
+from cgcloud.lib.ec2 import a_short_time
+from cgcloud.lib.retry import retry
 from cgcloud.lib.util import heredoc
 
 BASE_URL = 'http://cloud-images.ubuntu.com'
@@ -24,6 +26,13 @@ BASE_URL = 'http://cloud-images.ubuntu.com'
 log = logging.getLogger( __name__ )
 
 
+class PackageRepoRaceError( RuntimeError ):
+    """
+    Raised when the package index was modified on the mirror while it was being downloaded
+    """
+    pass
+
+
 class UbuntuBox( AgentBox, CloudInitBox, RcLocalBox ):
     """
     A box representing EC2 instances that boot from one of Ubuntu's cloud-image AMIs
@@ -93,17 +102,18 @@ class UbuntuBox( AgentBox, CloudInitBox, RcLocalBox ):
              local_path=StringIO( heredoc( """
                 Acquire::http::Timeout "10";
                 Acquire::ftp::Timeout "10"; """ ) ), )
-        for i in range( 5 ):
-            cmd = self.apt_get + ' update'
-            result = sudo( cmd, warn_only=True )
-            if result.succeeded: return
-            # https://bugs.launchpad.net/ubuntu/+source/apt/+bug/972077
-            # https://lists.debian.org/debian-dak/2012/05/threads.html#00006
-            if 'Hash Sum mismatch' in result:
-                log.warn( "Detected race condition during in '%s'" )
-            else:
-                raise RuntimeError( "Command '%s' failed" % cmd )
-        raise RuntimeError( "Command '%s' repeatedly failed with race condition. Giving up." )
+        cmd = self.apt_get + ' update'
+        for attempt in retry( base=a_short_time, timeout=None, max_attempts=5,
+                              predicate=lambda e: isinstance( e, PackageRepoRaceError ) ):
+            with attempt:
+                result = sudo( cmd, warn_only=True )
+                if result.failed:
+                    # https://bugs.launchpad.net/ubuntu/+source/apt/+bug/972077
+                    # https://lists.debian.org/debian-dak/2012/05/threads.html#00006
+                    if 'Hash Sum mismatch' in result:
+                        raise PackageRepoRaceError( "Detected race condition during '%s'" % cmd )
+                    else:
+                        raise RuntimeError( "Command '%s' failed" % cmd )
 
     @fabric_task
     def _upgrade_installed_packages( self ):
@@ -0,0 +1,192 @@
+"""
+Accounting of the requests made to AWS APIs. When enabled, the boto connections created by a
+cgcloud.lib.context.Context are instrumented such that every request is counted and timed per
+service and API action. Requests that fail due to throttling are counted separately, as are
+requests that repeat a failed request for the same action on the same thread, which is how the
+various retry loops in cgcloud manifest themselves.
+"""
+
+from __future__ import absolute_import
+
+import json
+import threading
+import time
+from functools import wraps
+
+# Error codes and messages AWS uses for rejecting requests due to rate limiting
+throttling_markers = ('RequestLimitExceeded',
+                      'Request limit exceeded',
+                      'Throttling',
+                      'Rate exceeded',
+                      'SlowDown')
+
+
+def is_throttling( status, body ):
+    """
+    >>> is_throttling( 503, '<Code>RequestLimitExceeded</Code>' )
+    True
+    >>> is_throttling( 400, '<Code>Throttling</Code><Message>Rate exceeded</Message>' )
+    True
+    >>> is_throttling( 400, '<Code>InvalidInstanceID.NotFound</Code>' )
+    False
+    """
+    return status in (400, 429, 503) and any( marker in body for marker in throttling_markers )
+
+
+class ActionStats( object ):
+    """
+    The counters for one API action of one service
+    """
+
+    __slots__ = ('calls', 'errors', 'throttles', 'retries', 'total_time', 'max_time')
+
+    def __init__( self ):
+        super( ActionStats, self ).__init__( )
+        self.calls = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class ApiCallStats( object ):
+    """
+    Collects the per-action counters for any number of instrumented connections, from any
+    number of threads.
+
+    >>> stats = ApiCallStats( )
+    >>> stats.record( 'ec2', 'DescribeInstances', 0.5, 200, '' )
+    >>> stats.record( 'ec2', 'RunInstances', 1.0, 503, 'RequestLimitExceeded' )
+    >>> stats.record( 'ec2', 'RunInstances', 2.0, 200, '' )
+    >>> stats.table( )
+    [('ec2', 'RunInstances', 2, 1, 1, 1, 1.5, 2.0), ('ec2', 'DescribeInstances', 1, 0, 0, 0, 0.5, 0.5)]
+    >>> json.loads( stats.to_json( ) )[ 0 ][ 'action' ]
+    u'RunInstances'
+    """
+
+    def __init__( self ):
+        super( ApiCallStats, self ).__init__( )
+        self.enabled = False
+        self.stats = { }
+        self.lock = threading.Lock( )
+        self.local = threading.local( )
+
+    def instrument( self, connection, service ):
+        """
+        If accounting is enabled, instrument the given boto connection to record every request
+        it makes under the given service name. Returns the connection.
+
+        >>> class Connection( object ):
+        ...     def make_request( self, action, params=None, path='/', verb='GET' ):
+        ...         return Response( )
+        >>> class Response( object ):
+        ...     status = 200
+        >>> stats = ApiCallStats( )
+        >>> stats.enabled = True
+        >>> c = stats.instrument( Connection( ), 'sqs' )
+        >>> c.make_request( 'ReceiveMessage' ).status
+        200
+        >>> stats.table( )[ 0 ][ :3 ]
+        ('sqs', 'ReceiveMessage', 1)
+        """
+        if self.enabled:
+            make_request = connection.make_request
+            action_name = s3_action_name if service == 's3' else query_action_name
+
+            @wraps( make_request )
+            def wrapper( *args, **kwargs ):
+                action = action_name( args, kwargs )
+                start = time.time( )
+                try:
+                    response = make_request( *args, **kwargs )
+                except:
+                    self.record( service, action, time.time( ) - start, None, '' )
+                    raise
+                else:
+                    duration = time.time( ) - start
+                    # boto's HTTPResponse caches the body so reading it here doesn't keep the
+                    # caller from reading it, too.
+                    body = response.read( ) if response.status >= 400 else ''
+                    self.record( service, action, duration, response.status, body )
+                    return response
+
+            connection.make_request = wrapper
+        return connection
+
+    def record( self, service, action, duration, status, body ):
+        """
+        Record a request for the given action that took the given number of seconds and
+        yielded a response with the given status and body. A status of None indicates that no
+        response was received.
+        """
+        key = service, action
+        failed = status is None or status >= 400
+        try:
+            failures = self.local.failures
+        except AttributeError:
+            failures = self.local.failures = set( )
+        retry = key in failures
+        if failed:
+            failures.add( key )
+        elif retry:
+            failures.remove( key )
+        with self.lock:
+            try:
+                stats = self.stats[ key ]
+            except KeyError:
+                stats = self.stats[ key ] = ActionStats( )
+            stats.calls += 1
+            stats.total_time += duration
+            stats.max_time = max( stats.max_time, duration )
+            if failed:
+                stats.errors += 1
+                if status is not None and is_throttling( status, body ):
+                    stats.throttles += 1
+            if retry:
+                stats.retries += 1
+
+    def table( self ):
+        """
+        Returns a list of tuples, one per service and action, containing the service,
+        the action, the number of calls, errors, throttles and retries as well as the mean and
+        maximum latency in seconds. The most frequent actions come first.
+        """
+        with self.lock:
+            table = [ (service, action,
+                          stats.calls, stats.errors, stats.throttles, stats.retries,
+                          stats.total_time / stats.calls, stats.max_time)
+                for (service, action), stats in self.stats.iteritems( ) ]
+        table.sort( key=lambda row: (-row[ 2 ], row[ :2 ]) )
+        return table
+
+    table_headers = [ 'service', 'action', 'calls', 'errors', 'throttles', 'retries',
+        'mean', 'max' ]
+
+    def to_json( self ):
+        """
+        Returns the contents of table() as a JSON array of objects.
+        """
+        return json.dumps( [ dict( zip( self.table_headers, row ) ) for row in self.table( ) ],
+                           indent=4 )
+
+
+def query_action_name( args, kwargs ):
+    return args[ 0 ] if args else kwargs[ 'action' ]
+
+
+def s3_action_name( args, kwargs ):
+    """
+    S3 isn't a query API, so derive a name from the HTTP method and the kind of resource.
+
+    >>> s3_action_name( ( 'GET', 'foo', 'bar' ), { } )
+    'GET object'
+    >>> s3_action_name( ( 'HEAD', ), dict( bucket='foo' ) )
+    'HEAD bucket'
+    """
+    args = dict( zip( ('method', 'bucket', 'key'), args ), **kwargs )
+    resource = 'object' if args.get( 'key' ) else 'bucket' if args.get( 'bucket' ) else 'service'
+    return '%s %s' % (args[ 'method' ], resource)
+
+
+api_call_stats = ApiCallStats( )
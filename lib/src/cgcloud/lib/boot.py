@@ -0,0 +1,280 @@
+"""
+A declarative graph of the steps a node performs at boot time. Each step names the steps it
+depends on. Steps whose dependencies are satisfied run concurrently such that, for example,
+attaching an EBS volume doesn't have to wait for the master to be discovered. The time spent
+in each step is recorded for a report that makes boot times measurable.
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+from cgcloud.lib.retry import backoff
+from cgcloud.lib.util import TaskGroup
+
+log = logging.getLogger( __name__ )
+
+
+def wait_until( condition, description, base=0.5, cap=10, timeout=None ):
+    """
+    Wait until the given callable returns a true value and return that value. The callable
+    is polled with exponential backoff.
+
+    :param str description: describes what is being waited for, used in log messages
+
+    :param float timeout: the number of seconds after which to give up or None to wait forever
+
+    >>> i = iter( [ None, 0, 'foo' ] )
+    >>> wait_until( lambda: next( i ), 'foo', base=0.001 )
+    'foo'
+    >>> wait_until( lambda: False, 'Godot', base=0.001, cap=0.001, timeout=0.01 )
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Timed out waiting for Godot
+    """
+    deadline = None if timeout is None else time.time( ) + timeout
+    attempt = 0
+    while True:
+        value = condition( )
+        if value:
+            return value
+        attempt += 1
+        delay = backoff( attempt, base, cap )
+        if deadline is not None and time.time( ) + delay > deadline:
+            raise RuntimeError( 'Timed out waiting for %s' % description )
+        if attempt == 1:
+            log.info( 'Waiting for %s ...', description )
+        time.sleep( delay )
+
+
+# From /usr/include/linux/inotify.h
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def _inotify_init( ):
+    """
+    Returns a new inotify file descriptor or None if inotify isn't available, e.g. because
+    this isn't Linux.
+    """
+    try:
+        libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+        fd = libc.inotify_init( )
+    except (OSError, AttributeError):
+        return None
+    else:
+        return None if fd < 0 else (libc, fd)
+
+
+def wait_for_file( path, description, timeout=None ):
+    """
+    Wait for a file or directory to appear at the given path. If possible, this function
+    sleeps until the kernel notifies it of the creation of entries in the parent directory.
+    Otherwise it falls back to polling via wait_until().
+
+    :param str description: describes what is being waited for, used in log messages
+
+    :param float timeout: the number of seconds after which to give up or None to wait forever
+
+    >>> import tempfile, shutil
+    >>> tmp_dir = tempfile.mkdtemp( )
+    >>> path = os.path.join( tmp_dir, 'done' )
+    >>> timer = threading.Timer( 0.1, lambda: open( path, 'w' ).close( ) )
+    >>> start = time.time( ); timer.start( )
+    >>> wait_for_file( path, 'foo', timeout=5 )
+    >>> 0.1 <= time.time( ) - start < 1
+    True
+    >>> wait_for_file( os.path.join( tmp_dir, 'bar' ), 'bar', timeout=0.1 )
+    Traceback (most recent call last):
+    ...
+    RuntimeError: Timed out waiting for bar
+    >>> shutil.rmtree( tmp_dir )
+    """
+    if os.path.exists( path ):
+        return
+    inotify = _inotify_init( )
+    if inotify is None:
+        wait_until( lambda: os.path.exists( path ), description, timeout=timeout )
+        return
+    libc, fd = inotify
+    try:
+        parent_dir = os.path.dirname( os.path.abspath( path ) )
+        if libc.inotify_add_watch( fd, parent_dir, IN_CREATE | IN_MOVED_TO ) < 0:
+            wait_until( lambda: os.path.exists( path ), description, timeout=timeout )
+            return
+        deadline = None if timeout is None else time.time( ) + timeout
+        log.info( 'Waiting for %s ...', description )
+        # Check again now that the watch is in place, the file may have appeared in between
+        while not os.path.exists( path ):
+            # The timeout guards against missed events, e.g. if the parent directory is replaced
+            wait = 60 if deadline is None else min( 60, deadline - time.time( ) )
+            if wait <= 0:
+                raise RuntimeError( 'Timed out waiting for %s' % description )
+            readable, _, _ = select.select( [ fd ], [ ], [ ], wait )
+            if readable:
+                # Discard the events, we only care whether the path exists now
+                os.read( fd, 4096 )
+    finally:
+        os.close( fd )
+
+
+class BootStep( object ):
+    """
+    A step in a BootGraph.
+    """
+
+    def __init__( self, name, function, after, condition ):
+        super( BootStep, self ).__init__( )
+        self.name = name
+        self.function = function
+        self.after = after
+        self.condition = condition
+        self.state = 'pending'
+        self.start = None
+        self.end = None
+
+    @property
+    def duration( self ):
+        return None if self.end is None else self.end - self.start
+
+
+class BootGraph( object ):
+    """
+    A set of boot steps and the dependencies between them.
+
+    >>> graph = BootGraph( )
+    >>> events = [ ]
+    >>> graph.add( 'a', lambda: events.append( 'a' ) )
+    >>> graph.add( 'b', lambda: events.append( 'b' ), after=[ 'a' ] )
+    >>> graph.add( 'c', lambda: events.append( 'c' ), after=[ 'a' ], condition=lambda: False )
+    >>> graph.add( 'd', lambda: events.append( 'd' ), after=[ 'b', 'c' ] )
+    >>> graph.run( )
+    >>> events
+    ['a', 'b', 'd']
+    >>> [ (step.name, step.state) for step in graph.steps.itervalues( ) ]
+    [('a', 'done'), ('b', 'done'), ('c', 'skipped'), ('d', 'done')]
+
+    A failing step prevents the steps that depend on it from running:
+
+    >>> graph = BootGraph( )
+    >>> graph.add( 'a', lambda: 1 / 0 )
+    >>> graph.add( 'b', lambda: events.append( 'b' ), after=[ 'a' ] )
+    >>> graph.run( )
+    Traceback (most recent call last):
+    ...
+    ZeroDivisionError: integer division or modulo by zero
+    >>> [ (step.name, step.state) for step in graph.steps.itervalues( ) ]
+    [('a', 'failed'), ('b', 'pending')]
+
+    Dependencies must be added before the steps depending on them:
+
+    >>> graph.add( 'c', lambda: None, after=[ 'x' ] )
+    Traceback (most recent call last):
+    ...
+    ValueError: Step 'c' depends on unknown step 'x'
+    """
+
+    def __init__( self, num_threads=8 ):
+        """
+        :param int num_threads: the maximum number of steps to run concurrently
+        """
+        super( BootGraph, self ).__init__( )
+        self.num_threads = num_threads
+        self.steps = OrderedDict( )
+        self.lock = threading.Lock( )
+        self.start = None
+
+    def add( self, name, function, after=(), condition=None ):
+        """
+        Add a step to this graph.
+
+        :param str name: the unique name of the step
+
+        :param function: the callable that performs the step, it will be invoked without
+               arguments
+
+        :param after: the names of the steps that must be completed before this step can start
+
+        :param condition: a callable that is invoked once the step's dependencies are
+               completed. If it returns False, the step is skipped but steps depending on it
+               are still run. If None, the step is unconditional.
+        """
+        if name in self.steps:
+            raise ValueError( "Duplicate step '%s'" % name )
+        for dependency in after:
+            if dependency not in self.steps:
+                raise ValueError( "Step '%s' depends on unknown step '%s'" % (name, dependency) )
+        self.steps[ name ] = BootStep( name, function, list( after ), condition )
+
+    def run( self ):
+        """
+        Run the steps of this graph, each one as soon as its dependencies are completed. Steps
+        are added in topological order so the graph can't have cycles. If a step fails, no
+        further steps are started and the failure is raised once the running steps completed.
+        """
+        self.start = time.time( )
+        with TaskGroup( self.num_threads, name='boot' ) as group:
+            def submit_ready( ):
+                with self.lock:
+                    for step in self.steps.itervalues( ):
+                        if step.state == 'pending' and all(
+                                self.steps[ dependency ].state in ('done', 'skipped')
+                                for dependency in step.after ):
+                            step.state = 'ready'
+                            group.apply_async( self.__run_step, [ step ], label=step.name )
+
+            submit_ready( )
+            for task in group.as_completed( ):
+                if not task.failed( ):
+                    submit_ready( )
+
+    def __run_step( self, step ):
+        step.start = time.time( )
+        try:
+            if step.condition is not None and not step.condition( ):
+                step.state = 'skipped'
+                log.info( "Skipping step '%s'", step.name )
+            else:
+                log.info( "Starting step '%s'", step.name )
+                step.state = 'running'
+                step.function( )
+                step.state = 'done'
+        except:
+            step.state = 'failed'
+            raise
+        finally:
+            step.end = time.time( )
+            log.info( "Step '%s' %s after %.3fs", step.name, step.state, step.duration )
+
+    def report( self ):
+        """
+        Returns a tab-separated table of the steps in this graph, listing for each step its
+        state, the time it started relative to the start of the graph and its duration, both in
+        seconds. Steps that didn't run have empty times.
+
+        >>> graph = BootGraph( )
+        >>> graph.add( 'a', lambda: None )
+        >>> graph.add( 'b', lambda: time.sleep( 0.1 ), after=[ 'a' ] )
+        >>> graph.run( )
+        >>> lines = graph.report( ).splitlines( )
+        >>> lines[ 0 ]
+        'step\\tstate\\tstart\\tduration'
+        >>> line = lines[ 2 ].split( '\\t' )
+        >>> line[ :2 ], 0.1 <= float( line[ 3 ] ) < 0.2
+        (['b', 'done'], True)
+        """
+        lines = [ 'step\tstate\tstart\tduration' ]
+        for step in self.steps.itervalues( ):
+            if step.start is None:
+                times = [ '', '' ]
+            else:
+                times = [ '%.3f' % (step.start - self.start), '%.3f' % step.duration ]
+            lines.append( '\t'.join( [ step.name, step.state ] + times ) )
+        return '\n'.join( lines ) + '\n'
@@ -1,6 +1,5 @@
 # coding=utf-8
 import hashlib
-from contextlib import contextmanager
 import json
 import os
 import urllib
@@ -8,8 +7,10 @@ import re
 import socket
 import itertools
 import logging
+import threading
+import time
+from functools import partial
 
-from bd2k.util.retry import retry
 from boto import ec2, iam, sns, sqs, vpc
 from boto.s3.key import Key as S3Key
 from boto.exception import S3ResponseError, BotoServerError
@@ -19,12 +20,22 @@ from boto.sns.connection import SNSConnection
 from boto.vpc import VPCConnection
 from boto.iam.connection import IAMConnection
 from boto.ec2.keypair import KeyPair
-from bd2k.util import fnmatch
+from boto.ec2.snapshot import Snapshot
+from boto.provider import Provider
 from bd2k.util import memoize
 from boto.utils import get_instance_metadata
 
+from cgcloud.lib.api_calls import api_call_stats
+from cgcloud.lib.inventory import inventory
 from cgcloud.lib.message import Message
-from cgcloud.lib.util import ec2_keypair_fingerprint, UserError
+from cgcloud.lib.rate_limit import rate_limiter, TokenBucket
+from cgcloud.lib.retry import retry, throttled
+from cgcloud.lib.util import (ec2_keypair_fingerprint,
+                              GlobMatcher,
+                              UserError,
+                              partition_seq,
+                              pmap,
+                              run_task_graph)
 
 log = logging.getLogger( __name__ )
 
@@ -123,11 +134,16 @@ class Context( object ):
         """
         super( Context, self ).__init__( )
 
-        self.__iam = None
-        self.__vpc = None
-        self.__s3 = None
-        self.__sns = None
-        self.__sqs = None
+        # Connections are handed out per thread since boto connections aren't thread-safe
+        self.__iam = ConnectionPool( partial( self.__aws_connect, iam, 'iam', 'universal' ) )
+        self.__vpc = ConnectionPool( partial( self.__aws_connect, vpc, 'ec2' ) )
+        self.__s3 = ConnectionPool( self.__s3_connect )
+        self.__sns = ConnectionPool( partial( self.__aws_connect, sns, 'sns' ) )
+        self.__sqs = ConnectionPool( partial( self.__aws_connect, sqs, 'sqs' ) )
+        self.__regional_ec2 = { }
+        self.__regional_ec2_lock = threading.Lock( )
+        self.__credentials = None
+        self.__credentials_lock = threading.Lock( )
 
         self.availability_zone = availability_zone
         m = self.availability_zone_re.match( availability_zone )
@@ -155,9 +171,7 @@ class Context( object ):
         """
         :rtype: IAMConnection
         """
-        if self.__iam is None:
-            self.__iam = self.__aws_connect( iam, 'universal' )
-        return self.__iam
+        return self.__iam.get( )
 
     # VPCConnection extends EC2Connection so we can use one instance of the former for both 
 
@@ -166,9 +180,7 @@ class Context( object ):
         """
         :rtype: VPCConnection
         """
-        if self.__vpc is None:
-            self.__vpc = self.__aws_connect( vpc )
-        return self.__vpc
+        return self.__vpc.get( )
 
     # ec2 = vpc works, too, but confuses the type hinter in PyCharm
 
@@ -179,44 +191,84 @@ class Context( object ):
         """
         return self.vpc
 
+    def regional_ec2( self, region ):
+        """
+        Returns an EC2 connection to the given region for operations that span regions. For
+        this context's own region, this is the same as the ec2 property.
+
+        :rtype: VPCConnection
+        """
+        if region == self.region:
+            return self.ec2
+        with self.__regional_ec2_lock:
+            try:
+                pool = self.__regional_ec2[ region ]
+            except KeyError:
+                pool = ConnectionPool( partial( self.__aws_connect, vpc, 'ec2', region ) )
+                self.__regional_ec2[ region ] = pool
+        return pool.get( )
+
     @property
     def s3( self ):
         """
         :rtype: S3Connection
         """
-        if self.__s3 is None:
-            # We let S3 route buckets to regions for us. If we connected to a specific region,
-            # bucket lookups (HEAD request against bucket URL) would fail with 301 status but
-            # without a Location header.
-            self.__s3 = S3Connection( )
-        return self.__s3
+        return self.__s3.get( )
 
     @property
     def sns( self ):
         """
         :rtype: SNSConnection
         """
-        if self.__sns is None:
-            self.__sns = self.__aws_connect( sns )
-        return self.__sns
+        return self.__sns.get( )
 
     @property
     def sqs( self ):
         """
         :rtype: SQSConnection
         """
-        if self.__sqs is None:
-            self.__sqs = self.__aws_connect( sqs )
-        return self.__sqs
+        return self.__sqs.get( )
 
-    def __aws_connect( self, aws_module, region=None, **kwargs ):
+    def __aws_connect( self, aws_module, service, region=None ):
         if region is None:
             region = self.region
-        conn = aws_module.connect_to_region( region, **kwargs )
+        conn = aws_module.connect_to_region( region, **self.__shared_credentials( ) )
         if conn is None:
             raise RuntimeError( "%s couldn't connect to region %s" % (
                 aws_module.__name__, region) )
-        return conn
+        return self.__instrument( conn, service )
+
+    def __s3_connect( self ):
+        # We let S3 route buckets to regions for us. If we connected to a specific region,
+        # bucket lookups (HEAD request against bucket URL) would fail with 301 status but
+        # without a Location header.
+        return self.__instrument( S3Connection( **self.__shared_credentials( ) ), 's3' )
+
+    def __shared_credentials( self ):
+        """
+        Returns keyword arguments for a boto connection that make it use the same credentials as
+        the first connection made by this context. This saves every new connection from having
+        to locate credentials in the environment, config files or instance metadata. Temporary
+        credentials, the ones with a security token, are not shared because a connection
+        constructed with explicit credentials wouldn't refresh them before they expire.
+        """
+        with self.__credentials_lock:
+            if self.__credentials is None:
+                provider = Provider( 'aws' )
+                if provider.security_token is None and provider.access_key is not None:
+                    self.__credentials = dict( aws_access_key_id=provider.access_key,
+                                               aws_secret_access_key=provider.secret_key )
+                else:
+                    self.__credentials = { }
+            return self.__credentials
+
+    @staticmethod
+    def __instrument( conn, service ):
+        # Rate limiting comes first so that the accounting doesn't include the time spent
+        # waiting for the rate limiter. Responses served from the inventory cache are neither
+        # limited nor accounted for.
+        conn = rate_limiter.instrument( api_call_stats.instrument( conn, service ), service )
+        return inventory.instrument( conn, service )
 
     def __enter__( self ):
         return self
@@ -225,11 +277,13 @@ class Context( object ):
         self.close( )
 
     def close( self ):
-        if self.__vpc is not None: self.__vpc.close( )
-        if self.__s3 is not None: self.__s3.close( )
-        if self.__iam is not None: self.__iam.close( )
-        if self.__sns is not None: self.__sns.close( )
-        if self.__sqs is not None: self.__sqs.close( )
+        for pool in self.__regional_ec2.itervalues( ):
+            pool.close( )
+        self.__vpc.close( )
+        self.__s3.close( )
+        self.__iam.close( )
+        self.__sns.close( )
+        self.__sqs.close( )
 
     @staticmethod
     def is_absolute_name( name ):
@@ -550,20 +604,21 @@ class Context( object ):
             else:
                 return (glob,)
 
-        globs = itertools.chain.from_iterable( map( iam_lookup, globs ) )
-
-        result = [ ]
-        keypairs = dict( (keypair.name, keypair) for keypair in self.ec2.get_all_key_pairs( ) )
-        for glob in globs:
-            i = len( result )
-            for name, keypair in keypairs.iteritems( ):
-                if fnmatch.fnmatch( name, glob ):
-                    result.append( keypair )
-
-            # since we can't modify the set during iteration
-            for keypair in result[ i: ]:
-                keypairs.pop( keypair.name )
-        return result
+        matcher = GlobMatcher( itertools.chain.from_iterable( map( iam_lookup, globs ) ) )
+        if not matcher.globs:
+            return [ ]
+        if matcher.has_wildcards:
+            keypairs = self.ec2.get_all_key_pairs( )
+        else:
+            # Let EC2 do the lookup, the response will only include the named key pairs
+            keypairs = self.ec2.get_all_key_pairs( filters={ 'key-name': matcher.literals.keys( ) } )
+        matches = [ [ ] for _ in matcher.globs ]
+        for keypair in keypairs:
+            i = matcher.match( keypair.name )
+            if i is not None:
+                log.debug( "Key pair '%s' matches glob '%s'.", keypair.name, matcher.globs[ i ] )
+                matches[ i ].append( keypair )
+        return list( itertools.chain.from_iterable( matches ) )
 
     def download_ssh_pubkey( self, ec2_keypair ):
         try:
@@ -705,7 +760,7 @@ class Context( object ):
                 else:
                     raise
             if current_policy != policy:
-                for attempt in retry(predicate=throttlePredicate):
+                for attempt in retry( predicate=throttled ):
                     with attempt:
                         put_policy( entity_name, policy_name, json.dumps( policy ) )
 
@@ -735,7 +790,7 @@ class Context( object ):
     def __publish_key_update_agent_message( self ):
         self.publish_agent_message( Message( type=Message.TYPE_UPDATE_SSH_KEYS ) )
 
-    def reset_namespace_security( self ):
+    def reset_namespace_security( self, num_threads=8 ):
         """
         Delete all
 
@@ -745,10 +800,17 @@ class Context( object ):
         - EC2 security groups
 
         associated with this context, or rather the namespace this context represents.
+
+        The deletions are run as a graph of tasks, concurrently, using at most the given number
+        of threads. Deletions that depend on each other are ordered accordingly, e.g. a role is
+        only deleted after it has been removed from every instance profile and after all of its
+        policies have been deleted.
         """
-        self.delete_instance_profiles( self.local_instance_profiles( ) )
-        self.delete_roles( self.local_roles( ) )
-        self.delete_security_groups( self.local_security_groups( ) )
+        profiles, roles, security_groups = pmap( lambda f: f( ),
+                                                 [ self.local_instance_profiles,
+                                                   self.local_roles,
+                                                   self.local_security_groups ] )
+        self.__reset_security( profiles, roles, security_groups, num_threads )
 
     def local_instance_profiles( self ):
         return [ p for p in self._get_all_instance_profiles( )
@@ -768,18 +830,8 @@ class Context( object ):
             else:
                 break
 
-    def delete_instance_profiles( self, instance_profiles ):
-        log.debug( 'Deleting profiles %r', instance_profiles )
-        for p in instance_profiles:
-            profile_name = p.instance_profile_name
-            with out_exception( 'instance profile', profile_name ):
-                # currently EC2 allows only one role per profile
-                if p.roles:
-                    role_name = p.roles.member.role_name
-                    log.debug( 'Removing role %s from profile %s', role_name, profile_name )
-                    self.iam.remove_role_from_instance_profile( profile_name, role_name )
-                log.debug( 'Deleting profile %s', profile_name )
-                self.iam.delete_instance_profile( profile_name )
+    def delete_instance_profiles( self, instance_profiles, num_threads=8 ):
+        self.__reset_security( instance_profiles, [ ], [ ], num_threads )
 
     def local_roles( self ):
         return [ r for r in self._get_all_roles( ) if self.try_contains_aws_name( r.role_name ) ]
@@ -787,23 +839,102 @@ class Context( object ):
     def _get_all_roles( self ):
         return self._pager( self.iam.list_roles, 'roles' )
 
-    def delete_roles( self, roles ):
-        log.debug( 'Deleting roles %r', roles )
-        for r in roles:
-            with out_exception( 'role', r.role_name ):
-                for policy_name in self.iam.list_role_policies( r.role_name ).policy_names:
-                    self.iam.delete_role_policy( r.role_name, policy_name )
-                self.iam.delete_role( r.role_name )
+    def delete_roles( self, roles, num_threads=8 ):
+        self.__reset_security( [ ], roles, [ ], num_threads )
 
     def local_security_groups( self ):
         return [ sg for sg in self.ec2.get_all_security_groups( )
                  if self.try_contains_aws_name( sg.name ) ]
 
-    def delete_security_groups( self, security_groups ):
-        log.debug( 'Deleting security groups %r', security_groups )
+    def delete_security_groups( self, security_groups, num_threads=8 ):
+        self.__reset_security( [ ], [ ], security_groups, num_threads )
+
+    def __reset_security( self, instance_profiles, roles, security_groups, num_threads ):
+        log.debug( 'Deleting profiles %r, roles %r and security groups %r',
+                   instance_profiles, roles, security_groups )
+        tasks = { }
+
+        def task( key, f, *args, **kwargs ):
+            """
+            Add a task with the given key that invokes f with the given arguments, retrying on
+            throttling. Dependencies are passed via the 'deps' keyword argument.
+            """
+            deps = kwargs.pop( 'deps', ( ) )
+
+            def run( ):
+                for attempt in retry( predicate=throttled ):
+                    with attempt:
+                        f( *args, **kwargs )
+
+            tasks[ key ] = (run, deps)
+
+        def call( service, action, *args, **kwargs ):
+            # Look up the connection on the thread running the task, connections must not be
+            # shared between threads
+            return getattr( getattr( self, service ), action )( *args, **kwargs )
+
+        # Each profile may hold a role, which needs to be removed from it before either of the
+        # two can be deleted. Currently EC2 allows only one role per profile.
+        profiles_by_role = { }
+        for p in instance_profiles:
+            profile_name = p.instance_profile_name
+            deps = [ ]
+            if p.roles:
+                role_name = p.roles.member.role_name
+                key = ('remove role from profile', role_name, profile_name)
+                task( key, call, 'iam', 'remove_role_from_instance_profile',
+                      profile_name, role_name )
+                profiles_by_role.setdefault( role_name, [ ] ).append( key )
+                deps.append( key )
+            task( ('delete profile', profile_name), call, 'iam', 'delete_instance_profile',
+                  profile_name, deps=deps )
+
+        # A role can only be deleted once its policies are gone. The policies of all roles are
+        # listed and deleted concurrently.
+        role_names = [ r.role_name for r in roles ]
+        policy_names = pmap( self.__role_policy_names, role_names, pool_size=num_threads )
+        for role_name, policy_names in zip( role_names, policy_names ):
+            deps = list( profiles_by_role.get( role_name, [ ] ) )
+            for policy_name in policy_names:
+                key = ('delete role policy', role_name, policy_name)
+                task( key, call, 'iam', 'delete_role_policy', role_name, policy_name )
+                deps.append( key )
+            task( ('delete role', role_name), call, 'iam', 'delete_role', role_name, deps=deps )
+
+        # A security group can't be deleted while rules in another group refer to it. Rules
+        # referring to other groups that are about to be deleted are revoked first. Groups that
+        # aren't referenced by any other group are deleted right away.
+        groups_by_id = dict( (sg.id, sg) for sg in security_groups )
+        revocations_by_group_id = { }
         for sg in security_groups:
-            with out_exception( 'security group', sg.name ):
-                sg.delete( )
+            key = ('revoke rules', sg.id)
+            rules = [ (rule, grant.group_id)
+                      for rule in sg.rules
+                      for grant in rule.grants
+                      if grant.group_id in groups_by_id and grant.group_id != sg.id ]
+            if rules:
+                task( key, self.__revoke_group_rules, sg.id, rules )
+                for _, group_id in rules:
+                    revocations_by_group_id.setdefault( group_id, set( ) ).add( key )
+        for sg in security_groups:
+            task( ('delete security group', sg.name), call, 'ec2', 'delete_security_group',
+                  group_id=sg.id, deps=revocations_by_group_id.get( sg.id, ( ) ) )
+
+        for key in run_task_graph( tasks, pool_size=num_threads ):
+            log.warn( "Failed to %s %s", key[ 0 ], ' '.join( key[ 1: ] ) )
+
+    def __role_policy_names( self, role_name ):
+        for attempt in retry( predicate=throttled ):
+            with attempt:
+                return self.iam.list_role_policies( role_name ).policy_names
+
+    def __revoke_group_rules( self, sg_id, rules ):
+        for rule, group_id in rules:
+            self.ec2.revoke_security_group( group_id=sg_id,
+                                            ip_protocol=rule.ip_protocol,
+                                            from_port=rule.from_port,
+                                            to_port=rule.to_port,
+                                            src_security_group_group_id=group_id )
 
     def unused_fingerprints( self ):
         """
@@ -812,23 +943,36 @@ class Context( object ):
 
         :rtype: set[str]
         """
-        keypairs = self.expand_keypair_globs( '*' )
-        ec2_fingerprints = set( keypair.fingerprint for keypair in keypairs )
+        ec2_fingerprints = set( keypair.fingerprint for keypair in self.ec2.get_all_key_pairs( ) )
         bucket = self.s3.get_bucket( self.s3_bucket_name, validate=False )
         prefix = self.ssh_pubkey_s3_key_prefix
-        s3_fingerprints = set( key.name[ len( prefix ): ] for key in bucket.list( prefix=prefix ) )
-        unused_fingerprints = s3_fingerprints - ec2_fingerprints
-        return unused_fingerprints
+        # Bucket.list() pages through the keys lazily so only the fingerprints are kept around
+        return set( fingerprint
+                    for fingerprint in (key.name[ len( prefix ): ]
+                                        for key in bucket.list( prefix=prefix ))
+                    if fingerprint not in ec2_fingerprints )
 
-    def delete_fingerprints( self, fingerprints ):
+    def delete_fingerprints( self, fingerprints, dry_run=False ):
         """
         Delete the given fingerprints.
 
         :type fingerprints: Iterable(str)
+
+        :param bool dry_run: only log the keys that would be deleted
+
+        :return: the number of deleted (or, with dry_run, deletable) fingerprints
         """
         bucket = self.s3.get_bucket( self.s3_bucket_name, validate=False )
         key_names = [ self.ssh_pubkey_s3_key_prefix + fingerprint for fingerprint in fingerprints ]
-        bucket.delete_keys( key_names )
+        if dry_run:
+            for key_name in key_names:
+                log.info( 'Would delete S3 key %s', key_name )
+            return len( key_names )
+        # DeleteObjects accepts at most 1000 keys per request, delete_keys() batches accordingly.
+        result = bucket.delete_keys( key_names )
+        for error in result.errors:
+            log.warn( "Failed to delete S3 key %s: %s", error.key, error.message )
+        return len( result.deleted )
 
     def unused_snapshots( self ):
         """
@@ -836,42 +980,148 @@ class Context( object ):
         has since been unregistered. This method works globally and does not consider the
         namespace represented by this context.
 
+        Snapshots are paged in and filtered against the set of snapshots referenced by images as
+        they arrive, such that only the IDs of unused snapshots are retained.
+
         :rtype: set[str]
         """
-        all_snapshots = self.ec2.get_all_snapshots(
-            owner='self',
-            filters=dict( description='Created by CreateImage*' ) )
-        all_snapshots = set( snapshot.id for snapshot in all_snapshots )
         used_snapshots = set( bdt.snapshot_id
                               for image in self.ec2.get_all_images( owners=[ 'self' ] )
                               for bdt in image.block_device_mapping.itervalues( )
                               if bdt.snapshot_id is not None )
-        return all_snapshots - used_snapshots
+        params = { }
+        self.ec2.build_list_params( params, [ 'self' ], 'Owner' )
+        self.ec2.build_filter_params( params, { 'description': 'Created by CreateImage*' } )
+        return set( snapshot.id
+                    for snapshot in self._ec2_pager( 'DescribeSnapshots', [ ('item', Snapshot) ],
+                                                     params )
+                    if snapshot.id not in used_snapshots )
+
+    def _ec2_pager( self, action, markers, params, page_size=1000 ):
+        """
+        Like _pager() but for EC2 Describe* requests that support MaxResults and NextToken.
+        """
+        params = dict( params, MaxResults=page_size )
+        while True:
+            for attempt in retry( predicate=throttled ):
+                with attempt:
+                    result = self.ec2.get_list( action, params, markers, verb='POST' )
+            for item in result:
+                yield item
+            if result.next_token:
+                params[ 'NextToken' ] = result.next_token
+            else:
+                break
 
-    def delete_snapshots( self, unused_snapshots ):
+    def delete_snapshots( self, unused_snapshots, dry_run=False, num_threads=8, rate=None ):
         """
-        Delete the snapshots with the given IDs.
+        Delete the snapshots with the given IDs. Deletions are issued concurrently, using at most
+        the given number of threads and no more than the given number of requests per second.
+        The rate limit for mutating EC2 requests applies in addition to the given rate. If the
+        given rate is None, only that limit applies.
 
         :type unused_snapshots: collections.Iterable[str]
+
+        :param bool dry_run: issue the requests with the DryRun flag set, verifying the
+        permission to delete each snapshot without actually deleting it
+
+        :return: the number of deleted (or, with dry_run, deletable) snapshots
         """
-        for snapshot_id in unused_snapshots:
-            log.info( 'Deleting snapshot %s', snapshot_id )
-            self.ec2.delete_snapshot( snapshot_id )
-
-
-def throttlePredicate(e):
-    if not isinstance(e, BotoServerError):
-        return False
-    # boto/AWS gives multiple messages for the same error...
-    if e.status == 503 and 'Request limit exceeded' in e.body:
-        return True
-    elif e.status == 400 and 'Rate exceeded' in e.body:
-        return True
-    return False
-
-@contextmanager
-def out_exception( object_type, object_name ):
-    try:
-        yield
-    except:
-        log.warn( "Failed to remove %s '%s'", object_type, object_name, exc_info=True )
+        bucket = None if rate is None else TokenBucket( rate, capacity=1 )
+
+        def delete( snapshot_id ):
+            if bucket is not None:
+                bucket.acquire( )
+            try:
+                for attempt in retry( predicate=throttled ):
+                    with attempt:
+                        self.ec2.delete_snapshot( snapshot_id, dry_run=dry_run )
+            except BotoServerError as e:
+                if dry_run and e.error_code == 'DryRunOperation':
+                    log.info( 'Would delete snapshot %s', snapshot_id )
+                    return True
+                log.warn( 'Failed to delete snapshot %s: %s', snapshot_id, e.error_message )
+                return False
+            else:
+                log.info( 'Deleted snapshot %s', snapshot_id )
+                return True
+
+        num_deleted = 0
+        for batch in partition_seq( list( unused_snapshots ), 100 * num_threads ):
+            num_deleted += sum( pmap( delete, batch, pool_size=num_threads ) )
+        return num_deleted
+
+
+class ConnectionPool( object ):
+    """
+    Hands out one boto connection per thread, creating connections on demand via the given
+    factory. Connections of threads that have ended are kept for reuse by other threads,
+    along with their keep-alive HTTP connections, up to the given maximum number of idle
+    connections. This bounds the number of connections to the number of live threads using
+    them plus that maximum.
+
+    >>> class FauxConnection( object ):
+    ...     num_closed = 0
+    ...     def close( self ):
+    ...         FauxConnection.num_closed += 1
+    >>> pool = ConnectionPool( FauxConnection, max_idle=1 )
+    >>> c = pool.get( )
+    >>> c is pool.get( )
+    True
+    >>> connections = [ ]
+    >>> def use( ):
+    ...     connections.append( pool.get( ) )
+    >>> for i in range( 3 ):
+    ...     thread = threading.Thread( target=use )
+    ...     thread.start( )
+    ...     thread.join( )
+    >>> c in connections, connections[ 0 ] is connections[ 1 ] is connections[ 2 ]
+    (False, True)
+    >>> pool.close( )
+    >>> FauxConnection.num_closed
+    2
+    """
+
+    def __init__( self, factory, max_idle=8 ):
+        super( ConnectionPool, self ).__init__( )
+        self.factory = factory
+        self.max_idle = max_idle
+        self.lock = threading.Lock( )
+        # Maps a thread's identifier to a tuple of the thread and its connection
+        self.in_use = { }
+        self.idle = [ ]
+
+    def get( self ):
+        thread = threading.current_thread( )
+        try:
+            owner, connection = self.in_use[ thread.ident ]
+            if owner is thread:
+                return connection
+        except KeyError:
+            pass
+        with self.lock:
+            self.__reclaim( )
+            connection = self.idle.pop( ) if self.idle else None
+        if connection is None:
+            connection = self.factory( )
+        with self.lock:
+            self.in_use[ thread.ident ] = thread, connection
+        return connection
+
+    def __reclaim( self ):
+        for ident, (thread, connection) in self.in_use.items( ):
+            if not thread.is_alive( ):
+                del self.in_use[ ident ]
+                if len( self.idle ) < self.max_idle:
+                    self.idle.append( connection )
+                else:
+                    connection.close( )
+
+    def close( self ):
+        with self.lock:
+            connections = [ connection for thread, connection in self.in_use.itervalues( ) ]
+            connections.extend( self.idle )
+            self.in_use.clear( )
+            del self.idle[ : ]
+        for connection in connections:
+            connection.close( )
@@ -5,12 +5,12 @@ from collections import Iterator
 from operator import attrgetter
 
 from bd2k.util.exceptions import panic
-from bd2k.util.retry import retry
 from boto.ec2.ec2object import TaggedEC2Object
 from boto.ec2.instance import Instance
 from boto.ec2.spotinstancerequest import SpotInstanceRequest
 from boto.exception import EC2ResponseError, BotoServerError
 
+from cgcloud.lib.retry import retry, circuit_breaker, ec2_not_found
 from cgcloud.lib.util import UserError
 
 a_short_time = 5
@@ -20,13 +20,15 @@ a_long_time = 60 * 60
 log = logging.getLogger( __name__ )
 
 
-def not_found( e ):
-    return e.error_code.endswith( '.NotFound' )
-
-
-def retry_ec2( retry_after=a_short_time, retry_for=10 * a_short_time, retry_while=not_found ):
-    t = retry_after
-    return retry( delays=(t, t, t * 2, t * 4), timeout=retry_for, predicate=retry_while )
+def retry_ec2( retry_after=a_short_time, retry_for=10 * a_short_time, retry_while=ec2_not_found ):
+    """
+    Retry an EC2 request with exponential backoff and full jitter, starting at retry_after
+    seconds and capped at four times that, for up to retry_for seconds, while the failure
+    matches the retry_while predicate. While EC2 appears to be down, attempts wait for it to
+    recover if that fits within retry_for and fail fast otherwise.
+    """
+    return retry( base=retry_after, cap=4 * retry_after, timeout=retry_for,
+                  predicate=retry_while, breaker=circuit_breaker( 'ec2' ) )
 
 
 class EC2VolumeHelper( object ):
@@ -124,6 +126,76 @@ def wait_transition( resource, from_states, to_state, state_getter=attrgetter( '
         raise UnexpectedResourceState( resource, to_state, state )
 
 
+def wait_image_available( ec2, image_id, filters=None,
+                          min_delay=a_short_time, max_delay=6 * a_short_time, timeout=a_long_time ):
+    """
+    Wait until the image with the given ID is available and return it. Unlike polling a filtered
+    listing of images, every request made by this function is scoped to the given image ID so
+    the response contains at most one image, regardless of the number of images in the account.
+
+    A freshly created image may not be visible at all for a while, causing DescribeImages to
+    fail with InvalidAMIID.NotFound. That error, as well as an empty response, is treated as if
+    the image was still pending. The delay between requests grows exponentially, starting at
+    min_delay, but never exceeds max_delay.
+
+    :param boto.ec2.connection.EC2Connection ec2: the EC2 connection to use for making requests
+
+    :param str image_id: the ID of the image to wait for
+
+    :param dict filters: optional DescribeImages filters the image must match before this
+    function returns. EC2 may take longer to include a new image in filtered queries than in
+    queries by ID only. Passing the filters used to list images makes the image discoverable
+    by such queries by the time this function returns.
+
+    :param float timeout: maximum number of seconds to wait
+
+    :rtype: boto.ec2.image.Image
+
+    >>> from collections import namedtuple
+    >>> FauxImage = namedtuple( 'FauxImage', [ 'id', 'state' ] )
+    >>> class FauxEC2( object ):
+    ...     def __init__( self, *responses ):
+    ...         self.responses = list( responses )
+    ...     def get_all_images( self, image_ids, filters=None ):
+    ...         response = self.responses.pop( 0 )
+    ...         if isinstance( response, Exception ): raise response
+    ...         return response
+    >>> not_found = EC2ResponseError( 400, 'Bad Request' )
+    >>> not_found.error_code = 'InvalidAMIID.NotFound'
+    >>> ec2 = FauxEC2( not_found, [ ], [ FauxImage( 'ami-1', 'pending' ) ],
+    ...                [ FauxImage( 'ami-1', 'available' ) ] )
+    >>> wait_image_available( ec2, 'ami-1', min_delay=0 )
+    FauxImage(id='ami-1', state='available')
+    >>> wait_image_available( FauxEC2( [ FauxImage( 'ami-1', 'failed' ) ] ), 'ami-1' )
+    Traceback (most recent call last):
+    ...
+    UnexpectedResourceState: Expected state of FauxImage(id='ami-1', state='failed') to be 'available' but got 'failed'
+    """
+    deadline = time.time( ) + timeout
+    delay = min_delay
+    while True:
+        try:
+            images = ec2.get_all_images( image_ids=[ image_id ], filters=filters )
+        except EC2ResponseError as e:
+            if e.error_code == 'InvalidAMIID.NotFound':
+                images = [ ]
+            else:
+                raise
+        if images:
+            image = images[ 0 ]
+            if image.state == 'available':
+                return image
+            elif image.state != 'pending':
+                raise UnexpectedResourceState( image, 'available', image.state )
+            log.info( 'Image %s is still pending.', image_id )
+        else:
+            log.info( 'Image %s is not yet visible.', image_id )
+        if time.time( ) + delay > deadline:
+            raise RuntimeError( 'Timed out waiting for image %s to become available.' % image_id )
+        time.sleep( delay )
+        delay = min( 2 * delay, max_delay )
+
+
 def running_on_ec2( ):
     try:
         with open( '/sys/hypervisor/uuid' ) as f:
@@ -135,6 +207,37 @@ def running_on_ec2( ):
             raise
 
 
+def describe_instances( ec2, filters=None, page_size=1000 ):
+    """
+    Yield the instances matching the given filters, one page of at most the given number of
+    instances at a time. Each page is requested only when the previous one has been consumed.
+    Unlike get_all_instances(), boto's get_all_reservations() accepts a pagination token.
+
+    >>> from boto.resultset import ResultSet
+    >>> from bd2k.util.expando import Expando
+    >>> class FakeEC2( object ):
+    ...     def get_all_reservations( self, instance_ids=None, filters=None, dry_run=False,
+    ...                               max_results=None, next_token=None ):
+    ...         page = ResultSet( )
+    ...         page.append( Expando( instances=[ next_token or 'i-1' ] ) )
+    ...         page.next_token = None if next_token else 'i-2'
+    ...         return page
+    >>> list( describe_instances( FakeEC2( ) ) )
+    [['i-1'], ['i-2']]
+
+    :rtype: Iterator[list[Instance]]
+    """
+    next_token = None
+    while True:
+        reservations = ec2.get_all_reservations( filters=filters,
+                                                 max_results=page_size,
+                                                 next_token=next_token )
+        yield [ instance for reservation in reservations for instance in reservation.instances ]
+        next_token = reservations.next_token
+        if not next_token:
+            break
+
+
 from collections import namedtuple
 
 InstanceType = namedtuple( 'InstanceType', [
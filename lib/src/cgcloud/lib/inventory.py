@@ -0,0 +1,250 @@
+"""
+An optional local cache for the responses to AWS API requests that look up facts about the
+world which rarely change, like images, key pairs and security groups. Every cgcloud command
+rediscovers these from scratch, which, in large namespaces, costs seconds per command and eats
+into the account's request quota.
+
+When enabled, the boto connections created by a cgcloud.lib.context.Context serve the
+responses to cacheable requests from an SQLite database in the user's cache directory for a
+limited time. Any other request to a service that mutates state, e.g. creating an image or
+importing a key pair, invalidates all cached responses from that service, in that region and
+for the same credentials. The time-to-live bounds the staleness caused by changes made outside
+of cgcloud or by other users.
+
+The cache is enabled by setting the CGCLOUD_INVENTORY_TTL environment variable to the number of
+seconds for which responses should be served from the cache.
+
+Requests for instances are deliberately not cached. Instances change state, acquire addresses
+and pass health checks without any action on cgcloud's part, and cgcloud polls for exactly
+these changes. For the same reason, requests for images by ID aren't cached either: cgcloud
+polls them right after creating or deregistering an image, waiting for it to change state. Code
+that polls other cacheable requests until a mutation becomes visible must do so in a
+bypass() block.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from cgcloud.lib.api_calls import query_action_name
+from cgcloud.lib.rate_limit import action_class
+from cgcloud.lib.util import user_cache_dir
+
+log = logging.getLogger( __name__ )
+
+# The actions, per service, whose responses may be cached
+cacheable_actions = {
+    'ec2': { 'DescribeImages',
+        'DescribeKeyPairs',
+        'DescribeSecurityGroups',
+        'DescribeRegions',
+        'DescribeAvailabilityZones' } }
+
+# The prefixes of request parameters that exempt an otherwise cacheable request from caching,
+# per service and action, because cgcloud polls requests of that shape
+uncacheable_params = {
+    'ec2': { 'DescribeImages': ('ImageId.',) } }
+
+
+def is_cacheable( service, action, params ):
+    """
+    >>> is_cacheable( 'ec2', 'DescribeImages', { 'Owner.1': 'self' } )
+    True
+    >>> is_cacheable( 'ec2', 'DescribeImages', { 'ImageId.1': 'ami-1' } )
+    False
+    >>> is_cacheable( 'ec2', 'DescribeInstances', { } )
+    False
+    """
+    if action not in cacheable_actions.get( service, () ):
+        return False
+    prefixes = uncacheable_params.get( service, { } ).get( action )
+    return not (prefixes and params and any( name.startswith( prefixes ) for name in params ))
+
+
+class CachedResponse( object ):
+    """
+    Quacks like the HTTP responses boto's query API connections get from make_request().
+    """
+
+    def __init__( self, body ):
+        super( CachedResponse, self ).__init__( )
+        self.status = 200
+        self.reason = 'OK'
+        self.body = body
+
+    def read( self ):
+        return self.body
+
+    # noinspection PyUnusedLocal
+    def getheader( self, name, default=None ):
+        return default
+
+
+class Inventory( object ):
+    """
+    A cache of AWS API responses, shared by all threads and processes of the current user.
+
+    >>> import tempfile, shutil
+    >>> tmp_dir = tempfile.mkdtemp( )
+    >>> inventory = Inventory( os.path.join( tmp_dir, 'inventory.sqlite' ), ttl=60 )
+    >>> inventory.put( 'ec2', 'DescribeImages', '<images/>' )
+    >>> inventory.get( 'ec2', 'DescribeImages' )
+    '<images/>'
+    >>> inventory.invalidate( 'ec2' )
+    >>> inventory.get( 'ec2', 'DescribeImages' ) is None
+    True
+
+    Responses expire after the time-to-live:
+
+    >>> inventory.ttl = 0.01
+    >>> inventory.put( 'ec2', 'DescribeImages', '<images/>' )
+    >>> time.sleep( 0.02 )
+    >>> inventory.get( 'ec2', 'DescribeImages' ) is None
+    True
+
+    An instrumented connection serves repeated listings from the cache but neither requests for
+    images by ID nor requests made in a bypass() block:
+
+    >>> class FakeConnection( object ):
+    ...     aws_access_key_id = 'foo'
+    ...     host = 'ec2.us-west-2.amazonaws.com'
+    ...     requests = 0
+    ...     def make_request( self, action, params=None ):
+    ...         self.requests += 1
+    ...         return CachedResponse( '<images/>' )
+    >>> inventory.ttl = 60
+    >>> connection = inventory.instrument( FakeConnection( ), 'ec2' )
+    >>> for params in [ { 'Owner.1': 'self' } ] * 2 + [ { 'ImageId.1': 'ami-1' } ] * 2:
+    ...     _ = connection.make_request( 'DescribeImages', params )
+    >>> connection.requests
+    3
+    >>> with inventory.bypass( ):
+    ...     _ = connection.make_request( 'DescribeImages', { 'Owner.1': 'self' } )
+    >>> connection.requests
+    4
+    >>> shutil.rmtree( tmp_dir )
+    """
+
+    schema_version = 1
+
+    def __init__( self, path=None, ttl=0 ):
+        """
+        :param str path: the path to the SQLite database, None for the default location in the
+               user's cache directory
+
+        :param float ttl: the number of seconds for which to serve a cached response, 0 to
+               disable this cache
+        """
+        super( Inventory, self ).__init__( )
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local( )
+
+    @property
+    def enabled( self ):
+        return bool( self.ttl )
+
+    @property
+    def bypassed( self ):
+        return getattr( self.local, 'bypassed', False )
+
+    @contextmanager
+    def bypass( self ):
+        """
+        A context manager in which the requests made by the current thread neither use nor
+        update this cache. Use it when polling for the effect of a mutation.
+        """
+        bypassed = self.bypassed
+        self.local.bypassed = True
+        try:
+            yield
+        finally:
+            self.local.bypassed = bypassed
+
+    def __connection( self ):
+        # SQLite connections can't be shared between threads
+        try:
+            return self.local.connection
+        except AttributeError:
+            if self.path is None:
+                self.path = os.path.join( user_cache_dir( ),
+                                          'inventory-v%i.sqlite' % self.schema_version )
+            connection = sqlite3.connect( self.path, timeout=10, isolation_level=None )
+            connection.text_factory = str
+            connection.execute( 'CREATE TABLE IF NOT EXISTS responses ('
+                                'scope TEXT, request TEXT, body BLOB, expires REAL, '
+                                'PRIMARY KEY (scope, request))' )
+            self.local.connection = connection
+            return connection
+
+    def get( self, scope, request ):
+        """
+        Returns the cached body of the response to the given request in the given scope,
+        or None if there is no such response or if it expired.
+        """
+        row = self.__connection( ).execute(
+            'SELECT body FROM responses WHERE scope=? AND request=? AND expires>?',
+            (scope, request, time.time( )) ).fetchone( )
+        return None if row is None else str( row[ 0 ] )
+
+    def put( self, scope, request, body ):
+        self.__connection( ).execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+            (scope, request, buffer( body ), time.time( ) + self.ttl) )
+
+    def invalidate( self, scope ):
+        """
+        Discard all cached responses in the given scope.
+        """
+        self.__connection( ).execute( 'DELETE FROM responses WHERE scope=?', (scope,) )
+
+    def instrument( self, connection, service ):
+        """
+        If this cache is enabled, instrument the given boto connection to serve the responses to
+        cacheable requests from the cache and to invalidate the cache when it makes a request
+        that mutates state. Returns the connection.
+        """
+        if self.enabled and service in cacheable_actions:
+            make_request = connection.make_request
+            # The scope of a response is the service endpoint, i.e. the region, and the account
+            account = hashlib.sha1( connection.aws_access_key_id or '' ).hexdigest( )
+            scope = '%s %s %s' % (service, connection.host, account)
+
+            @wraps( make_request )
+            def wrapper( *args, **kwargs ):
+                action = query_action_name( args, kwargs )
+                params = args[ 1 ] if len( args ) > 1 else kwargs.get( 'params' )
+                if not self.bypassed and is_cacheable( service, action, params ):
+                    request = json.dumps( [ action, params ], sort_keys=True )
+                    body = self.get( scope, request )
+                    if body is not None:
+                        log.debug( 'Serving %s from inventory cache', action )
+                        return CachedResponse( body )
+                    response = make_request( *args, **kwargs )
+                    if response.status == 200:
+                        # boto's HTTPResponse caches the body so reading it here doesn't keep
+                        # the caller from reading it, too.
+                        self.put( scope, request, response.read( ) )
+                    return response
+                elif action_class( action ) == 'mutating':
+                    try:
+                        return make_request( *args, **kwargs )
+                    finally:
+                        # Even a failed request may have changed something
+                        self.invalidate( scope )
+                else:
+                    return make_request( *args, **kwargs )
+
+            connection.make_request = wrapper
+        return connection
+
+
+inventory = Inventory( ttl=float( os.environ.get( 'CGCLOUD_INVENTORY_TTL' ) or 0 ) )
@@ -0,0 +1,565 @@
+"""
+The code shared by the packages that set up the nodes of a cluster at boot time, like
+cgcloud-spark-tools and cgcloud-mesos-tools.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import logging
+import os
+import re
+import socket
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+from grp import getgrnam
+from pwd import getpwnam
+from subprocess import check_call, check_output
+from urllib2 import urlopen
+
+import boto.ec2
+from bd2k.util import memoize, less_strict_bool
+from bd2k.util.files import mkdir_p
+from boto.ec2.instance import Instance
+
+from cgcloud.lib.boot import BootGraph, wait_until, wait_for_file
+from cgcloud.lib.ec2 import EC2VolumeHelper
+from cgcloud.lib.retry import retry
+from cgcloud.lib.shared_dir import Distribution
+from cgcloud.lib.util import volume_label_hash
+
+log = logging.getLogger( __name__ )
+
+
+class NodeTools( object ):
+    """
+    The base class for the tools that set up a node (master or slave) at boot time when it
+    starts up as part of a cluster.
+
+    Master discovery works as follows: All instances in a cluster are tagged with the instance ID
+    of the master. Each instance will look up the private IP of 1) the master instance using the
+    EC2 API (via boto) and 2) itself using the instance metadata endpoint. An entry for the
+    master's host name will be added to /etc/hosts. All configuration files use this name
+    instead of hard-coding the IP.
+
+    Optionally, a persistent EBS volume is attached, formatted (if needed) and mounted.
+
+    The boot process is a graph of steps, see _add_boot_steps(). Independent steps run
+    concurrently and the time spent in each step is logged and written to a report file.
+    """
+
+    # The host name of the master in /etc/hosts, subclasses must override this
+    master_host = None
+
+    # The name of the service that invokes start() and stop(), subclasses must override this
+    service_name = None
+
+    # The maximum number of seconds between checks in any of the waits at boot time
+    max_poll_interval = 10
+
+    def __init__( self, user, shared_dir, ephemeral_dir, persistent_dir, lazy_dirs ):
+        """
+        :param user: the user the services run as
+        """
+        super( NodeTools, self ).__init__( )
+        self.user = user
+        self.shared_dir = shared_dir
+        self.ephemeral_dir = ephemeral_dir
+        self.persistent_dir = persistent_dir
+        self.uid = getpwnam( self.user ).pw_uid
+        self.gid = getgrnam( self.user ).gr_gid
+        self.lazy_dirs = lazy_dirs
+        self.__local = threading.local( )
+        self.etc_hosts = HostsFile( )
+        self._patch_boto_config( )
+
+    def _patch_boto_config( self ):
+        from boto import config
+        def inject_default( name, default ):
+            section = 'Boto'
+            value = config.get( section, name )
+
+            if value != default:
+                if not config.has_section( section ):
+                    config.add_section( section )
+                config.set( section, name, default )
+
+        # Override the 5xx retry limit default of 6
+        inject_default( 'num_retries', '12' )
+
+    @property
+    def boot_report_path( self ):
+        return '/var/log/%s-boot-steps.tsv' % self.service_name
+
+    def start( self ):
+        """
+        Invoked at boot time or when the service is started.
+        """
+        log.info( "Starting %s", self.service_name )
+        graph = BootGraph( )
+        self._add_boot_steps( graph )
+        graph.add( 'start_services', self._start_services, after=graph.steps.keys( ) )
+        try:
+            graph.run( )
+        finally:
+            report = graph.report( )
+            log.info( "Boot steps:\n%s", report )
+            try:
+                replace_file( self.boot_report_path, report )
+            except EnvironmentError as e:
+                log.warn( "Failed to write boot report to %s: %s", self.boot_report_path, e )
+
+    def _add_boot_steps( self, graph ):
+        """
+        Add the steps for booting this node to the given graph. Subclasses should extend this
+        method to add their own steps. Steps for only the master or only the slaves must depend
+        on the discover_master step and use _on_master or _on_slave as their condition.
+
+        :param BootGraph graph:
+        """
+        graph.add( 'wait_for_cloud_init', self._wait_for_cloud_init )
+        graph.add( 'discover_master', self._discover_master, after=[ 'wait_for_cloud_init' ] )
+        graph.add( 'mount_ebs_volume', self._mount_ebs_volume, after=[ 'wait_for_cloud_init' ] )
+        graph.add( 'create_lazy_dirs', self._create_lazy_dirs, after=[ 'mount_ebs_volume' ] )
+        graph.add( 'setup_etc_hosts', self._setup_etc_hosts, after=[ 'discover_master' ] )
+        graph.add( 'publish_host_key', self._publish_host_key,
+                   after=[ 'discover_master' ], condition=self._on_master )
+        graph.add( 'get_master_host_key', self._get_master_host_key,
+                   after=[ 'discover_master' ], condition=self._on_slave )
+        graph.add( 'wait_for_master_ssh', self._wait_for_master_ssh,
+                   after=[ 'setup_etc_hosts' ], condition=self._on_slave )
+        graph.add( 'copy_shared_dir', self._copy_shared_dir,
+                   after=[ 'get_master_host_key', 'wait_for_master_ssh' ],
+                   condition=lambda: self._on_slave( ) and self.shared_dir )
+
+    def _start_services( self ):
+        """
+        Start the services for this node, depending on self.node_type.
+        """
+        raise NotImplementedError( )
+
+    def stop( self ):
+        """
+        Invoked at shutdown time or when the service is stopped.
+        """
+        log.info( "Stopping %s", self.service_name )
+        self.etc_hosts.update( { } )
+
+    def _on_master( self ):
+        return self.node_type == 'master'
+
+    def _on_slave( self ):
+        return self.node_type == 'slave'
+
+    @property
+    def node_type( self ):
+        return 'master' if self.master_ip == self.node_ip else 'slave'
+
+    @classmethod
+    @memoize
+    def instance_data( cls, path ):
+        return urlopen( 'http://169.254.169.254/latest/' + path ).read( )
+
+    @classmethod
+    @memoize
+    def meta_data( cls, path ):
+        return cls.instance_data( 'meta-data/' + path )
+
+    @classmethod
+    @memoize
+    def user_data( cls ):
+        user_data = cls.instance_data( 'user-data' )
+        log.info( "User data is '%s'", user_data )
+        return user_data
+
+    @property
+    @memoize
+    def node_ip( self ):
+        ip = self.meta_data( 'local-ipv4' )
+        log.info( "Local IP is '%s'", ip )
+        return ip
+
+    @property
+    @memoize
+    def instance_id( self ):
+        instance_id = self.meta_data( 'instance-id' )
+        log.info( "Instance ID is '%s'", instance_id )
+        return instance_id
+
+    @property
+    @memoize
+    def availability_zone( self ):
+        zone = self.meta_data( 'placement/availability-zone' )
+        log.info( "Availability zone is '%s'", zone )
+        return zone
+
+    @property
+    @memoize
+    def region( self ):
+        m = re.match( r'^([a-z]{2}-[a-z]+-[1-9][0-9]*)([a-z])$', self.availability_zone )
+        assert m
+        region = m.group( 1 )
+        log.info( "Region is '%s'", region )
+        return region
+
+    @property
+    def ec2( self ):
+        """
+        The EC2 connection of the calling thread. Boot steps run concurrently and a boto
+        connection must not be shared between threads.
+        """
+        try:
+            return self.__local.ec2
+        except AttributeError:
+            ec2 = self.__local.ec2 = boto.ec2.connect_to_region( self.region )
+            return ec2
+
+    @property
+    @memoize
+    def master_id( self ):
+        master_id = self.instance_tag( 'leader_instance_id' )
+        if not master_id:
+            raise RuntimeError( "Instance not tagged with master's instance ID" )
+        log.info( "Master's instance ID is '%s'", master_id )
+        return master_id
+
+    @property
+    @memoize
+    def master_ip( self ):
+        if self.master_id == self.instance_id:
+            master_ip = self.node_ip
+            log.info( "I am the master" )
+        else:
+            log.info( "I am a slave" )
+            master_ip = self.master_instance.private_ip_address
+        log.info( "Master IP is '%s'", master_ip )
+        return master_ip
+
+    @property
+    @memoize
+    def is_spot_instance( self ):
+        result = bool( self.this_instance.spot_instance_request_id )
+        log.info( "I am %s spot instance", "a" if result else "not a" )
+        return result
+
+    @memoize
+    def instance( self, instance_id ):
+        """:rtype: Instance"""
+        instances = self.ec2.get_only_instances( instance_ids=[ instance_id ] )
+        assert len( instances ) == 1
+        instance = instances[ 0 ]
+        return instance
+
+    @property
+    @memoize
+    def this_instance( self ):
+        """:rtype: Instance"""
+        instance = self.instance( self.instance_id )
+        log.info( "I am running on %r", instance.__dict__ )
+        return instance
+
+    @property
+    @memoize
+    def master_instance( self ):
+        """:rtype: Instance"""
+        return self.instance( self.master_id )
+
+    @memoize
+    def instance_tag( self, key ):
+        """:rtype: str|None"""
+        return self.this_instance.tags.get( key )
+
+    def _wait_for_cloud_init( self ):
+        # Created by cloud-init on every boot, see cgcloud.core.cloud_init_box.CloudInitBox
+        wait_for_file( '/tmp/cloud-init.done', 'cloud-init to finish' )
+
+    def _discover_master( self ):
+        # Resolving the master's IP resolves everything else it depends on
+        assert self.master_ip
+
+    def _mount_ebs_volume( self ):
+        """
+        Attach, format (if necessary) and mount the EBS volume with the same cluster ordinal as
+        this node.
+        """
+        ebs_volume_size = self.instance_tag( 'ebs_volume_size' ) or '0'
+        ebs_volume_size = int( ebs_volume_size )
+        if ebs_volume_size:
+            instance_name = self.instance_tag( 'Name' )
+            cluster_ordinal = int( self.instance_tag( 'cluster_ordinal' ) )
+            volume_name = '%s__%d' % (instance_name, cluster_ordinal)
+            volume = EC2VolumeHelper( ec2=self.ec2,
+                                      availability_zone=self.availability_zone,
+                                      name=volume_name,
+                                      size=ebs_volume_size,
+                                      volume_type="gp2" )
+            # TODO: handle case where volume is already attached
+            device_ext = '/dev/sdf'
+            device = '/dev/xvdf'
+            volume.attach( self.instance_id, device_ext )
+
+            # Wait for inode to appear and make sure its a block device
+            wait_until( lambda: os.path.exists( device ), 'device %s' % device,
+                        cap=self.max_poll_interval )
+            assert stat.S_ISBLK( os.stat( device ).st_mode )
+
+            # Only format empty volumes
+            volume_label = volume_label_hash( volume_name )
+            if check_output( [ 'file', '-sL', device ] ).strip( ) == device + ': data':
+                check_call( [ 'mkfs', '-t', 'ext4', device ] )
+                check_call( [ 'e2label', device, volume_label ] )
+            else:
+                # If the volume is not empty, verify the file system label
+                actual_label = check_output( [ 'e2label', device ] ).strip( )
+                if actual_label != volume_label:
+                    raise AssertionError(
+                        "Expected volume label '%s' (derived from '%s') but got '%s'" %
+                        (volume_label, volume_name, actual_label) )
+            current_mount_point = self._mount_point( device )
+            if current_mount_point is None:
+                mkdir_p( self.persistent_dir )
+                check_call( [ 'mount', device, self.persistent_dir ] )
+            elif current_mount_point == self.persistent_dir:
+                pass
+            else:
+                raise RuntimeError(
+                    "Can't mount device %s on '%s' since it is already mounted on '%s'" % (
+                        device, self.persistent_dir, current_mount_point) )
+        else:
+            # No persistent volume is attached and the root volume is off limits, so we will need
+            # to place persistent data on the ephemeral volume.
+            self.persistent_dir = self.ephemeral_dir
+
+    def _get_master_host_key( self ):
+        log.info( "Getting master's host key" )
+        master_host_key = self.master_instance.tags.get( 'ssh_host_key' )
+        if master_host_key:
+            self._add_host_keys( [ self.master_host + ':' + master_host_key ] )
+        else:
+            log.warn( "Could not get master's host key" )
+
+    def _add_host_keys( self, host_keys, globally=None ):
+        if globally is None:
+            globally = os.geteuid( ) == 0
+        if globally:
+            known_hosts_path = '/etc/ssh/ssh_known_hosts'
+        else:
+            known_hosts_path = os.path.expanduser( '~/.ssh/known_hosts' )
+        with open( known_hosts_path, 'a+' ) as f:
+            fcntl.flock( f, fcntl.LOCK_EX )
+            keys = set( _.strip( ) for _ in f.readlines( ) )
+            keys.update( ' '.join( _.split( ':' ) ) for _ in host_keys )
+            if '' in keys: keys.remove( '' )
+            keys = list( keys )
+            keys.sort( )
+            keys.append( '' )
+            f.seek( 0 )
+            f.truncate( 0 )
+            f.write( '\n'.join( keys ) )
+
+    def _wait_for_master_ssh( self ):
+        """
+        Wait until the master is accessible via SSH.
+        """
+        for attempt in retry( cap=self.max_poll_interval, timeout=None,
+                              predicate=lambda e: isinstance( e, socket.error ) ):
+            with attempt:
+                s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+                try:
+                    s.settimeout( 5 )
+                    s.connect( (self.master_host, 22) )
+                finally:
+                    s.close( )
+
+    def _copy_shared_dir( self ):
+        self._copy_dir_from_master( self.shared_dir )
+
+    def _copy_dir_from_master( self, path ):
+        distribution = Distribution.from_spec( self.instance_tag( 'shared_dir_distribution' ),
+                                               node=self, master_host=self.master_host )
+        distribution.fetch( path )
+
+    def _get_host_key( self ):
+        with open( '/etc/ssh/ssh_host_ecdsa_key.pub' ) as f:
+            return ':'.join( f.read( ).split( )[ :2 ] )
+
+    def _publish_host_key( self ):
+        master_host_key = self._get_host_key( )
+        self.ec2.create_tags( [ self.master_id ], dict( ssh_host_key=master_host_key ) )
+
+    def _create_lazy_dirs( self ):
+        log.info( "Bind-mounting directory structure" )
+        for (parent, name, persistent) in self.lazy_dirs:
+            assert parent[ 0 ] == os.path.sep
+            logical_path = os.path.join( parent, name )
+            if persistent is None:
+                tag = 'persist' + logical_path.replace( os.path.sep, '_' )
+                persistent = less_strict_bool( self.instance_tag( tag ) )
+            location = self.persistent_dir if persistent else self.ephemeral_dir
+            physical_path = os.path.join( location, parent[ 1: ], name )
+            mkdir_p( physical_path )
+            os.chown( physical_path, self.uid, self.gid )
+            check_call( [ 'mount', '--bind', physical_path, logical_path ] )
+
+    def _etc_hosts_entries( self ):
+        """
+        Returns the desired entries for /etc/hosts as an ordered dictionary mapping host names
+        to IPs. Subclasses can extend this method to add entries, e.g. for workers.
+        """
+        hosts = self.instance_tag( 'etc_hosts_entries' ) or ""
+        hosts = parse_etc_hosts_entries( hosts )
+        hosts[ self.master_host ] = self.master_ip
+        return hosts
+
+    def _setup_etc_hosts( self ):
+        self.etc_hosts.update( self._etc_hosts_entries( ) )
+
+    def _mount_point( self, device ):
+        with open( '/proc/mounts' ) as f:
+            for line in f:
+                line = line.split( )
+                if line[ 0 ] == device:
+                    return line[ 1 ]
+        return None
+
+
+class HostsFile( object ):
+    """
+    Manages a block of entries in a hosts file. All entries are written at once, replacing the
+    previous block. The file is replaced atomically such that resolvers never see a partially
+    written file, and it is left untouched if nothing changed.
+
+    >>> import shutil
+    >>> tmp_dir = tempfile.mkdtemp( )
+    >>> path = os.path.join( tmp_dir, 'hosts' )
+    >>> with open( path, 'w' ) as f:
+    ...     f.write( '127.0.0.1 localhost\\n10.0.0.9 spark-master\\n' )
+    >>> hosts = HostsFile( path )
+    >>> hosts.update( OrderedDict( [ ('spark-master', '10.0.0.1'), ('foo', '10.0.0.2') ] ) )
+    True
+    >>> print open( path ).read( ),
+    127.0.0.1 localhost
+    # BEGIN entries managed by cgcloud
+    10.0.0.1 spark-master
+    10.0.0.2 foo
+    # END entries managed by cgcloud
+    >>> hosts.update( OrderedDict( [ ('spark-master', '10.0.0.1'), ('foo', '10.0.0.2') ] ) )
+    False
+    >>> hosts.update( { } )
+    True
+    >>> print open( path ).read( ),
+    127.0.0.1 localhost
+    >>> shutil.rmtree( tmp_dir )
+    """
+
+    begin_marker = '# BEGIN entries managed by cgcloud\n'
+    end_marker = '# END entries managed by cgcloud\n'
+
+    def __init__( self, path='/etc/hosts' ):
+        super( HostsFile, self ).__init__( )
+        self.path = path
+        self.lock = threading.Lock( )
+
+    def update( self, hosts ):
+        """
+        Replace the managed block with one containing the given entries. Entries for the given
+        host names outside the managed block, e.g. ones added by earlier versions of cgcloud, are
+        removed, too.
+
+        :param dict hosts: maps host names to IPs, an empty dictionary removes the block
+
+        :return: True if the file was changed, False otherwise
+        """
+        with self.lock:
+            # Don't replace a symlink with a regular file
+            path = os.path.realpath( self.path )
+            with open( path ) as f:
+                contents = f.read( )
+            contents = self.render( contents, hosts )
+            changed = replace_file( path, contents )
+        if changed:
+            log.info( "Updated %s with %i entries", self.path, len( hosts ) )
+        return changed
+
+    @classmethod
+    def render( cls, contents, hosts ):
+        """
+        Returns the given contents of a hosts file with the managed block replaced by one for
+        the given entries.
+        """
+        lines = [ ]
+        in_block = False
+        for line in contents.splitlines( True ):
+            if not line.endswith( '\n' ):
+                line += '\n'
+            if line == cls.begin_marker:
+                in_block = True
+            elif line == cls.end_marker:
+                in_block = False
+            elif not in_block:
+                fields = line.split( '#', 1 )[ 0 ].split( )
+                if not any( name in hosts for name in fields[ 1: ] ):
+                    lines.append( line )
+        if hosts:
+            lines.append( cls.begin_marker )
+            lines.extend( '%s %s\n' % (ip, name) for name, ip in hosts.iteritems( ) if ip )
+            lines.append( cls.end_marker )
+        return ''.join( lines )
+
+
+def parse_etc_hosts_entries( hosts ):
+    """
+    >>> parse_etc_hosts_entries("").items()
+    []
+    >>> parse_etc_hosts_entries("foo:1.2.3.4").items()
+    [('foo', '1.2.3.4')]
+    >>> parse_etc_hosts_entries(" foo : 1.2.3.4 , bar : 2.3.4.5 ").items()
+    [('foo', '1.2.3.4'), ('bar', '2.3.4.5')]
+    """
+    return OrderedDict( (ip.strip( ), name.strip( ))
+        for ip, name in (entry.split( ':', 1 )
+        for entry in hosts.split( ',' ) if entry) )
+
+
+def replace_file( path, contents, uid=None, gid=None ):
+    """
+    Atomically replace the file at the given path with one containing the given string, unless
+    the file already has the given contents. Readers of the file see either the old or the new
+    version, never a partially written one.
+
+    :return: True if the file was replaced, False if it already had the given contents
+
+    >>> import shutil
+    >>> tmp_dir = tempfile.mkdtemp( )
+    >>> path = os.path.join( tmp_dir, 'foo' )
+    >>> replace_file( path, 'bar' ), replace_file( path, 'bar' ), replace_file( path, 'baz' )
+    (True, False, True)
+    >>> open( path ).read( ), os.listdir( tmp_dir )
+    ('baz', ['foo'])
+    >>> shutil.rmtree( tmp_dir )
+    """
+    try:
+        with open( path ) as f:
+            if f.read( ) == contents:
+                return False
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    fd, tmp_path = tempfile.mkstemp( dir=os.path.dirname( path ),
+                                     prefix='.' + os.path.basename( path ) )
+    try:
+        with os.fdopen( fd, 'w' ) as f:
+            f.write( contents )
+            f.flush( )
+            os.fsync( f.fileno( ) )
+        os.chmod( tmp_path, 0644 )
+        if uid is not None or gid is not None:
+            os.chown( tmp_path, -1 if uid is None else uid, -1 if gid is None else gid )
+        os.rename( tmp_path, path )
+    except:
+        os.unlink( tmp_path )
+        raise
+    return True
@@ -0,0 +1,242 @@
+"""
+Client-side rate limiting of requests to AWS APIs. AWS meters API requests per account using
+token buckets, separately for different classes of actions. When many threads in a process
+exceed the account's rate, they all get throttled and retry with backoff at roughly the same
+time, causing bursts followed by stalls. Limiting the rate on the client side, in one bucket
+per service and action class that is shared by all threads, keeps the request rate close to
+what the account sustains. The rate of a bucket adapts to throttling: it is halved whenever
+AWS throttles a request and recovers gradually with every request that isn't throttled.
+
+The default limits can be overridden in the CGCLOUD_RATE_LIMITS environment variable, a
+comma-separated list of entries of the form SERVICE.CLASS=RATE[/BURST], where CLASS is either
+'describe' or 'mutating', RATE is the sustained number of requests per second and BURST the
+number of requests that may be made at once. A RATE of 0 disables limiting for that bucket.
+Since AWS applies its limits per account, this should be set to match the account in use.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from cgcloud.lib.api_calls import query_action_name, s3_action_name, is_throttling
+
+log = logging.getLogger( __name__ )
+
+
+class TokenBucket( object ):
+    """
+    A token bucket shared by any number of threads. Each call to acquire() consumes a token,
+    blocking the caller until one is available. Tokens are replenished at the bucket's rate
+    and accumulate up to the bucket's capacity, allowing for bursts. Callers are served in the
+    order in which they call acquire(): a caller that has to wait reserves a token by driving
+    the number of tokens below zero.
+
+    >>> b = TokenBucket( rate=100, capacity=2 )
+    >>> start = time.time( )
+    >>> for i in range( 4 ):
+    ...     b.acquire( )
+    >>> 0.015 < time.time( ) - start < 0.2
+    True
+
+    When a request is throttled, the rate is halved and the bucket drained. Throttling
+    reported in short succession, e.g. by concurrent threads, is treated as a single event.
+
+    >>> b.throttled( )
+    >>> b.rate, b.tokens <= 0
+    (50.0, True)
+    >>> b.throttled( )
+    >>> b.rate
+    50.0
+
+    Each successful request increases the rate again by an amount that adds up to about one
+    request per second over the course of a second, but never beyond the bucket's maximum rate.
+
+    >>> for i in range( 50 ):
+    ...     b.succeeded( )
+    >>> round( b.rate, 1 )
+    51.0
+    >>> for i in range( 10000 ):
+    ...     b.succeeded( )
+    >>> b.rate
+    100.0
+
+    >>> TokenBucket( rate=0, capacity=1 )
+    Traceback (most recent call last):
+    ...
+    ValueError: The rate of a token bucket must be greater than zero.
+    """
+
+    def __init__( self, rate, capacity, min_rate=0.5 ):
+        super( TokenBucket, self ).__init__( )
+        if not rate > 0:
+            raise ValueError( 'The rate of a token bucket must be greater than zero.' )
+        self.max_rate = float( rate )
+        self.min_rate = min( min_rate, self.max_rate )
+        self.rate = self.max_rate
+        self.capacity = float( capacity )
+        self.tokens = self.capacity
+        self.last_refill = time.time( )
+        self.last_throttled = None
+        self.lock = threading.Lock( )
+
+    def acquire( self ):
+        with self.lock:
+            now = time.time( )
+            self.__refill( now )
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep( delay )
+
+    def throttled( self ):
+        with self.lock:
+            now = time.time( )
+            if self.last_throttled is None or now - self.last_throttled > 1 / self.rate + 1:
+                self.last_throttled = now
+                self.__refill( now )
+                self.rate = max( self.min_rate, self.rate / 2 )
+                self.tokens = min( self.tokens, 0 )
+                log.debug( 'Throttled, reducing rate to %.1f requests/s', self.rate )
+
+    def succeeded( self ):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min( self.max_rate, self.rate + 1 / self.rate )
+
+    def __refill( self, now ):
+        self.tokens = min( self.capacity, self.tokens + (now - self.last_refill) * self.rate )
+        self.last_refill = now
+
+
+# The sustained rate and burst size per service and action class. The EC2 values are those of
+# the request token buckets documented by AWS for an account with default limits.
+#
+default_limits = {
+    ('ec2', 'describe'): (20, 100),
+    ('ec2', 'mutating'): (5, 50),
+    ('iam', 'describe'): (10, 20),
+    ('iam', 'mutating'): (5, 10),
+    ('sns', 'describe'): (20, 50),
+    ('sns', 'mutating'): (20, 50),
+    ('sqs', 'describe'): (0, 0),
+    ('sqs', 'mutating'): (0, 0),
+    ('s3', 'describe'): (0, 0),
+    ('s3', 'mutating'): (0, 0) }
+
+
+def parse_limits( s ):
+    """
+    Parse the value of the CGCLOUD_RATE_LIMITS environment variable.
+
+    >>> sorted( parse_limits( 'ec2.mutating=2.5, iam.describe=5/10' ).items( ) )
+    [(('ec2', 'mutating'), (2.5, 2.5)), (('iam', 'describe'), (5.0, 10.0))]
+    >>> parse_limits( '' )
+    {}
+    >>> parse_limits( 'ec2=5' )
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid rate limit 'ec2=5', expected SERVICE.CLASS=RATE[/BURST]
+    """
+    limits = { }
+    for entry in s.split( ',' ):
+        entry = entry.strip( )
+        if entry:
+            try:
+                key, value = entry.split( '=' )
+                service, action_class = key.strip( ).split( '.' )
+                if action_class not in ('describe', 'mutating'):
+                    raise ValueError( )
+                rate, _, burst = value.partition( '/' )
+                rate = float( rate )
+                burst = float( burst ) if burst else max( rate, 1 ) if rate else 0.0
+                if rate < 0 or burst < 0:
+                    raise ValueError( )
+            except ValueError:
+                raise ValueError( "Invalid rate limit '%s', expected "
+                                  "SERVICE.CLASS=RATE[/BURST]" % entry )
+            limits[ service, action_class ] = rate, burst
+    return limits
+
+
+def action_class( action ):
+    """
+    >>> map( action_class, [ 'DescribeInstances', 'ListRoles', 'GET object', 'RunInstances' ] )
+    ['describe', 'describe', 'describe', 'mutating']
+    """
+    return 'describe' if action.startswith( ('Describe', 'Get', 'List', 'GET ', 'HEAD ') ) \
+        else 'mutating'
+
+
+class RateLimiter( object ):
+    """
+    Maintains one token bucket per service and action class.
+
+    >>> limiter = RateLimiter( parse_limits( 'ec2.mutating=2' ) )
+    >>> limiter.bucket( 'ec2', 'RunInstances' ).rate
+    2.0
+    >>> limiter.bucket( 'ec2', 'DescribeInstances' ).rate
+    20.0
+    >>> limiter.bucket( 's3', 'GET object' ) is None
+    True
+    """
+
+    def __init__( self, limits=None ):
+        super( RateLimiter, self ).__init__( )
+        self.limits = dict( default_limits )
+        if limits is not None:
+            self.limits.update( limits )
+        self.buckets = { }
+        self.lock = threading.Lock( )
+
+    def bucket( self, service, action ):
+        """
+        Returns the bucket for the given action of the given service or None if requests for
+        that action are not to be limited.
+
+        :rtype: TokenBucket|None
+        """
+        key = service, action_class( action )
+        try:
+            return self.buckets[ key ]
+        except KeyError:
+            with self.lock:
+                try:
+                    return self.buckets[ key ]
+                except KeyError:
+                    rate, burst = self.limits.get( key, (0, 0) )
+                    bucket = TokenBucket( rate, burst ) if rate else None
+                    self.buckets[ key ] = bucket
+                    return bucket
+
+    def instrument( self, connection, service ):
+        """
+        Instrument the given boto connection such that its requests are limited by the
+        buckets for the given service. Returns the connection.
+        """
+        make_request = connection.make_request
+        action_name = s3_action_name if service == 's3' else query_action_name
+
+        @wraps( make_request )
+        def wrapper( *args, **kwargs ):
+            bucket = self.bucket( service, action_name( args, kwargs ) )
+            if bucket is None:
+                return make_request( *args, **kwargs )
+            bucket.acquire( )
+            response = make_request( *args, **kwargs )
+            # boto's HTTPResponse caches the body so reading it here doesn't keep the caller
+            # from reading it, too.
+            if response.status >= 400 and is_throttling( response.status, response.read( ) ):
+                bucket.throttled( )
+            else:
+                bucket.succeeded( )
+            return response
+
+        connection.make_request = wrapper
+        return connection
+
+
+rate_limiter = RateLimiter( parse_limits( os.environ.get( 'CGCLOUD_RATE_LIMITS', '' ) ) )
@@ -0,0 +1,341 @@
+"""
+A single retry policy for all of cgcloud: exponential backoff with full jitter, bounded by an
+overall time budget and, optionally, a number of attempts, plus circuit breakers that hold
+off retries once an endpoint is clearly down.
+
+Full jitter means that the delay before each retry is chosen uniformly at random between zero
+and the exponentially growing backoff. Without jitter, many threads, or many nodes of a
+cluster, that fail at the same moment would all retry at the same moment, too, and fail again
+for the same reason.
+
+Like bd2k.util.retry.retry(), which it replaces, retry() yields one context manager per attempt:
+
+>>> i = 0
+>>> for attempt in retry( base=0.001, timeout=1, predicate=lambda e: True ):
+...     with attempt:
+...         i += 1
+...         if i < 3: raise RuntimeError( 'foo' )
+>>> i
+3
+"""
+
+from __future__ import absolute_import
+
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from boto.exception import BotoServerError
+
+from cgcloud.lib.api_calls import is_throttling
+
+log = logging.getLogger( __name__ )
+
+
+# noinspection PyUnusedLocal
+def never( exception ):
+    return False
+
+
+def backoff( attempt, base, cap ):
+    """
+    Returns the delay in seconds before the given retry attempt, the first retry being attempt
+    1, using exponential backoff with full jitter.
+
+    >>> all( 0 <= backoff( 1, 2, 60 ) <= 2 for i in range( 100 ) )
+    True
+    >>> all( 0 <= backoff( 10, 2, 60 ) <= 60 for i in range( 100 ) )
+    True
+    """
+    return random.uniform( 0, min( cap, base * 2 ** (attempt - 1) ) )
+
+
+def retry( base=1, cap=60, timeout=300, max_attempts=None, predicate=never, breaker=None ):
+    """
+    Retry an operation while the failure matches a given predicate, waiting an exponentially
+    increasing, randomized amount of time in between attempts. This function is a generator
+    that yields context managers, one per attempt.
+
+    :param float base: the maximum delay in seconds before the first retry, the maximum delay
+           doubles with every retry
+
+    :param float cap: the upper bound in seconds for the maximum delay
+
+    :param float timeout: the time budget in seconds for all attempts together. No retry is
+           made if its delay would exceed the budget. An ongoing attempt is not interrupted
+           when the budget runs out. If None, retry for as long as it takes. If 0, make
+           exactly one attempt.
+
+    :param int max_attempts: the maximum number of attempts, or None for no limit
+
+    :param Callable[[Exception],bool] predicate: a unary callable returning True if another
+           attempt should be made to recover from the given exception. The default value for
+           this parameter will prevent any retries.
+
+    :param CircuitBreaker breaker: a circuit breaker to consult before each attempt and to
+           report the outcome of each attempt to. While the breaker is open, an attempt waits
+           for it to let attempts through again, but only if that happens within the time
+           budget. Otherwise the attempt fails with CircuitOpenError.
+
+    :rtype: Iterator
+
+    Give up when the time budget would be exceeded:
+
+    >>> i = 0
+    >>> for attempt in retry( base=0.01, cap=0.01, timeout=.1, predicate=lambda e: True ):
+    ...     with attempt:
+    ...         i += 1
+    ...         raise RuntimeError( 'foo' )
+    Traceback (most recent call last):
+    ...
+    RuntimeError: foo
+    >>> i > 1
+    True
+
+    Give up after a number of attempts:
+
+    >>> i = 0
+    >>> for attempt in retry( base=0, max_attempts=5, predicate=lambda e: True ):
+    ...     with attempt:
+    ...         i += 1
+    ...         raise RuntimeError( 'foo' )
+    Traceback (most recent call last):
+    ...
+    RuntimeError: foo
+    >>> i
+    5
+
+    Don't retry unless the predicate returns True:
+
+    >>> i = 0
+    >>> for attempt in retry( base=0, timeout=1 ):
+    ...     with attempt:
+    ...         i += 1
+    ...         raise RuntimeError( 'foo' )
+    Traceback (most recent call last):
+    ...
+    RuntimeError: foo
+    >>> i
+    1
+    """
+    if timeout == 0:
+        max_attempts = 1
+    deadline = None if timeout is None else time.time( ) + timeout
+    go = [ None ]
+    attempts = [ 0 ]
+
+    @contextmanager
+    def repeated_attempt( ):
+        attempts[ 0 ] += 1
+        if breaker is not None:
+            breaker.before( deadline=deadline )
+        try:
+            yield
+        except Exception as e:
+            if breaker is not None:
+                breaker.failure( e )
+            if max_attempts is not None and attempts[ 0 ] >= max_attempts or not predicate( e ):
+                raise
+            delay = backoff( attempts[ 0 ], base, cap )
+            if deadline is not None and time.time( ) + delay >= deadline:
+                raise
+            log.info( 'Got %s, trying again in %.1fs.', e, delay )
+            time.sleep( delay )
+        else:
+            if breaker is not None:
+                breaker.success( )
+            go.pop( )
+
+    while go:
+        yield repeated_attempt( )
+
+
+class CircuitOpenError( RuntimeError ):
+    """
+    Raised instead of making an attempt while a circuit breaker is open
+    """
+    pass
+
+
+def server_error( e ):
+    """
+    True for failures that indicate that an endpoint is down rather than that a particular
+    request failed.
+
+    >>> server_error( BotoServerError( 503, 'Service Unavailable' ) )
+    True
+    >>> server_error( BotoServerError( 400, 'Bad Request' ) )
+    False
+    >>> server_error( socket.error( errno.ECONNREFUSED, 'Connection refused' ) )
+    True
+    """
+    if isinstance( e, BotoServerError ):
+        return e.status >= 500 and not throttled( e )
+    return isinstance( e, socket.error )
+
+
+class CircuitBreaker( object ):
+    """
+    Tracks consecutive failures of an endpoint across all threads. Once the given number of
+    consecutive failures is reached, the breaker opens and attempts fail fast with
+    CircuitOpenError instead of waiting for the endpoint to time out. After the given reset
+    timeout, the breaker lets one attempt through. If that attempt succeeds, the breaker closes
+    again, otherwise it stays open for another reset timeout. An attempt with a deadline
+    that leaves enough time waits for the breaker to let it through instead of failing.
+
+    >>> b = CircuitBreaker( 'foo', threshold=2, reset_timeout=0.05 )
+    >>> down = BotoServerError( 503, 'Service Unavailable' )
+    >>> b.failure( down ); b.before( ); b.failure( down )
+    >>> b.before( )
+    Traceback (most recent call last):
+    ...
+    CircuitOpenError: The foo endpoint appears to be down.
+    >>> time.sleep( 0.05 )
+    >>> b.before( )
+    >>> b.before( )
+    Traceback (most recent call last):
+    ...
+    CircuitOpenError: The foo endpoint appears to be down.
+    >>> b.success( ); b.before( )
+
+    Wait for the breaker if the deadline permits:
+
+    >>> b.failure( down ); b.failure( down )
+    >>> start = time.time( )
+    >>> b.before( deadline=start + 1 )
+    >>> 0.04 <= time.time( ) - start < 1
+    True
+    >>> b.failure( down )
+    >>> b.before( deadline=time.time( ) + 0.01 )
+    Traceback (most recent call last):
+    ...
+    CircuitOpenError: The foo endpoint appears to be down.
+    >>> b.success( )
+
+    Failures that don't indicate an outage don't count:
+
+    >>> for i in range( 3 ): b.failure( BotoServerError( 400, 'Bad Request' ) )
+    >>> b.before( )
+    """
+
+    def __init__( self, name, threshold=5, reset_timeout=30, trips=server_error ):
+        super( CircuitBreaker, self ).__init__( )
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.trips = trips
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Condition( )
+
+    def before( self, deadline=0 ):
+        """
+        Invoked before an attempt. Returns when the attempt may be made. Raises CircuitOpenError
+        if the breaker is open and won't let the attempt through before the given deadline.
+
+        :param float deadline: the time by which the attempt must be made, in seconds since the
+               epoch, 0 to fail immediately while the breaker is open or None to wait for as
+               long as it takes
+        """
+        with self.lock:
+            while self.opened is not None:
+                now = time.time( )
+                reopen = self.opened + self.reset_timeout
+                if now >= reopen:
+                    # Let this attempt through but keep others waiting until it succeeds
+                    self.opened = now
+                    break
+                if deadline is not None and reopen > deadline:
+                    raise CircuitOpenError( 'The %s endpoint appears to be down.' % self.name )
+                # A successful attempt closes the breaker and wakes us up early
+                self.lock.wait( reopen - now )
+
+    def failure( self, e ):
+        if not self.trips( e ):
+            # The endpoint responded, it just didn't like the request
+            self.success( )
+        else:
+            with self.lock:
+                self.failures += 1
+                if self.failures >= self.threshold and self.opened is None:
+                    log.warn( 'The %s endpoint appears to be down, failing fast for %is.',
+                              self.name, self.reset_timeout )
+                    self.opened = time.time( )
+
+    def success( self ):
+        with self.lock:
+            self.failures = 0
+            if self.opened is not None:
+                self.opened = None
+                self.lock.notify_all( )
+
+
+_breakers = { }
+_breakers_lock = threading.Lock( )
+
+
+def circuit_breaker( name ):
+    """
+    Returns the process-wide circuit breaker for the endpoint of the given name, creating it
+    if necessary.
+
+    :rtype: CircuitBreaker
+    """
+    with _breakers_lock:
+        try:
+            return _breakers[ name ]
+        except KeyError:
+            breaker = _breakers[ name ] = CircuitBreaker( name )
+            return breaker
+
+
+# Error classifiers for the various services. Each takes an exception and returns True if the
+# operation that raised it should be retried.
+
+def throttled( e ):
+    """
+    True if the given exception indicates that AWS throttled the request.
+
+    >>> def error( status, code, message ):
+    ...     return BotoServerError( status, '', '<Response><Errors><Error><Code>%s</Code>'
+    ...                             '<Message>%s</Message></Error></Errors></Response>'
+    ...                             % (code, message) )
+    >>> throttled( error( 503, 'RequestLimitExceeded', 'Request limit exceeded.' ) )
+    True
+    >>> throttled( error( 400, 'Throttling', 'Rate exceeded' ) )
+    True
+    >>> throttled( error( 429, 'TooManyRequestsException', 'Rate exceeded' ) )
+    True
+    >>> throttled( error( 503, 'SlowDown', 'Please reduce your request rate.' ) )
+    True
+    >>> throttled( error( 400, 'InvalidInstanceID.Malformed', 'Invalid id' ) )
+    False
+    >>> throttled( BotoServerError( 503, 'Service Unavailable', 'not XML' ) )
+    False
+    >>> throttled( BotoServerError( 503, 'Service Unavailable' ) )
+    False
+    """
+    return isinstance( e, BotoServerError ) and is_throttling( e.status, e.body or '' )
+
+
+def ec2_not_found( e ):
+    """
+    True for the NotFound errors caused by EC2's eventual consistency, e.g. when tagging an
+    instance right after creating it.
+    """
+    return isinstance( e, BotoServerError ) and (e.error_code or '').endswith( '.NotFound' )
+
+
+def ssh_retryable( e ):
+    """
+    True for the kinds of failures to be expected when connecting to a booting instance via
+    SSH.
+
+    >>> ssh_retryable( socket.timeout( ) ), ssh_retryable( AssertionError( ) )
+    (True, False)
+    """
+    return not isinstance( e, AssertionError )
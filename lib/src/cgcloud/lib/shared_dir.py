@@ -0,0 +1,472 @@
+"""
+Distribution of the shared directory to the workers of a cluster at boot time.
+
+Originally, every worker rsync'ed the shared directory from the leader. When a large cluster
+comes up, the leader's disk and network interface become the bottleneck and the time it takes
+to boot the cluster grows linearly with the number of workers. The strategy to use is selected
+per cluster, via the shared_dir_distribution instance tag, whose value is one of
+
+rsync
+    The default. Every worker rsync's the shared directory directly from the leader. This is
+    the simplest and fastest strategy for small clusters.
+
+relay[:K]
+    The workers form a K-ary tree by cluster ordinal, K defaulting to 2. The leader sits at
+    the root of the tree. Each worker waits for its parent to finish copying the shared
+    directory and then rsync's it from the parent instead of the leader, such that no node
+    serves more than K others. A worker whose parent is gone or doesn't finish in time falls
+    back to copying from the leader.
+
+s3://BUCKET[/PREFIX]
+    The client uploads the shared directory to S3 along with a manifest of checksums and the
+    workers download the files in parallel, directly from S3. If the manifest is missing,
+    e.g. because the cluster was created without a shared directory, workers fall back to
+    copying from the leader. The workers' IAM role must allow reading from the bucket.
+
+Every strategy compares checksums such that a node skips the files it already has, e.g.
+because they were baked into its image or copied during a previous boot.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import binascii
+import errno
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from subprocess import check_call, CalledProcessError
+
+from cgcloud.lib.retry import retry, backoff
+from cgcloud.lib.util import TaskGroup
+
+log = logging.getLogger( __name__ )
+
+sudo = '/usr/bin/sudo'
+
+default_fanout = 2
+
+# The name of the instance tag by which a node signals that its copy of the shared directory
+# is complete
+ready_tag = 'shared_dir_ready'
+
+manifest_name = 'manifest.json'
+
+
+def parse_distribution( spec ):
+    """
+    Parse the value of the shared_dir_distribution tag into a tuple of the name of the
+    strategy and its argument.
+
+    >>> parse_distribution( None ), parse_distribution( 'rsync' )
+    (('rsync', None), ('rsync', None))
+    >>> parse_distribution( 'relay' ), parse_distribution( 'relay:4' )
+    (('relay', 2), ('relay', 4))
+    >>> parse_distribution( 's3://foo' ), parse_distribution( 's3://foo/bar/baz/' )
+    (('s3', ('foo', '')), ('s3', ('foo', 'bar/baz')))
+    >>> parse_distribution( 'relay:0' )
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid shared directory distribution 'relay:0', expected 'rsync', 'relay[:K]' \
+with K > 0 or 's3://BUCKET[/PREFIX]'
+    """
+    if not spec or spec == 'rsync':
+        return 'rsync', None
+    try:
+        if spec.startswith( 's3://' ):
+            bucket_name, _, prefix = spec[ len( 's3://' ): ].partition( '/' )
+            if bucket_name:
+                return 's3', (bucket_name, prefix.strip( '/' ))
+        else:
+            name, _, fanout = spec.partition( ':' )
+            if name == 'relay':
+                fanout = int( fanout ) if fanout else default_fanout
+                if fanout > 0:
+                    return name, fanout
+    except ValueError:
+        pass
+    raise ValueError( "Invalid shared directory distribution '%s', expected 'rsync', "
+                      "'relay[:K]' with K > 0 or 's3://BUCKET[/PREFIX]'" % spec )
+
+
+def relay_parent( ordinal, fanout ):
+    """
+    Returns the cluster ordinal of the node from which the node with the given ordinal copies
+    the shared directory when relaying. The leader, with ordinal 0, is the root of the tree.
+
+    >>> [ relay_parent( i, 2 ) for i in range( 1, 8 ) ]
+    [0, 0, 1, 1, 2, 2, 3]
+    """
+    return (ordinal - 1) // fanout
+
+
+def s3_key_prefix( prefix, leader_instance_id ):
+    """
+    Returns the prefix of the keys under which the shared directory of the cluster with the
+    given leader is staged in S3.
+
+    >>> s3_key_prefix( '', 'i-1234' ), s3_key_prefix( 'foo/bar', 'i-1234' )
+    ('i-1234/', 'foo/bar/i-1234/')
+    """
+    return '/'.join( filter( None, [ prefix, leader_instance_id ] ) ) + '/'
+
+
+def file_md5( path ):
+    """
+    Returns the MD5 checksum of the file at the given path as a hexadecimal string.
+    """
+    md5 = hashlib.md5( )
+    with open( path, 'rb' ) as f:
+        while True:
+            buf = f.read( 1024 * 1024 )
+            if not buf:
+                break
+            md5.update( buf )
+    return md5.hexdigest( )
+
+
+def walk_files( local_path ):
+    """
+    Yields a tuple ( rel_path, abs_path ) for every regular file at or below the given path,
+    rel_path being where `rsync -r local_path dest/` would place the file relative to dest. Like
+    rsync, this function honors the trailing slash and skips symbolic links.
+
+    >>> import tempfile, shutil
+    >>> tmp_dir = tempfile.mkdtemp( )
+    >>> os.makedirs( os.path.join( tmp_dir, 'foo', 'bar' ) )
+    >>> for path in [ 'foo/a', 'foo/bar/b' ]:
+    ...     open( os.path.join( tmp_dir, path ), 'w' ).close( )
+    >>> os.symlink( 'a', os.path.join( tmp_dir, 'foo', 'c' ) )
+    >>> sorted( rel_path for rel_path, _ in walk_files( os.path.join( tmp_dir, 'foo' ) ) )
+    ['foo/a', 'foo/bar/b']
+    >>> sorted( rel_path for rel_path, _ in walk_files( os.path.join( tmp_dir, 'foo/' ) ) )
+    ['a', 'bar/b']
+    >>> list( walk_files( os.path.join( tmp_dir, 'foo', 'a' ) ) ) == [
+    ...     ( 'a', os.path.join( tmp_dir, 'foo', 'a' ) ) ]
+    True
+    >>> shutil.rmtree( tmp_dir )
+    """
+    base = '' if local_path.endswith( '/' ) else os.path.basename( local_path )
+    if os.path.isdir( local_path ):
+        for dir_path, _, file_names in os.walk( local_path ):
+            for file_name in file_names:
+                abs_path = os.path.join( dir_path, file_name )
+                if os.path.isfile( abs_path ) and not os.path.islink( abs_path ):
+                    yield os.path.join( base, os.path.relpath( abs_path, local_path ) ), abs_path
+    elif os.path.isfile( local_path ) and not os.path.islink( local_path ):
+        yield base, local_path
+
+
+def publish( local_path, get_bucket, key_prefix, num_threads=8 ):
+    """
+    Upload the given local file or directory to S3, along with a manifest of the uploaded
+    files, their checksums and permissions. The manifest is uploaded last such that its
+    presence signals that the upload is complete.
+
+    :param str local_path: the path to the local file or directory, see walk_files()
+
+    :param get_bucket: a callable returning the boto S3 bucket to upload to. It will be invoked
+           from multiple threads and should return a bucket object that is safe to use in the
+           calling thread.
+
+    :param str key_prefix: the prefix of the S3 keys, see s3_key_prefix()
+
+    :return: the number of files uploaded
+    """
+    manifest = { }
+    lock = threading.Lock( )
+
+    def upload( rel_path, abs_path ):
+        md5 = file_md5( abs_path )
+        key = get_bucket( ).new_key( key_prefix + 'files/' + rel_path )
+        key.set_contents_from_filename( abs_path,
+                                        md5=(md5, base64.b64encode( binascii.unhexlify( md5 ) )) )
+        with lock:
+            manifest[ rel_path ] = [ md5, os.stat( abs_path ).st_mode & 0777 ]
+
+    with TaskGroup( num_threads, name='publish' ) as group:
+        for rel_path, abs_path in walk_files( local_path ):
+            group.submit( upload, rel_path, abs_path )
+    get_bucket( ).new_key( key_prefix + manifest_name ).set_contents_from_string(
+        json.dumps( manifest, sort_keys=True ) )
+    return len( manifest )
+
+
+def fetch( path, get_bucket, key_prefix, uid=None, gid=None, num_threads=8 ):
+    """
+    Download the files listed in the manifest published under the given key prefix into the
+    given local directory, skipping files whose local copy has the expected checksum. Each file
+    is downloaded to a temporary file next to it that is renamed into place once its checksum
+    was verified.
+
+    :param int uid: the ID of the user to own the downloaded files and directories, or None to
+           keep the owner
+
+    :param int gid: the ID of the group to own the downloaded files and directories, or None to
+           keep the group
+
+    :return: the number of files downloaded or None if there is no manifest
+
+    >>> import tempfile, shutil
+    >>> tmp_dir = tempfile.mkdtemp( )
+    >>> os.makedirs( os.path.join( tmp_dir, 'src', 'bar' ) )
+    >>> for name in [ 'a', 'bar/b' ]:
+    ...     with open( os.path.join( tmp_dir, 'src', name ), 'w' ) as f:
+    ...         f.write( name )
+    >>> class FauxKey( object ):
+    ...     def __init__( self, contents, name ):
+    ...         self.contents, self.name = contents, name
+    ...     def set_contents_from_filename( self, path, md5 ):
+    ...         self.contents[ self.name ] = open( path ).read( )
+    ...     def set_contents_from_string( self, s ):
+    ...         self.contents[ self.name ] = s
+    ...     def get_contents_as_string( self ):
+    ...         return self.contents[ self.name ]
+    ...     def get_contents_to_filename( self, path ):
+    ...         open( path, 'w' ).write( self.contents[ self.name ] )
+    >>> class FauxBucket( dict ):
+    ...     def new_key( self, name ):
+    ...         return FauxKey( self, name )
+    ...     def get_key( self, name ):
+    ...         return FauxKey( self, name ) if name in self else None
+    >>> bucket = FauxBucket( )
+    >>> get_bucket = lambda: bucket
+    >>> fetch( os.path.join( tmp_dir, 'dst' ), get_bucket, 'i-1234/' ) is None
+    True
+    >>> publish( os.path.join( tmp_dir, 'src/' ), get_bucket, 'i-1234/' )
+    2
+    >>> fetch( os.path.join( tmp_dir, 'dst' ), get_bucket, 'i-1234/' )
+    2
+    >>> open( os.path.join( tmp_dir, 'dst', 'bar', 'b' ) ).read( )
+    'bar/b'
+
+    Only files that are missing or differ are downloaded again:
+
+    >>> with open( os.path.join( tmp_dir, 'dst', 'a' ), 'w' ) as f:
+    ...     f.write( 'x' )
+    >>> fetch( os.path.join( tmp_dir, 'dst' ), get_bucket, 'i-1234/' )
+    1
+    >>> open( os.path.join( tmp_dir, 'dst', 'a' ) ).read( )
+    'a'
+    >>> shutil.rmtree( tmp_dir )
+    """
+    key = get_bucket( ).get_key( key_prefix + manifest_name )
+    if key is None:
+        return None
+    manifest = json.loads( key.get_contents_as_string( ) )
+    downloaded = [ ]
+    lock = threading.Lock( )
+
+    def download( rel_path, md5, mode ):
+        local_path = os.path.join( path, rel_path )
+        if os.path.isfile( local_path ) and file_md5( local_path ) == md5:
+            return
+        _makedirs( path, os.path.dirname( rel_path ), uid, gid )
+        tmp_path = local_path + '.cgcloud-tmp'
+        try:
+            get_bucket( ).new_key( key_prefix + 'files/' + rel_path ).get_contents_to_filename(
+                tmp_path )
+            if file_md5( tmp_path ) != md5:
+                raise RuntimeError( "Checksum mismatch for '%s'" % rel_path )
+            os.chmod( tmp_path, mode )
+            if uid is not None or gid is not None:
+                os.chown( tmp_path, -1 if uid is None else uid, -1 if gid is None else gid )
+            os.rename( tmp_path, local_path )
+        except:
+            if os.path.exists( tmp_path ):
+                os.unlink( tmp_path )
+            raise
+        with lock:
+            downloaded.append( rel_path )
+
+    with TaskGroup( num_threads, name='fetch' ) as group:
+        for rel_path, (md5, mode) in manifest.iteritems( ):
+            group.submit( download, rel_path, md5, mode )
+    log.info( 'Downloaded %i of %i files, the others were up-to-date.',
+              len( downloaded ), len( manifest ) )
+    return len( downloaded )
+
+
+def _makedirs( path, rel_path, uid, gid ):
+    """
+    Create the given relative directory and its missing parents below the given path,
+    changing the ownership of each directory created.
+    """
+    for i in range( -1, rel_path.count( '/' ) + 1 if rel_path else 0 ):
+        dir_path = os.path.join( path, *rel_path.split( '/' )[ :i + 1 ] )
+        try:
+            os.mkdir( dir_path )
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            if uid is not None or gid is not None:
+                os.chown( dir_path, -1 if uid is None else uid, -1 if gid is None else gid )
+
+
+class Distribution( object ):
+    """
+    A strategy for copying the shared directory to a worker. Instances are created via
+    from_spec() and used by the node tools at boot time.
+    """
+
+    def __init__( self, node, master_host ):
+        """
+        :param cgcloud.lib.node_tools.NodeTools node: the node tools of the worker
+
+        :param str master_host: the host name of the leader
+        """
+        super( Distribution, self ).__init__( )
+        self.node = node
+        self.master_host = master_host
+
+    @classmethod
+    def from_spec( cls, spec, node, master_host ):
+        """
+        Returns the strategy selected by the given value of the shared_dir_distribution tag.
+
+        :rtype: Distribution
+        """
+        name, arg = parse_distribution( spec )
+        if name == 'relay':
+            return RelayDistribution( node, master_host, fanout=arg )
+        elif name == 's3':
+            return S3Distribution( node, master_host, *arg )
+        else:
+            return RsyncDistribution( node, master_host )
+
+    def fetch( self, path ):
+        """
+        Copy the directory at the given path on the leader to the same path on this worker.
+        """
+        raise NotImplementedError( )
+
+    def _rsync( self, host, path, ssh_opts=None ):
+        if not path.endswith( '/' ):
+            path += '/'
+        args = [ sudo, '-u', self.node.user, 'rsync', '-av', '--checksum' ]
+        if ssh_opts:
+            args.append( '--rsh=ssh ' + ' '.join( ssh_opts ) )
+        for attempt in retry( base=5, timeout=None, max_attempts=5,
+                              predicate=lambda e: isinstance( e, CalledProcessError ) ):
+            with attempt:
+                check_call( args + [ host + ':' + path, path ] )
+
+
+class RsyncDistribution( Distribution ):
+    """
+    Copy the shared directory directly from the leader.
+    """
+
+    def fetch( self, path ):
+        log.info( "Copying %s from master", path )
+        self._rsync( self.master_host, path )
+
+
+class RelayDistribution( Distribution ):
+    """
+    Copy the shared directory from the parent node in a tree of nodes rooted at the leader.
+    """
+
+    # Only used for a parent that didn't publish its host key. The traffic stays within the
+    # cluster's security group.
+    peer_ssh_opts = [ '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null' ]
+
+    def __init__( self, node, master_host, fanout=default_fanout, timeout=15 * 60 ):
+        """
+        :param int fanout: the maximum number of nodes copying from any one node
+
+        :param float timeout: the number of seconds to wait for the parent before falling back
+               to the leader
+        """
+        super( RelayDistribution, self ).__init__( node, master_host )
+        self.fanout = fanout
+        self.timeout = timeout
+
+    def fetch( self, path ):
+        ordinal = int( self.node.instance_tag( 'cluster_ordinal' ) or 0 )
+        parent = relay_parent( ordinal, self.fanout ) if ordinal > 0 else 0
+        source, known_host = self.__wait_for_parent( parent ) if parent > 0 else (None, False)
+        if source is not None:
+            log.info( "Copying %s from node %i at %s", path, parent, source )
+            ssh_opts = None if known_host else self.peer_ssh_opts
+            try:
+                self._rsync( source, path, ssh_opts=ssh_opts )
+            except CalledProcessError:
+                log.warn( "Failed to copy %s from node %i, falling back to master", path, parent )
+                source = None
+        if source is None:
+            log.info( "Copying %s from master", path )
+            self._rsync( self.master_host, path )
+        # Publish this node's host key along with the ready tag so that its children can verify it
+        # noinspection PyProtectedMember
+        self.node.ec2.create_tags( [ self.node.instance_id ],
+                                   { ready_tag: 'True', 'ssh_host_key': self.node._get_host_key( ) } )
+
+    def __wait_for_parent( self, ordinal ):
+        """
+        Wait for the node with the given cluster ordinal to tag itself as ready and add its SSH
+        host key to the known hosts. Return the node's private IP and whether its host key was
+        known, or (None, False) if that node is gone or doesn't become ready in time.
+        """
+        filters = { 'tag:leader_instance_id': self.node.master_id,
+            'tag:cluster_ordinal': str( ordinal ),
+            'instance-state-name': [ 'pending', 'running' ] }
+        deadline = time.time( ) + self.timeout
+        attempt = 0
+        while True:
+            instances = self.node.ec2.get_only_instances( filters=filters )
+            if not instances:
+                log.warn( "Node %i is gone", ordinal )
+                return None, False
+            instance = instances[ 0 ]
+            if instance.tags.get( ready_tag ):
+                ip_address = instance.private_ip_address
+                host_key = instance.tags.get( 'ssh_host_key' )
+                if host_key:
+                    # noinspection PyProtectedMember
+                    self.node._add_host_keys( [ ip_address + ':' + host_key ] )
+                else:
+                    log.warn( "Node %i did not publish its host key, not checking it", ordinal )
+                return ip_address, bool( host_key )
+            attempt += 1
+            delay = backoff( attempt, base=5, cap=60 )
+            if time.time( ) + delay > deadline:
+                log.warn( "Node %i did not become ready in time", ordinal )
+                return None, False
+            log.info( "Waiting for node %i to copy the shared directory ...", ordinal )
+            time.sleep( delay )
+
+
+class S3Distribution( Distribution ):
+    """
+    Download the shared directory from where the client staged it in S3.
+    """
+
+    def __init__( self, node, master_host, bucket_name, prefix ):
+        super( S3Distribution, self ).__init__( node, master_host )
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.local = threading.local( )
+
+    def _get_bucket( self ):
+        # boto connections aren't thread-safe
+        try:
+            return self.local.bucket
+        except AttributeError:
+            import boto
+            bucket = boto.connect_s3( ).get_bucket( self.bucket_name, validate=False )
+            self.local.bucket = bucket
+            return bucket
+
+    def fetch( self, path ):
+        key_prefix = s3_key_prefix( self.prefix, self.node.master_id )
+        log.info( "Copying %s from s3://%s/%s", path, self.bucket_name, key_prefix )
+        if fetch( path, self._get_bucket, key_prefix,
+                  uid=self.node.uid, gid=self.node.gid ) is None:
+            log.info( "Shared directory was not staged in S3, copying %s from master", path )
+            self._rsync( self.master_host, path )
+
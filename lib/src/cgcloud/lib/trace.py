@@ -0,0 +1,296 @@
+"""
+A lightweight tracer for measuring where the time goes in long-running operations like
+creating a cluster. The tracer records spans, i.e. named and timed phases of an operation.
+Spans nest: a span opened while another span is active on the same thread becomes a child of
+that span. Tasks run by cgcloud.lib.util.TaskGroup adopt the span that was active when they
+were submitted, so spans also nest across worker threads.
+
+The tracer is disabled by default, in which case opening a span costs little more than a
+method call.
+
+>>> t = Tracer( )
+>>> with t.span( 'outer' ) as outer:
+...     with t.span( 'inner', node=1 ) as inner:
+...         pass
+>>> len( t.spans ), outer, inner
+(0, None, None)
+>>> t.enabled = True
+>>> with t.span( 'outer' ) as outer:
+...     with t.span( 'inner', node=1 ) as inner:
+...         assert t.current( ) is inner
+>>> [ span.name for span in t.spans ]
+['inner', 'outer']
+>>> inner.parent is outer, outer.parent is None, inner.args, t.current( ) is None
+(True, True, {'node': 1}, True)
+>>> 0 <= inner.duration <= outer.duration
+True
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class Span( object ):
+    """
+    A named phase of an operation, timed from entering the span to exiting it. The args
+    dictionary holds additional details to be included in the trace. It can be amended while
+    the span is active.
+    """
+
+    __slots__ = ('tracer', 'name', 'args', 'parent', 'thread_id', 'thread_name', 'start', 'end')
+
+    def __init__( self, tracer, name, args, parent=None, start=None, end=None ):
+        super( Span, self ).__init__( )
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.parent = parent
+        thread = threading.current_thread( )
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.start = start
+        self.end = end
+
+    @property
+    def duration( self ):
+        """
+        The number of seconds spent in this span or None if the span hasn't finished yet.
+        """
+        return None if self.end is None else self.end - self.start
+
+    def __enter__( self ):
+        self.parent = self.tracer.current( )
+        self.tracer.local.span = self
+        self.start = time.time( )
+        return self
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.end = time.time( )
+        if exc_type is not None:
+            self.args[ 'error' ] = exc_type.__name__
+        self.tracer.local.span = self.parent
+        self.tracer.add( self )
+        return False
+
+    def __repr__( self ):
+        return 'Span(%r, %r)' % (self.name, self.args)
+
+
+class _NullSpan( object ):
+    """
+    The context manager returned by a disabled tracer
+    """
+
+    def __enter__( self ):
+        return None
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        return False
+
+
+class _Adoption( object ):
+    """
+    Makes a given span the current span of the calling thread for the duration of a with
+    statement.
+    """
+
+    __slots__ = ('tracer', 'span', 'previous')
+
+    def __init__( self, tracer, span ):
+        super( _Adoption, self ).__init__( )
+        self.tracer = tracer
+        self.span = span
+        self.previous = None
+
+    def __enter__( self ):
+        self.previous = self.tracer.current( )
+        self.tracer.local.span = self.span
+        return self.span
+
+    def __exit__( self, exc_type, exc_val, exc_tb ):
+        self.tracer.local.span = self.previous
+        return False
+
+
+_null_span = _NullSpan( )
+
+
+class Tracer( object ):
+    """
+    Records spans from any number of threads.
+    """
+
+    def __init__( self ):
+        super( Tracer, self ).__init__( )
+        self.enabled = False
+        self.epoch = time.time( )
+        self.spans = [ ]
+        self.lock = threading.Lock( )
+        self.local = threading.local( )
+
+    def current( self ):
+        """
+        Returns the span that is active on the calling thread, or None if there is no such span.
+        """
+        return getattr( self.local, 'span', None )
+
+    def span( self, name, **args ):
+        """
+        Returns a context manager that times the body of a with statement as a span of the
+        given name. The keyword arguments become the span's args. The context manager yields
+        the span, or None if this tracer is disabled.
+
+        :rtype: Span|None
+        """
+        if self.enabled:
+            return Span( self, name, args )
+        else:
+            return _null_span
+
+    def adopt( self, span ):
+        """
+        Returns a context manager that makes the given span, typically one that was opened on
+        another thread, the parent of any spans opened by the calling thread in the body of a
+        with statement.
+
+        >>> t = Tracer( )
+        >>> t.enabled = True
+        >>> def worker( parent ):
+        ...     with t.adopt( parent ):
+        ...         with t.span( 'child' ):
+        ...             pass
+        >>> with t.span( 'parent' ) as parent:
+        ...     thread = threading.Thread( target=worker, args=(parent,) )
+        ...     thread.start( )
+        ...     thread.join( )
+        >>> child = t.spans[ 0 ]
+        >>> child.parent is parent, child.thread_id != parent.thread_id
+        (True, True)
+        """
+        return _Adoption( self, span )
+
+    def record( self, name, start, end=None, **args ):
+        """
+        Record a span of the given name that started at the given time and ends now,
+        or at the given end time. This is useful for phases that can't be expressed as the body
+        of a with statement, like the time it takes for a spot request to be fulfilled.
+        The span becomes a child of the span that is active on the calling thread.
+
+        >>> t = Tracer( )
+        >>> t.record( 'foo', 0 )
+        >>> t.enabled = True
+        >>> t.record( 'foo', 1, 3, bar=True )
+        >>> t.spans
+        [Span('foo', {'bar': True})]
+        >>> t.spans[ 0 ].duration
+        2
+        """
+        if self.enabled:
+            if end is None:
+                end = time.time( )
+            self.add( Span( self, name, args, parent=self.current( ), start=start, end=end ) )
+
+    def add( self, span ):
+        with self.lock:
+            self.spans.append( span )
+
+    def chrome_trace( self ):
+        """
+        Returns the recorded spans as a dictionary in the Chrome trace event format. The result
+        can be loaded into chrome://tracing or https://ui.perfetto.dev. Spans are complete
+        events in the thread that recorded them. A span whose parent was recorded by another
+        thread is additionally linked to that parent by a flow event.
+
+        >>> t = Tracer( )
+        >>> t.enabled = True
+        >>> t.epoch = 0
+        >>> t.record( 'foo', 1, 1.5, node=1 )
+        >>> events = t.chrome_trace( )[ 'traceEvents' ]
+        >>> [ (e[ 'ph' ], e[ 'name' ]) for e in events ]
+        [('M', 'thread_name'), ('X', 'foo')]
+        >>> e = events[ -1 ]
+        >>> e[ 'ts' ], e[ 'dur' ], e[ 'args' ]
+        (1000000, 500000, {'node': 1})
+        """
+        pid = os.getpid( )
+
+        def micros( t ):
+            return int( round( (t - self.epoch) * 1e6 ) )
+
+        with self.lock:
+            spans = list( self.spans )
+        events = [ ]
+        threads = { }
+        for span in spans:
+            threads.setdefault( span.thread_id, span.thread_name )
+        for thread_id, thread_name in threads.iteritems( ):
+            events.append( dict( ph='M', name='thread_name', pid=pid, tid=thread_id,
+                                 args=dict( name=thread_name ) ) )
+        for flow_id, span in enumerate( sorted( spans, key=lambda s: s.start ) ):
+            ts = micros( span.start )
+            events.append( dict( ph='X', name=span.name, cat='cgcloud', pid=pid,
+                                 tid=span.thread_id, ts=ts,
+                                 dur=micros( span.end ) - ts, args=span.args ) )
+            parent = span.parent
+            if parent is not None and parent.thread_id != span.thread_id:
+                events.append( dict( ph='s', name=parent.name, cat='cgcloud', id=flow_id,
+                                     pid=pid, tid=parent.thread_id, ts=ts ) )
+                events.append( dict( ph='f', bp='e', name=parent.name, cat='cgcloud',
+                                     id=flow_id, pid=pid, tid=span.thread_id, ts=ts ) )
+        return dict( traceEvents=events, displayTimeUnit='ms' )
+
+    def write_chrome_trace( self, path ):
+        """
+        Write the recorded spans to the file at the given path in Chrome trace event format.
+        """
+        with open( path, 'w' ) as f:
+            json.dump( self.chrome_trace( ), f, default=str )
+
+    def summary( self, percentiles=(50, 90, 99) ):
+        """
+        Returns a table with one row per span name, in the order the first span of each name
+        was opened. Each row contains the name, the number of spans of that name, the given
+        percentiles of their durations and the maximum duration, in seconds. For example,
+        the row for the phase in which instances wait for SSH shows how long the typical and
+        the slowest node of a cluster spent waiting for SSH.
+
+        >>> t = Tracer( )
+        >>> t.enabled = True
+        >>> for i in range( 1, 11 ):
+        ...     t.record( 'boot', 0, i )
+        >>> t.record( 'rsync', 20, 21 )
+        >>> t.summary( )
+        [('boot', 10, 5, 9, 10, 10), ('rsync', 1, 1, 1, 1, 1)]
+        """
+        with self.lock:
+            spans = list( self.spans )
+        durations = OrderedDict( )
+        for span in sorted( spans, key=lambda s: s.start ):
+            durations.setdefault( span.name, [ ] ).append( span.duration )
+        table = [ ]
+        for name, values in durations.iteritems( ):
+            values.sort( )
+            table.append( tuple( [ name, len( values ) ]
+                                 + [ percentile( values, p ) for p in percentiles ]
+                                 + [ values[ -1 ] ] ) )
+        return table
+
+
+def percentile( values, p ):
+    """
+    Returns the p-th percentile of the given sorted list of values, using the nearest-rank
+    method.
+
+    >>> percentile( [ 1, 2, 3, 4 ], 50 ), percentile( [ 1, 2, 3, 4 ], 51 ), percentile( [ 7 ], 99 )
+    (2, 3, 7)
+    """
+    rank = max( 1, -(-len( values ) * p // 100) )
+    return values[ rank - 1 ]
+
+
+tracer = Tracer( )
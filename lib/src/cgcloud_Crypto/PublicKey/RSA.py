@@ -230,6 +230,7 @@ class _RSAobj():
         # DER format is always used, even in case of PEM, which simply
         # encodes it into BASE64.
         if self.has_private():
+                dP, dQ, qInv = self.key.crt()
                 binary_key = newDerSequence(
                         0,
                         self.n,
@@ -237,9 +238,9 @@ class _RSAobj():
                         self.d,
                         self.p,
                         self.q,
-                        self.d % (self.p-1),
-                        self.d % (self.q-1),
-                        inverse(self.q, self.p)
+                        dP,
+                        dQ,
+                        qInv
                     ).encode()
                 if pkcs==1:
                     keyType = 'RSA PRIVATE'
@@ -359,12 +360,17 @@ class RSAImplementation(object):
             # Try PKCS#1 first, for a private key
             if len(der) == 9 and der.hasOnlyInts() and der[0] == 0:
                 # ASN.1 RSAPrivateKey element
-                del der[6:]     # Remove d mod (p-1),
-                                # d mod (q-1), and
-                                # q^{-1} mod p
-                der.append(inverse(der[4], der[5]))  # Add p^{-1} mod q
-                del der[0]      # Remove version
-                return self.construct(der[:])
+                n, e, d, p, q, dP, dQ, qInv = der[1:]
+                if 0 < qInv < p and q * qInv % p == 1:
+                    u = _slowmath.rsa_inverse_crt(p, q, qInv)
+                else:
+                    u = inverse(p, q)
+                key = self.construct((n, e, d, p, q, u))
+                # Keep d mod (p-1), d mod (q-1) and q^{-1} mod p around for
+                # exporting the key later
+                if hasattr(key.key, 'set_crt'):
+                    key.key.set_crt(dP, dQ, qInv)
+                return key
 
             # Keep on trying PKCS#1, but now for a public key
             if len(der) == 2:
@@ -26,7 +26,7 @@
 
 __revision__ = "$Id$"
 
-__all__ = ['rsa_construct']
+__all__ = ['rsa_construct', 'rsa_inverse_crt']
 
 import sys
 
@@ -41,6 +41,37 @@ class _RSAKey(object):
     def has_private(self):
         return hasattr(self, 'd')
 
+    def crt(self):
+        """Return the CRT components (d mod (p-1), d mod (q-1), (1/q) mod p)
+        of a private key. They are computed on first use and cached since
+        exporting a key requires them and inverting q is comparatively
+        expensive."""
+        try:
+            return self._crt
+        except AttributeError:
+            self._crt = (self.d % (self.p - 1), self.d % (self.q - 1),
+                         inverse(self.q, self.p))
+            return self._crt
+
+    def set_crt(self, dP, dQ, qInv):
+        """Cache the given CRT components, as found in a PKCS#1 RSAPrivateKey,
+        if they are consistent with this key. Return True if they are."""
+        p, q = self.p, self.q
+        if (dP == self.d % (p - 1) and dQ == self.d % (q - 1)
+                and 0 < qInv < p and q * qInv % p == 1):
+            self._crt = (dP, dQ, qInv)
+            return True
+        return False
+
+def rsa_inverse_crt(p, q, qInv):
+    """Return (1/p) mod q given (1/q) mod p.
+
+    Since q*qInv = 1 + k*p for some k, -k is the inverse of p modulo q. This
+    takes a multiplication and a division instead of the extended Euclidean
+    algorithm. The caller must ensure that q*qInv = 1 mod p."""
+    k = (q * qInv - 1) // p
+    return -k % q
+
 def rsa_construct(n, e, d=None, p=None, q=None, u=None):
     """Construct an RSAKey object"""
     assert isinstance(n, long)
@@ -66,5 +97,39 @@ def rsa_construct(n, e, d=None, p=None, q=None, u=None):
         obj.u = inverse(obj.p, obj.q)
     return obj
 
+def _benchmark(bits=2048, number=200):
+    """Time the pure-Python number theory used when importing and exporting
+    RSA keys. Run with python -m cgcloud_Crypto.PublicKey._slowmath."""
+    import random, timeit
+    from cgcloud_Crypto.Util.number import long_to_bytes, bytes_to_long
+    from cgcloud_Crypto.PublicKey import RSA
+    # The numbers don't need to be prime, they only need to be of the right
+    # size and coprime.
+    rnd = random.Random(42)
+    while True:
+        p = rnd.getrandbits(bits // 2) | 1
+        q = rnd.getrandbits(bits // 2) | 1
+        if q * inverse(q, p) % p == 1:
+            break
+    d = rnd.getrandbits(bits)
+    qInv = inverse(q, p)
+    key = RSA.construct((p * q, 65537L, d, p, q, inverse(p, q)))
+    der_key = key.exportKey(format='DER')
+    n_bytes = long_to_bytes(key.n)
+    tests = [
+        ('inverse(q, p)', lambda: inverse(q, p)),
+        ('rsa_inverse_crt(p, q, qInv)', lambda: rsa_inverse_crt(p, q, qInv)),
+        ('long_to_bytes(n)', lambda: long_to_bytes(key.n)),
+        ('bytes_to_long(n)', lambda: bytes_to_long(n_bytes)),
+        ('RSA.importKey(der_key)', lambda: RSA.importKey(der_key)),
+        ('key.exportKey(format=DER)', lambda: key.exportKey(format='DER')),
+    ]
+    for name, f in tests:
+        t = timeit.timeit(f, number=number)
+        print('%-30s %10.2f us' % (name, t / number * 1e6))
+
+if __name__ == '__main__':
+    _benchmark()
+
 # vim:set ts=4 sw=4 sts=4 expandtab:
 
@@ -79,6 +79,50 @@ class BytesIO_EOF(BytesIO):
 class _NoDerElementError(EOFError):
     pass
 
+def _decodeTLV(view, offset, expectedIdOctet=None):
+    """Parse the identifier and length octets of the DER element starting at
+    *offset* in the memoryview *view*, without copying any data.
+
+    Return a tuple (idOctet, start, end) where *start* and *end* delimit the
+    payload of the element within *view*.
+
+    :Raise _NoDerElementError: If there is no element at *offset*.
+    :Raise EOFError: If the element is truncated.
+    :Raise ValueError: If the identifier octet isn't *expectedIdOctet*, if
+      given, or if the length octets are not valid DER.
+    """
+    size = len(view)
+    if offset >= size:
+        raise _NoDerElementError
+    idOctet = bord(view[offset])
+    if expectedIdOctet != None and idOctet != expectedIdOctet:
+        raise ValueError("Unexpected DER tag")
+    if offset + 1 >= size:
+        raise EOFError
+    length = bord(view[offset + 1])
+    start = offset + 2
+    if length > 127:
+        start += length & 0x7F
+        if start > size:
+            raise EOFError
+        length = bytes_to_long(view[offset + 2:start].tobytes())
+        # According to DER (but not BER) the long form is used
+        # only when the length doesn't fit into 7 bits.
+        if length <= 127:
+            raise ValueError("Not a DER length tag (but still valid BER).")
+    end = start + length
+    if end > size:
+        raise EOFError
+    return idOctet, start, end
+
+def _decodeInteger(view, start, end):
+    """Convert the payload of a DER INTEGER, delimited by *start* and *end*
+    within the memoryview *view*, to a Python integer in one go."""
+    value = bytes_to_long(view[start:end].tobytes())
+    if end > start and bord(view[start]) & 0x80:
+        value -= 1L << (8 * (end - start))
+    return value
+
 class DerObject(object):
         """Base class for defining a single DER object.
 
@@ -162,19 +206,6 @@ class DerObject(object):
                 # and contents octets
                 return bchr(self._idOctet) + self._lengthOctets() + self.payload
 
-        def _decodeLen(self, s):
-                """Decode DER length octets from a file."""
-
-                length = bord(s.read_byte())
-                if length<=127:
-                        return length
-                payloadLength = bytes_to_long(s.read(length & 0x7F))
-                # According to DER (but not BER) the long form is used
-                # only when the length doesn't fit into 7 bits.
-                if payloadLength<=127:
-                        raise ValueError("Not a DER length tag (but still valid BER).")
-                return payloadLength
-
         def decode(self, derEle):
                 """Decode a complete DER element, and re-initializes this
                 object with it.
@@ -189,29 +220,27 @@ class DerObject(object):
                   If the DER element is too short.
                 """
 
-                s = BytesIO_EOF(derEle)
-                self._decodeFromStream(s)
+                view = memoryview(derEle)
                 # There shouldn't be other bytes left
-                try:
-                    b = s.read_byte()
+                if self._decodeFromView(view, 0) != len(view):
                     raise ValueError("Unexpected extra data after the DER structure")
-                except EOFError:
-                    pass
-
-        def _decodeFromStream(self, s):
-                """Decode a complete DER element from a file."""
-
-                try:
-                    idOctet = bord(s.read_byte())
-                except EOFError:
-                    raise _NoDerElementError
-                if self._idOctet != None:
-                    if idOctet != self._idOctet:
-                        raise ValueError("Unexpected DER tag")
-                else:
-                    self._idOctet = idOctet
-                length = self._decodeLen(s)
-                self.payload = s.read(length)
+
+        def _decodeHeader(self, view, offset):
+                """Decode the identifier and length octets of the DER element
+                at *offset* in a memoryview and return the offsets delimiting
+                its payload."""
+
+                idOctet, start, end = _decodeTLV(view, offset, self._idOctet)
+                self._idOctet = idOctet
+                return start, end
+
+        def _decodeFromView(self, view, offset):
+                """Decode a complete DER element at *offset* in a memoryview
+                and return the offset of the first byte following it."""
+
+                start, end = self._decodeHeader(view, offset)
+                self.payload = view[start:end].tobytes()
+                return end
 
 class DerInteger(DerObject):
         """Class to model a DER INTEGER.
@@ -258,6 +287,13 @@ class DerInteger(DerObject):
                 binary string."""
 
                 number = self.value
+                if number >= 0:
+                    # Convert in bulk, prepending a zero byte if needed to
+                    # keep the value positive
+                    self.payload = long_to_bytes(number)
+                    if bord(self.payload[0]) & 0x80:
+                        self.payload = bchr(0x00) + self.payload
+                    return DerObject.encode(self)
                 self.payload = b('')
                 while True:
                     self.payload = bchr(number&255) + self.payload
@@ -283,21 +319,12 @@ class DerInteger(DerObject):
                 """
                 DerObject.decode(self, derEle)
 
-        def _decodeFromStream(self, s):
-                """Decode a complete DER INTEGER from a file."""
-
-                # Fill up self.payload
-                DerObject._decodeFromStream(self, s)
+        def _decodeFromView(self, view, offset):
+                """Decode a complete DER INTEGER from a memoryview."""
 
-                # Derive self.value from self.payload
-                self.value = 0L
-                bits = 1
-                for i in self.payload:
-                    self.value *= 256
-                    self.value += bord(i)
-                    bits <<= 8
-                if self.payload and bord(self.payload[0]) & 0x80:
-                    self.value -= bits
+                end = DerObject._decodeFromView(self, view, offset)
+                self.value = _decodeInteger(view, end - len(self.payload), end)
+                return end
 
 def newDerInteger(number):
     """Create a DerInteger object, already initialized with an integer."""
@@ -452,33 +479,26 @@ class DerSequence(DerObject):
                 """
                 DerObject.decode(self, derEle)
 
-        def _decodeFromStream(self, s):
-                """Decode a complete DER SEQUENCE from a file."""
+        def _decodeFromView(self, view, offset):
+                """Decode a complete DER SEQUENCE from a memoryview."""
 
                 self._seq = []
 
-                # Fill up self.payload
-                DerObject._decodeFromStream(self, s)
-
-                # Add one item at a time to self.seq, by scanning self.payload
-                p = BytesIO_EOF(self.payload)
-                while True:
-                    try:
-                        p.setRecord(True)
-                        der = DerObject()
-                        der._decodeFromStream(p)
-
-                        # Parse INTEGERs differently
-                        if der._idOctet != 0x02:
-                            self._seq.append(p._recording)
-                        else:
-                            derInt = DerInteger()
-                            derInt.decode(p._recording)
-                            self._seq.append(derInt.value)
-
-                    except _NoDerElementError:
-                        break
-                # end
+                start, end = self._decodeHeader(view, offset)
+                self.payload = view[start:end].tobytes()
+
+                # Walk the elements in place. INTEGERs are converted
+                # directly, any other element is copied out as is.
+                body = view[start:end]
+                pos = 0
+                while pos < len(body):
+                    idOctet, itemStart, itemEnd = _decodeTLV(body, pos)
+                    if idOctet != 0x02:
+                        self._seq.append(body[pos:itemEnd].tobytes())
+                    else:
+                        self._seq.append(_decodeInteger(body, itemStart, itemEnd))
+                    pos = itemEnd
+                return end
 
 def newDerSequence(*der_objs):
     """Create a DerSequence object, already initialized with all objects
@@ -624,26 +644,22 @@ class DerObjectId(DerObject):
 
         DerObject.decode(self, derEle)
 
-    def _decodeFromStream(self, s):
-        """Decode a complete DER OBJECT ID from a file."""
+    def _decodeFromView(self, view, offset):
+        """Decode a complete DER OBJECT ID from a memoryview."""
 
-        # Fill up self.payload
-        DerObject._decodeFromStream(self, s)
+        end = DerObject._decodeFromView(self, view, offset)
 
-        # Derive self.value from self.payload
-        p = BytesIO_EOF(self.payload)
-        comps = list(map(str, divmod(bord(p.read_byte()),40)))
+        if not self.payload:
+            raise EOFError
+        comps = list(map(str, divmod(bord(self.payload[0]),40)))
         v = 0
-        try:
-            while True:
-                c = p.read_byte()
-                v = v*128 + (bord(c) & 0x7F)
-                if not (bord(c) & 0x80):
-                    comps.append(str(v))
-                    v = 0
-        except EOFError:
-            pass
+        for c in self.payload[1:]:
+            v = v*128 + (bord(c) & 0x7F)
+            if not (bord(c) & 0x80):
+                comps.append(str(v))
+                v = 0
         self.value = '.'.join(comps)
+        return end
 
 def newDerObjectId(dottedstring):
     """Create a DerObjectId object, already initialized with the given Object
@@ -717,11 +733,11 @@ class DerBitString(DerObject):
 
         DerObject.decode(self, derEle)
 
-    def _decodeFromStream(self, s):
-        """Decode a complete DER BIT STRING DER from a file."""
+    def _decodeFromView(self, view, offset):
+        """Decode a complete DER BIT STRING DER from a memoryview."""
 
         # Fill-up self.payload
-        DerObject._decodeFromStream(self, s)
+        end = DerObject._decodeFromView(self, view, offset)
 
         if self.payload and bord(self.payload[0])!=0:
             raise ValueError("Not a valid BIT STRING")
@@ -731,6 +747,7 @@ class DerBitString(DerObject):
         # Remove padding count byte
         if self.payload:
             self.value = self.payload[1:]
+        return end
 
 def newDerBitString(binstring):
     """Create a DerStringString object, already initialized with the binary
@@ -833,41 +850,36 @@ class DerSetOf(DerObject):
 
         DerObject.decode(self, derEle)
 
-    def _decodeFromStream(self, s):
-        """Decode a complete DER SET OF from a file."""
+    def _decodeFromView(self, view, offset):
+        """Decode a complete DER SET OF from a memoryview."""
 
         self._seq = []
 
         # Fill up self.payload
-        DerObject._decodeFromStream(self, s)
+        start, end = self._decodeHeader(view, offset)
+        self.payload = view[start:end].tobytes()
 
-        # Add one item at a time to self.seq, by scanning self.payload
-        p = BytesIO_EOF(self.payload)
+        # Add one item at a time to self.seq, scanning the payload in place
+        body = view[start:end]
+        pos = 0
         setIdOctet = -1
-        while True:
-            try:
-                p.setRecord(True)
-                der = DerObject()
-                der._decodeFromStream(p)
-
-                # Verify that all members are of the same type
-                if setIdOctet < 0:
-                    setIdOctet = der._idOctet
-                else:
-                    if setIdOctet != der._idOctet:
-                        raise ValueError("Not all elements are of the same DER type")
+        while pos < len(body):
+            idOctet, itemStart, itemEnd = _decodeTLV(body, pos)
 
-                # Parse INTEGERs differently
-                if setIdOctet != 0x02:
-                    self._seq.append(p._recording)
-                else:
-                    derInt = DerInteger()
-                    derInt.decode(p._recording)
-                    self._seq.append(derInt.value)
+            # Verify that all members are of the same type
+            if setIdOctet < 0:
+                setIdOctet = idOctet
+            else:
+                if setIdOctet != idOctet:
+                    raise ValueError("Not all elements are of the same DER type")
 
-            except _NoDerElementError:
-                break
-        # end
+            # Parse INTEGERs differently
+            if setIdOctet != 0x02:
+                self._seq.append(body[pos:itemEnd].tobytes())
+            else:
+                self._seq.append(_decodeInteger(body, itemStart, itemEnd))
+            pos = itemEnd
+        return end
 
     def encode(self):
         """Return this SET OF DER element, fully encoded as a
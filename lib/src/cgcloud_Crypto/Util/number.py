@@ -80,17 +80,15 @@ def inverse(u, v):
     u3, v3 = long(u), long(v)
     u1, v1 = 1L, 0L
     while v3 > 0:
-        q=divmod(u3, v3)[0]
+        q, r = divmod(u3, v3)
         u1, v1 = v1, u1 - v1*q
-        u3, v3 = v3, u3 - v3*q
+        u3, v3 = v3, r
     while u1<0:
         u1 = u1 + v
     return u1
 
-# Improved conversion functions contributed by Barry Warsaw, after
-# careful benchmarking
 
-import struct
+import binascii
 
 def long_to_bytes(n, blocksize=0):
     """long_to_bytes(n:long, blocksize:int) : string
@@ -100,24 +98,14 @@ def long_to_bytes(n, blocksize=0):
     byte string with binary zeros so that the length is a multiple of
     blocksize.
     """
-    # after much testing, this algorithm was deemed to be the fastest
-    s = b('')
+    # Going through the hexadecimal representation lets the interpreter do
+    # the conversion in C instead of looping over 32-bit words in Python.
     n = long(n)
-    pack = struct.pack
-    while n > 0:
-        s = pack('>I', n & 0xffffffffL) + s
-        n = n >> 32
-    # strip off leading zeros
-    for i in range(len(s)):
-        if s[i] != b('\000')[0]:
-            break
+    if n > 0:
+        s = '%x' % n
+        s = binascii.unhexlify('0' * (len(s) & 1) + s)
     else:
-        # only happens when n == 0
         s = b('\000')
-        i = 0
-    s = s[i:]
-    # add back some pad bytes.  this could be done more efficiently w.r.t. the
-    # de-padding being done above, but sigh...
     if blocksize > 0 and len(s) % blocksize:
         s = (blocksize - len(s) % blocksize) * b('\000') + s
     return s
@@ -128,18 +116,10 @@ def bytes_to_long(s):
 
     This is (essentially) the inverse of long_to_bytes().
     """
-    acc = 0L
-    unpack = struct.unpack
-    length = len(s)
-    if length % 4:
-        extra = (4 - length % 4)
-        s = b('\000') * extra + s
-        length = length + extra
-    for i in range(0, length, 4):
-        acc = (acc << 32) + unpack('>I', s[i:i+4])[0]
-    return acc
-
-# For backwards compatibility...
+    if not s:
+        return 0L
+    return long(binascii.hexlify(s), 16)
+
 import warnings
 def long2str(n, blocksize=0):
     warnings.warn("long2str() has been replaced by long_to_bytes()")
@@ -359,15 +359,28 @@ class SparkBox( ApacheSoftwareBox,
             #!{tools_dir}/bin/python2.7
             import sys
             import logging
-            # Prefix each log line to make it more obvious that it's the master logging when the
-            # slave calls this script via ssh.
+            # Prefix each log line to make it more obvious that it's the slaves file being
+            # managed, as opposed to the master being discovered.
             logging.basicConfig( level=logging.INFO,
                                  format="manage_slaves: " + logging.BASIC_FORMAT )
             from cgcloud.spark_tools import SparkTools
             spark_tools = {spark_tools}
-            spark_tools.manage_slaves( slaves_to_add=sys.argv[1:] )""" ) ) )
+            if sys.argv[1:] == [ '--watch' ]:
+                spark_tools.watch_slaves( )
+            else:
+                spark_tools.manage_slaves( )""" ) ) )
         sudo( fmt( "chown root:root {script_path} && chmod 755 {script_path}" ) )
 
+        self._register_init_script(
+            "sparkbox-slaves",
+            heredoc( """
+                description "Spark/HDFS slaves file maintenance"
+                console log
+                start on sparkbox-start-master
+                stop on runlevel [!2345]
+                respawn
+                exec {script_path} --watch""" ) )
+
     @fabric_task
     def _lazy_mkdir( self, parent, name, persistent=False ):
         """